@@ -47,8 +47,8 @@ repo="printcfg"
 branch="master"
 # Get home directory
 home=$(eval echo ~"$USER")
-# Define the klipper config paths
-printer_data=$home/printer_data
+# Define the klipper config paths (PRINTCFG_DATA selects another instance)
+printer_data=${PRINTCFG_DATA:-$home/printer_data}
 config=$printer_data/config
 # Define the printer.cfg and moonraker.conf files
 printer=$config/printer.cfg
@@ -57,12 +57,20 @@ moonraker=$config/moonraker.conf
 default_src=default
 # Set the config file
 REPO_DATA="$home"/$repo/$repo.conf
+# Each fleet instance keeps its own (~/printer_data is the 'printer' instance)
+if [ -n "$PRINTCFG_INSTANCE" ] && [ "$PRINTCFG_INSTANCE" != printer ]
+then
+    REPO_DATA="$home"/$repo/$repo-$PRINTCFG_INSTANCE.conf
+fi
 
 # import logger4bash
 # shellcheck source=/dev/null
 source "$home"/$repo/src/log4bash.sh
+# import the helper daemon client
+# shellcheck source=/dev/null
+source "$home"/$repo/src/printcfg_call.sh
 # set log file
-LOGFILE="$home/$repo/logs/install.log"
+LOGFILE="$home/$repo/logs/install${PRINTCFG_INSTANCE:+-$PRINTCFG_INSTANCE}.log"
 
 exec 3>&1 4>&2
 trap 'exec 2>&4 1>&3' 0 1 2 3
@@ -191,6 +199,27 @@ function store_repo_data() {
     echo "printcfg configuration stored in $REPO_DATA."
 }
 
+# Find the unit of a klipper or moonraker service of this printer_data
+# (Eg: klipper-printer_2 for ~/printer_2_data), from its unit or environment file
+function find_unit() {
+    local unit env_file
+    for unit in /etc/systemd/system/"$1".service /etc/systemd/system/"$1"-*.service
+    do
+        [ -f "$unit" ] || continue
+        env_file=$(grep -oP '(?<=EnvironmentFile=)-?\K.*' "$unit")
+        if grep -qsP "\Q$printer_data\E([/\"\s]|$)" "$unit" "$env_file"
+        then
+            basename "$unit" .service
+            return
+        fi
+    done
+    # The plain service serves the default printer_data
+    if [ "$printer_data" = "$home/printer_data" ] && [ -f /etc/systemd/system/"$1".service ]
+    then
+        echo "$1"
+    fi
+}
+
 # Check if a file exists
 function file_exists() {
     if [ ! -f "$1" ]
@@ -273,8 +302,10 @@ then
     echo "Updating $repo repo..."
     # Change to the repo directory
     cd "$home"/$repo || exit
-    # Pull the latest changes
-    git pull
+    # Pull the latest changes (unless another instance already did)
+    if [ -z "$PRINTCFG_REPO_UPDATED" ]; then
+        git pull
+    fi
 else
     echo "Installing $repo repo..."
     # Clone the repo
@@ -335,7 +366,9 @@ fi
 
 # Install the dependencies
 echo "Installing dependencies..."
-if [ -f requirements.txt ]; then
+if [ -n "$PRINTCFG_REPO_UPDATED" ]; then
+    echo -e "\e[33mDependencies already installed.\e[0m"
+elif [ -f requirements.txt ]; then
     pip3 install -r requirements.txt
     echo -e "\e[32mDependencies installed successfully.\e[0m"
 else
@@ -426,43 +459,22 @@ dir_exists "$config" "klipper"
 # Check if the file exists
 file_exists "$printer" "klipper"
 
-# Check if user_config file exists
-if [ ! -f "$config"/user_config.cfg ]
+# Check if profile exists
+if [ ! -f "$home"/$repo/profiles/"$src"/config.cfg ] || [ ! -f "$home"/$repo/profiles/"$src"/variables.cfg ]
 then
-    # Check if profile config exists
-    if [ ! -f "$home"/$repo/profiles/"$src"/config.cfg ]
-    then
-        echo -e "\e[31mError: Config Profile '$src' not found.\e[0m"
-        echo "Using default config profile: $default_src"
-        src=$default_src
-    fi
-    # Copy user profile to config directory
-    echo -e "\e[36mUsing config profile: $src\e[0m"
-    echo "Creating user_config in config directory..."
-    cp -r "$home"/$repo/profiles/"$src"/config.cfg "$config"/user_config.cfg
-else
-    echo -e "\e[32mUser config already exists.\e[0m"
+    echo -e "\e[31mError: Profile '$src' not found.\e[0m"
+    echo "Using default profile: $default_src"
+    src=$default_src
 fi
-
-# Check if profile exists
 profile_exists "$src"
 
-# Check if user profile file exists
-if [ ! -f "$config"/user_profile.cfg ]
+# Create the user config and user profile if they do not exist yet
+echo -e "\e[36mUsing profile: $src\e[0m"
+echo "Syncing user config and user profile..."
+if ! python3 "$home"/$repo/src/sync_profile.py "$src" "$config" "$home/$repo"
 then
-    # Check if profile exists
-    if [ ! -f "$home"/$repo/profiles/"$src"/variables.cfg ]
-    then
-        echo -e "\e[31mError: Profile '$src' not found.\e[0m"
-        echo "Using default variables profile: $default_src"
-        src=$default_src
-    fi
-    # Copy user profile to config directory
-    echo -e "\e[36mUsing variables profile: $src\e[0m"
-    echo "Creating user profile in config directory..."
-    cp -r "$home"/$repo/profiles/"$src"/variables.cfg "$config"/user_profile.cfg
-else
-    echo -e "\e[32mUser profile already exists.\e[0m"
+    echo -e "\e[31mError: User profile sync failed.\e[0m"
+    exit 1
 fi
 
 # Check if link already exists
@@ -489,7 +501,7 @@ then
 else
     echo "Adding $repo config to $printer..."
     # Add printcfg config to beginning of file
-    python3 "$home"/$repo/src/search_replace.py "$uconfig_pattern" "$uconfig_pattern" "$printer"
+    printcfg_call replace "$uconfig_pattern" "$uconfig_pattern" "$printer"
 fi
 
 # Verify moonraker is installed
@@ -643,7 +655,7 @@ then
 else
     echo "Adding $repo config to $moonraker..."
     # Add printcfg config to moonraker
-    python3 "$home"/$repo/src/search_replace.py "$moon_pattern" "$new_moon" "$moonraker"
+    printcfg_call replace "$moon_pattern" "$new_moon" "$moonraker"
 fi
 
 # Add printcfg to moonraker.asvc
@@ -748,13 +760,30 @@ echo
 # Store repo data
 store_repo_data
 
-# Restart klipper
-echo "Restarting klipper..."
-systemctl restart klipper
+# Only restart the services of this instance
+klipper_unit=$(find_unit klipper)
+moonraker_unit=$(find_unit moonraker)
+
+# Restart klipper, unless it would interrupt a print
+if [ -z "$klipper_unit" ]
+then
+    echo -e "\e[33mNo klipper service found for $printer_data: restart it manually.\e[0m"
+elif PRINTCFG_DATA="$printer_data" python3 "$home"/$repo/src/moonraker.py idle
+then
+    echo "Restarting $klipper_unit..."
+    systemctl restart "$klipper_unit"
+else
+    echo -e "\e[33mA print is running: restart $klipper_unit once it has finished.\e[0m"
+fi
 
 # Restart moonraker
-echo "Restarting moonraker..."
-systemctl restart moonraker
+if [ -z "$moonraker_unit" ]
+then
+    echo -e "\e[33mNo moonraker service found for $printer_data: restart it manually.\e[0m"
+else
+    echo "Restarting $moonraker_unit..."
+    systemctl restart "$moonraker_unit"
+fi
 
 echo
 echo -e "\e[32mInstallation completed successfully.\e[0m"
@@ -42,21 +42,22 @@
 repo="printcfg"
 # Get home directory
 home=$(eval echo ~"$USER")
-# Define the klipper config file
-config=$home/printer_data/config
+# Define the klipper config file (PRINTCFG_DATA selects another instance)
+config=${PRINTCFG_DATA:-$home/printer_data}/config
 # Define the printer.cfg and moonraker.conf files
-printer=$home/printer_data/config/printer.cfg
+printer=$config/printer.cfg
 user_vars=$config/user_profile.cfg
 user_cfg=$config/user_config.cfg
+
+# import the helper daemon client
+# shellcheck source=/dev/null
+source "$home"/$repo/src/printcfg_call.sh
+
 old_user_cfg=$config/$repo/user_config.cfg
-# Patterns to identify profile name and version
-profile_pattern="# Profile:(.*)"
-patch_pattern="# Patch:(.*)"
 uconfig_pattern_old="[include $repo/user_config.cfg]"
 uconfig_pattern_new="[include user_config.cfg]"
-ver_patch="# Patch: *"
 
-LOGFILE="$home/$repo/logs/patch.log"
+LOGFILE="$home/$repo/logs/patch${PRINTCFG_INSTANCE:+-$PRINTCFG_INSTANCE}.log"
 exec 3>&1 1>"$LOGFILE" 2>&1
 trap "echo 'ERROR: An error occurred during execution, check log for details.' >&3" ERR
 trap '{ set +x; } 2>/dev/null; echo -n "[$(date -Is)]  "; set -x' DEBUG
@@ -99,7 +100,7 @@ then
         then
             echo -e "\e[31mInclude line is out of date.\e[0m"
             # Replace old include line with new include line
-            python3 "$home"/$repo/src/search_replace.py "$uconfig_pattern_old" "$uconfig_pattern_new" "$printer"
+            printcfg_call replace "$uconfig_pattern_old" "$uconfig_pattern_new" "$printer"
             # Verify include line was added
             if grep -qFx "$uconfig_pattern_new" "$printer"
             then
@@ -128,191 +129,7 @@ else
     echo -e "\e[32mUser config path is up to date.\e[0m" >&3
 fi
 
-# Check user config profile marker
-echo "Checking user config: profile..." >&3
-
-# Search for the profile_pattern in the user_cfg using grep
-config_profile=$(grep -oP "$profile_pattern" "$user_cfg" | cut -d':' -f2)
-
-if [ -n "$config_profile" ]; then
-    echo "Profile: $config_profile" >&3
-else
-    echo -e "\e[31mUser config profile marker not found.\e[0m" >&3
-    exit 1
-fi
-
-# Check user config patch version marker
-echo "Checking user config: version..." >&3
-
-# Search for the patch pattern in the user_cfg
-config_ver=$(grep -oP "$patch_pattern" "$user_cfg" | cut -d':' -f2)
-
-if [ -n "$config_ver" ]; then
-    # Extract the version number using sed
-    echo "Version: $config_ver" >&3
-else
-    echo -e "\e[31mUser config version marker not found.\e[0m" >&3
-    exit 1
-fi
-
-# Check user profile profile marker
-echo "Checking user profile: profile..." >&3
-
-# Search for the profile_pattern in the user_vars using grep
-vars_profile=$(grep -oP "$profile_pattern" "$user_vars" | cut -d':' -f2)
-
-if [ -n "$vars_profile" ]; then
-    echo "Profile: $vars_profile" >&3
-else
-    echo -e "\e[31mUser profile profile marker not found.\e[0m" >&3
-    exit 1
-fi
-
-# Check user profile patch version marker
-echo "Checking user profile: version..." >&3
-
-# Search for the patch pattern in the user_vars
-vars_ver=$(grep -oP "$patch_pattern" "$user_vars" | cut -d':' -f2)
-
-if [ -n "$vars_ver" ]; then
-    # Extract the version number using sed
-    echo "Version: $vars_ver" >&3
-else
-    echo -e "\e[31mUser profile version marker not found.\e[0m" >&3
-    exit 1
-fi
-
-# Find the latest version in the patch_notes.
+# Apply every pending patch to the user config and user profile
 echo "Checking patch notes..." >&3
-
-# Search for the patch pattern in the patch_notes
-patch_notes="$home/$repo/profiles/$vars_profile/patch_notes.txt"
-
-# Read version from patch notes
-highest_version=$(python3 "$home"/$repo/src/read_patch_notes.py "$patch_notes")
-
-# Print the highest version number
-echo "Latest patch is: $highest_version" >&3
-
-# Check if the user config version is the same as the highest version
-if [ "$config_ver" = "$highest_version" ]; then
-    echo -e "\e[32mUser config is up to date.\e[0m" >&3
-    update_config=False
-else
-    echo -e "\e[31mUser config is out of date.\e[0m" >&3
-    update_config=True
-fi
-
-# Check if the user profile version is the same as the highest version
-
-if [ "$vars_ver" = "$highest_version" ]; then
-    echo -e "\e[32mUser profile is up to date.\e[0m" >&3
-    update_profile=False
-else
-    echo -e "\e[31mUser profile is out of date.\e[0m" >&3
-    update_profile=True
-fi
-
-if [ "$update_config" = "False" ] && [ "$update_profile" = "False" ]; then
-    echo -e "\e[32mUser config and profile are up to date.\e[0m" >&3
-    echo -e "\e[32mNo action required.\e[0m" >&3
-    exit 0
-else
-    # Search for patch files matching the user profile version
-    echo "Searching for patch files..." >&3
-    vars_patch=$home/$repo/profiles/$vars_profile/patches/$highest_version/vars.patch
-    config_patch=$home/$repo/profiles/$config_profile/patches/$highest_version/config.patch
-    
-    # Check if the config needs to be updated
-    if [ "$update_config" = "True" ]; then
-        # Check if the patch file exists
-        if [ -f "$config_patch" ]; then
-            echo "Patch file found." >&3
-            # Append the contents of the patch file to the user config
-            echo "Applying config patch file..." >&3
-            cat "$config_patch" >> "$user_cfg"
-            echo "Config patch file applied." >&3
-            # Update version number in user config
-            echo "Updating version number..." >&3
-            # Replace the version number using sed
-            python3 "$home"/$repo/src/search_replace.py "$ver_patch" "$ver_patch$highest_version" "$user_cfg"
-            # Verify that the version number has been updated
-            if grep -qFx "$ver_patch$highest_version" "$user_cfg"
-            then
-                echo -e "\e[32mVersion number updated.\e[0m" >&3
-            else
-                echo -e "\e[31mVersion number update failed.\e[0m" >&3
-                exit 1
-            fi
-            echo "Version number updated." >&3
-        else
-            echo -e "\e[31mConfig patch file not found.\e[0m" >&3
-            echo "Patch file: $config_patch" >&3
-            exit 1
-        fi
-    fi
-    
-    # Check if the profile needs to be updated
-    if [ "$update_profile" = "True" ]; then
-        # Check if the patch file exists
-        if [ -f "$vars_patch" ]; then
-            echo "Patch file found." >&3
-            # Append the contents of the patch file to the user config
-            echo "Applying profile patch file..." >&3
-            # Find the line containing '# End Custom Variables #'
-            vars_end=$(grep -n '# End Custom Variables #' "$user_vars" | cut -d':' -f1)
-            # Make sure the line number is not empty
-            if [ -z "$vars_end" ]; then
-                echo -e "\e[31mEnd of custom variables marker not found.\e[0m" >&3
-                echo "Marker: # End Custom Variables #" >&3
-                echo >&3
-                echo "Using 'gcode:' instead." >&3
-                vars_end=$(grep -n 'gcode:' "$user_vars" | cut -d':' -f1)
-            fi
-            # Add the patch before the line
-            sed -i "$vars_end r $vars_patch" "$user_vars"
-            # Add a newline after the patch
-            sed -i "$vars_end a \ " "$user_vars"
-            echo "Profile patch file applied." >&3
-            # Update version number in user profile
-            echo "Updating version number..." >&3
-            # Replace the version number using sed
-            python3 "$home"/$repo/src/search_replace.py "$ver_patch" "$ver_patch$highest_version" "$user_vars"
-            # Verify that the version number has been updated
-            if grep -qFx "$ver_patch$highest_version" "$user_vars"
-            then
-                echo -e "\e[32mVersion number updated.\e[0m" >&3
-            else
-                echo -e "\e[31mVersion number update failed.\e[0m" >&3
-                exit 1
-            fi
-        else
-            echo -e "\e[31mProfile patch file not found.\e[0m" >&3
-            echo "Patch file: $vars_patch" >&3
-            exit 1
-        fi
-    fi
-    
-    # Summarize results
-    echo >&3
-    echo "Summary:" >&3
-    if [ "$update_config" = "True" ]; then
-        echo -e "\e[32mUser config was successfully patched.\e[0m" >&3
-        echo -e "Version: $highest_version" >&3
-    else
-        echo -e "\e[32mUser config patch was not needed.\e[0m" >&3
-        echo -e "Version: $config_ver" >&3
-    fi
-    if [ "$update_profile" = "True" ]; then
-        echo -e "\e[32mUser profile was successfully patched.\e[0m" >&3
-        echo -e "Version: $highest_version" >&3
-    else
-        echo -e "\e[32mUser profile patch was not needed.\e[0m" >&3
-        echo -e "Version: $vars_ver" >&3
-    fi
-    
-    echo >&3
-    echo -e "\e[32mPatching completed successfully.\e[0m" >&3
-    exit 0
-    
-fi
\ No newline at end of file
+python3 "$home"/$repo/src/apply_patches.py "$config" "$home/$repo" >&3
+exit $?
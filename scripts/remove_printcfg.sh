@@ -56,6 +56,14 @@ else
     echo -e "\e[31m$service_file does not exist.\e[0m"
 fi
 
+# Stop and remove the printcfg helper daemon
+daemon_file="/etc/systemd/system/$repo-daemon.service"
+if [ -L "$daemon_file" ] || [ -f "$daemon_file" ]; then
+    sudo systemctl stop $repo-daemon.service
+    sudo systemctl disable $repo-daemon.service || { echo -e "\e[31mFailed to disable $repo-daemon service.\e[0m"; exit 1; }
+    sudo rm "$daemon_file" || { echo -e "\e[31mFailed to remove $daemon_file.\e[0m"; exit 1; }
+fi
+
 # Remove the [include user_config.cfg] line from printer.cfg
 include_line="[include user_config.cfg]"
 replace_line="#[include user_config.cfg]"
@@ -43,10 +43,10 @@
 repo="printcfg"
 # Get home directory
 home=$(eval echo ~"$USER")
-# Define the klipper config file
-config=$home/printer_data/config
+# Define the klipper config file (PRINTCFG_DATA selects another instance)
+config=${PRINTCFG_DATA:-$home/printer_data}/config
 # Define the printer.cfg and moonraker.conf files
-printer=$home/printer_data/config/printer.cfg
+printer=$config/printer.cfg
 # Set the default profile
 default_src=default
 user_vars=$config/user_profile.cfg
@@ -56,7 +56,7 @@ old_user_cfg=$config/$repo/user_config.cfg
 # Set the config file
 REPO_DATA="$home"/$repo/$repo.conf
 
-LOGFILE="$home/$repo/logs/setup.log"
+LOGFILE="$home/$repo/logs/setup${PRINTCFG_INSTANCE:+-$PRINTCFG_INSTANCE}.log"
 exec 3>&1 1>"$LOGFILE" 2>&1
 trap "echo 'ERROR: An error occurred during execution, check log for details.' >&3" ERR
 trap '{ set +x; } 2>/dev/null; echo -n "[$(date -Is)]  "; set -x' DEBUG
@@ -102,81 +102,16 @@ fi
 # Check for force parameter
 if [ "$2" == "force" ]
 then
-    echo -e "\e[31mChanging user profile to $default_src.\e[0m" >&3
+    echo -e "\e[31mChanging user profile to $profile_used.\e[0m" >&3
     echo
-    echo "Updating user config..." >&3
-    # Check if src_cfg exists
-    if [ -f "$src_cfg" ]
+    echo "Updating user config and user profile..." >&3
+    # Only the files that differ from the profile are written
+    if ! python3 "$home"/$repo/src/sync_profile.py --force "$profile_used" "$config" "$home/$repo" >&3
     then
-        # Check if user config exists
-        if [ -f "$user_cfg" ]
-        then
-            # Remove old user config
-            rm "$user_cfg"
-            # Verify removal was successful
-            if [ ! -f "$user_cfg" ]
-            then
-                echo "Old user config removed." >&3
-                # Copy new user config
-                cp "$src_cfg" "$user_cfg"
-                # Verify copy was successful
-                if [ -f "$user_cfg" ]
-                then
-                    echo "New user config copied."
-                    # User config is up to date
-                    echo -e "\e[32mUser config is now up to date.\e[0m" >&3
-                else
-                    echo -e "\e[31mUser config copy failed.\e[0m" >&3
-                    exit 1
-                fi
-            else
-                echo -e "\e[31mOld user config removal failed.\e[0m" >&3
-                exit 1
-            fi
-        else
-            echo -e "\e[31mUser config does not exist.\e[0m" >&3
-            exit 1
-        fi
-    else
-        echo -e "\e[31mSource config does not exist.\e[0m" >&3
-        exit 1
-    fi
-    # Check if src_vars exists
-    if [ -f "$src_vars" ]
-    then
-        # Check if user vars exists
-        if [ -f "$user_vars" ]
-        then
-            # Remove old user vars
-            rm "$user_vars"
-            # Verify removal was successful
-            if [ ! -f "$user_vars" ]
-            then
-                echo "Old user vars removed."
-                # Copy new user vars
-                cp "$src_vars" "$user_vars"
-                # Verify copy was successful
-                if [ -f "$user_vars" ]
-                then
-                    echo "New user vars copied."
-                    # User vars is up to date
-                    echo -e "\e[32mUser vars is now up to date.\e[0m" >&3
-                else
-                    echo -e "\e[31mUser vars copy failed.\e[0m" >&3
-                    exit 1
-                fi
-            else
-                echo -e "\e[31mOld user vars removal failed.\e[0m" >&3
-                exit 1
-            fi
-        else
-            echo -e "\e[31mUser vars does not exist.\e[0m" >&3
-            exit 1
-        fi
-    else
-        echo -e "\e[31mSource vars does not exist.\e[0m" >&3
+        echo -e "\e[31mUser profile sync failed.\e[0m" >&3
         exit 1
     fi
+    echo -e "\e[32mUser config and user profile are now up to date.\e[0m" >&3
 else
     echo "Checking user config..." >&3
     # Check that user config exists
@@ -200,10 +135,11 @@ else
             if grep -qFx "[include $repo/user_config.cfg]" "$printer"
             then
                 echo -e "\e[31mInclude line is out of date.\e[0m" >&3
-                # Remove old include line
-                sed -i "/\[include $repo\/user_config.cfg\]/d" "$printer"
-                # Add new include line
-                sed -i "1s/^/[include user_config.cfg]\n/" "$printer"
+                # Remove old include line and add new include line (one atomic write)
+                python3 "$home"/$repo/src/search_replace.py \
+                    --delete "[include $repo/user_config.cfg]" \
+                    --replace "[include user_config.cfg]" "[include user_config.cfg]" \
+                    "$printer"
                 # Verify include line was added
                 if grep -qFx "[include user_config.cfg]" "$printer"
                 then
@@ -257,13 +193,10 @@ else
         fi
     fi
     
-    # Find version of user profile
-    user_vars_version=$(grep -oP '(variable_version: ).*' "$user_vars")
-    user_vars_version=${user_vars_version#variable_version: }
-    src_vars_version=$(grep -oP '(variable_version: ).*' "$src_vars")
-    src_vars_version=${src_vars_version#variable_version: }
-    #user_vars_version=$(python3 "$home"/$repo/src/find_string.py "variable_version: " "$user_vars")
-    #src_vars_version=$(python3 "$home"/$repo/src/find_string.py "variable_version: " "$src_vars")
+    # Find version of user profile and source profile in one lookup
+    eval "$(python3 "$home"/$repo/src/find_string.py --batch "$user_vars" \
+        user_vars_version=variable_version \
+        --file "$src_vars" src_vars_version=variable_version --shell)"
     
     # Check if user profile is up to date
     
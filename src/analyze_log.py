@@ -0,0 +1,565 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script summarizes the prints of a klippy.log.
+# The log is memory-mapped and scanned with a single compiled pattern, and
+# each print is summarized as soon as it ends, so the memory used does not
+# grow with the size of the log.
+#
+# Klipper does not log the G-code it runs, so the print start is timed
+# from the heater states of the 'Stats' lines:
+#
+#   - heating: how long each heater took to reach each of its targets.
+#   - start: from the start of the print until the extruder reached its
+#     printing temperature (the end of START_PRINT, before purging).
+#   - soak: the time the print was paused before that (timed heat soaks
+#     pause the print until heat_soak_timer resumes it).
+#
+# For each print it also reports the lowest buffer_time while printing,
+# print stalls, MCU load and retransmits, host load, macro errors and
+# shutdowns, and the entries echoed by the 'logger' macro (variable_echo).
+#
+# Usage:
+#   python3 analyze_log.py [<klippy.log> ...] [--json] [--output <file>]
+#
+# Options:
+#   --json: Print the summaries as JSON lines.
+#   --output: Also write the summaries to a JSON lines file.
+#
+# Example:
+#   python3 analyze_log.py ~/printer_data/logs/klippy.log.2023-10-01 \
+#       ~/printer_data/logs/klippy.log
+
+import json
+import mmap
+import os
+import re
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, TextIO
+
+from log_setup import get_logger
+
+logger = get_logger("analyze_log")
+
+# The printer_data directory (PRINTCFG_DATA selects another instance)
+PRINTER_DATA = os.environ.get(
+    "PRINTCFG_DATA", os.path.join(os.path.expanduser("~"), "printer_data")
+)
+# The Klipper log
+KLIPPY_LOG = os.path.join(PRINTER_DATA, "logs", "klippy.log")
+# Degrees below its target at which a heater counts as heated
+HEATER_TOLERANCE = 2.0
+# buffer_time (seconds) below which the host is falling behind the printer
+LOW_BUFFER_TIME = 0.1
+# Most heating steps, events and error messages kept per print
+MAX_ITEMS = 20
+# Values of a Stats line, in the formats of the Klipper stats() methods
+HEATER_STATS = re.compile(r" target=([\d.]+) temp=([-\d.]+)")
+MCU_STATS = re.compile(
+    r" mcu_awake=([\d.]+) mcu_task_avg=([\d.]+) .*?bytes_retransmit=(\d+)"
+)
+TOOLHEAD_STATS = re.compile(
+    r"print_time=([\d.]+) buffer_time=([\d.]+) print_stall=(\d+)"
+)
+HOST_STATS = re.compile(r"sysload=([\d.]+) cputime=[\d.]+ memavail=(\d+)")
+
+MATCHER = re.compile(
+    rb"^(?:"
+    rb"Stats (?P<stats>[\d.]+): (?P<values>.*)"
+    rb"|Start printer at .*\((?P<wall>[\d.]+) (?P<mono>[\d.]+)\)"
+    rb"|(?P<sd>Starting|Exiting) SD card print \(position (?P<position>\d+)\)"
+    rb"|(?P<finished>Finished) SD card print"
+    rb"|Error (?:evaluating|loading template) '(?:gcode_macro )?(?P<macro>[^':]+)"
+    rb"[^']*': (?P<macro_error>.*)"
+    rb"|Transition to shutdown state: (?P<shutdown>.*)"
+    rb"|(?P<error>(?:Internal error on command|Unknown command|Must home axis first"
+    rb"|Move out of range|Move exceeds maximum extrusion|Extrude below minimum temp"
+    rb"|Timer too close|MCU '[^']*' shutdown)\b.*)"
+    rb"|LOGGER (?P<level>[A-Z]+): (?P<title>.*?): (?P<message>.*)"
+    rb")\r?$",
+    re.MULTILINE,
+)
+
+
+def parse_stats(text: str) -> Dict[str, Dict[str, float]]:
+    """
+    Gets the values of a Stats line used by the summaries, by section.
+    Only patterns starting with a literal are used: they are searched much
+    faster than the line can be split into its values.
+
+    Args:
+        text: The values (Eg: 'gcodein=0 mcu: mcu_awake=0.004 ...').
+
+    Returns:
+        The values of each section (Eg: {'mcu': {'mcu_awake': 0.004}}),
+        with the toolhead and host values in the '' section.
+    """
+    sections: Dict[str, Dict[str, float]] = {"": {}}
+    for match in HEATER_STATS.finditer(text):
+        sections[_section_name(text, match.start())] = {
+            "target": float(match.group(1)),
+            "temp": float(match.group(2)),
+        }
+    for match in MCU_STATS.finditer(text):
+        sections[_section_name(text, match.start())] = {
+            "mcu_awake": float(match.group(1)),
+            "mcu_task_avg": float(match.group(2)),
+            "bytes_retransmit": float(match.group(3)),
+        }
+    match = TOOLHEAD_STATS.search(text)
+    if match:
+        sections[""]["print_time"] = float(match.group(1))
+        sections[""]["buffer_time"] = float(match.group(2))
+        sections[""]["print_stall"] = float(match.group(3))
+    match = HOST_STATS.search(text)
+    if match:
+        sections[""]["sysload"] = float(match.group(1))
+        sections[""]["memavail"] = float(match.group(2))
+    return sections
+
+
+def _section_name(text: str, end: int) -> str:
+    """Get the name of the section ending at a position (Eg: 'mcu:' = 'mcu')."""
+    return text[text.rfind(" ", 0, end - 1) + 1 : end - 1]
+
+
+def _append(items: List[Any], item: Any):
+    """Keep an item, up to MAX_ITEMS."""
+    if len(items) < MAX_ITEMS:
+        items.append(item)
+
+
+class PrintTimeline:
+    """What happened during one print."""
+
+    def __init__(self, number: int, session: int, start: float, wall: Optional[float]):
+        self.number = number
+        self.session = session
+        self.start = start
+        self.wall = wall
+        self.end = start
+        self.result = "running"
+        self.heaters: Dict[str, Dict[str, Any]] = {}
+        self.heating: List[Dict[str, Any]] = []
+        self.pauses: List[List[float]] = []
+        self.exited: Optional[float] = None
+        self.last_print_time: Optional[float] = None
+        self.buffer_min: Optional[float] = None
+        self.low_buffer = 0
+        self.stalls_first: Optional[float] = None
+        self.stalls = 0.0
+        self.sysload_max = 0.0
+        self.memavail_min: Optional[float] = None
+        self.mcus: Dict[str, Dict[str, float]] = {}
+        self.errors = 0
+        self.macro_errors: Dict[str, int] = {}
+        self.messages: List[str] = []
+        self.shutdown: Optional[str] = None
+        self.events: List[Dict[str, Any]] = []
+
+    def stats(self, eventtime: float, sections: Dict[str, Dict[str, float]]):
+        """Update the timeline with a Stats line."""
+        self.end = eventtime
+        heated = True
+        for name, values in sections.items():
+            if "target" in values and "temp" in values:
+                heated = self._heater(eventtime, name, values) and heated
+            elif "mcu_awake" in values:
+                mcu = self.mcus.setdefault(
+                    name,
+                    {
+                        "awake_max": 0.0,
+                        "task_avg_max": 0.0,
+                        "retransmit_first": values.get("bytes_retransmit", 0.0),
+                    },
+                )
+                mcu["awake_max"] = max(mcu["awake_max"], values["mcu_awake"])
+                mcu["task_avg_max"] = max(
+                    mcu["task_avg_max"], values.get("mcu_task_avg", 0.0)
+                )
+                mcu["retransmit_last"] = values.get("bytes_retransmit", 0.0)
+        host = sections[""]
+        if "print_stall" in host:
+            if self.stalls_first is None:
+                self.stalls_first = host["print_stall"]
+            self.stalls = host["print_stall"] - self.stalls_first
+        self.sysload_max = max(self.sysload_max, host.get("sysload", 0.0))
+        if "memavail" in host:
+            memavail = host["memavail"]
+            self.memavail_min = min(self.memavail_min or memavail, memavail)
+        print_time = host.get("print_time")
+        moving = (
+            print_time is not None
+            and self.last_print_time is not None
+            and print_time > self.last_print_time
+        )
+        self.last_print_time = print_time
+        # Only while printing: the buffer is empty while waiting for heaters
+        if moving and heated and self.exited is None and "buffer_time" in host:
+            buffer_time = host["buffer_time"]
+            if self.buffer_min is None or buffer_time < self.buffer_min:
+                self.buffer_min = buffer_time
+            if buffer_time < LOW_BUFFER_TIME:
+                self.low_buffer += 1
+
+    def _heater(self, eventtime: float, name: str, values: Dict[str, float]) -> bool:
+        """Follow a heater. Returns whether it is at its target (or off)."""
+        target = values["target"]
+        state = self.heaters.get(name)
+        if state is None or state["target"] != target:
+            state = {"target": target, "since": eventtime, "reached": False}
+            self.heaters[name] = state
+        if target <= 0:
+            return True
+        if not state["reached"] and values["temp"] >= target - HEATER_TOLERANCE:
+            state["reached"] = True
+            _append(
+                self.heating,
+                {
+                    "heater": name,
+                    "target": target,
+                    "at": round(state["since"] - self.start, 1),
+                    "seconds": round(eventtime - state["since"], 1),
+                },
+            )
+        return state["reached"]
+
+    def resume(self, eventtime: float):
+        """The print was resumed."""
+        if self.exited is not None:
+            _append(self.pauses, [self.exited - self.start, eventtime - self.exited])
+            self.exited = None
+
+    def error(self, message: str, macro: Optional[str] = None):
+        """Count an error."""
+        self.errors += 1
+        if macro is not None:
+            self.macro_errors[macro] = self.macro_errors.get(macro, 0) + 1
+        _append(self.messages, message)
+
+    def finish(self, result: str, eventtime: float):
+        """End the print."""
+        if self.exited is not None:
+            # Exited without being resumed
+            eventtime = self.exited
+            if self.shutdown:
+                result = "shutdown"
+            elif result == "running":
+                result = "paused"
+        self.result = result
+        self.end = max(eventtime, self.start)
+
+    def summary(self) -> Dict[str, Any]:
+        """Gets the summary of the print."""
+        start_seconds = None
+        extruders = [
+            step for step in self.heating if step["heater"].startswith("extruder")
+        ]
+        if extruders:
+            target = max(step["target"] for step in extruders)
+            ready = next(step for step in extruders if step["target"] == target)
+            start_seconds = round(ready["at"] + ready["seconds"], 1)
+        soak = sum(
+            length
+            for at, length in self.pauses
+            if start_seconds is not None and at < start_seconds
+        )
+        return {
+            "print": self.number,
+            "session": self.session,
+            "started": (
+                time.strftime(
+                    "%Y-%m-%d %H:%M:%S",
+                    time.localtime(self.wall + self.start),
+                )
+                if self.wall is not None
+                else None
+            ),
+            "result": self.result,
+            "seconds": round(self.end - self.start, 1),
+            "start_seconds": start_seconds,
+            "soak_seconds": round(soak, 1),
+            "heating": self.heating,
+            "pauses": len(self.pauses),
+            "paused_seconds": round(sum(length for _, length in self.pauses), 1),
+            "buffer_time_min": self.buffer_min,
+            "low_buffer_samples": self.low_buffer,
+            "print_stalls": int(self.stalls),
+            "sysload_max": self.sysload_max,
+            "memavail_min": self.memavail_min,
+            "mcus": {
+                name: {
+                    "awake_max": mcu["awake_max"],
+                    "task_avg_max": mcu["task_avg_max"],
+                    "retransmit_bytes": int(
+                        mcu.get("retransmit_last", 0.0) - mcu["retransmit_first"]
+                    ),
+                }
+                for name, mcu in self.mcus.items()
+            },
+            "errors": self.errors,
+            "macro_errors": self.macro_errors,
+            "messages": self.messages,
+            "shutdown": self.shutdown,
+            "events": self.events,
+        }
+
+
+class LogAnalyzer:
+    """Splits klippy.log files into print timelines."""
+
+    def __init__(self):
+        self.session = 0
+        self.prints = 0
+        self.eventtime = 0.0
+        # Wall time minus Klipper time of the current session
+        self.wall: Optional[float] = None
+        self.current: Optional[PrintTimeline] = None
+        self.last_error: Optional[str] = None
+
+    def analyze(self, path: str) -> Iterator[Dict[str, Any]]:
+        """
+        Scans a klippy.log file.
+
+        Args:
+            path: The log file.
+
+        Returns:
+            The summary of each print, as soon as it ends.
+        """
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    # Read ahead, and let the pages already scanned go
+                    data.madvise(mmap.MADV_SEQUENTIAL)
+                for match in MATCHER.finditer(data):
+                    summary = self._match(match)
+                    if summary is not None:
+                        yield summary
+
+    def close(self) -> Optional[Dict[str, Any]]:
+        """Gets the summary of the print still running at the end of the logs."""
+        return self._end("running")
+
+    def _end(self, result: str) -> Optional[Dict[str, Any]]:
+        """End the current print."""
+        if self.current is None:
+            return None
+        self.current.finish(result, self.eventtime)
+        summary = self.current.summary()
+        self.current = None
+        return summary
+
+    def _match(self, match: "re.Match") -> Optional[Dict[str, Any]]:
+        """Handle a matched line. Returns the summary of a print that ended."""
+        groups = match.groupdict()
+        current = self.current
+        if groups["stats"] is not None:
+            self.eventtime = float(groups["stats"])
+            self.last_error = None
+            if current is not None:
+                values = groups["values"].decode("utf-8", "replace")
+                current.stats(self.eventtime, parse_stats(values))
+            return None
+        if groups["wall"] is not None:
+            summary = self._end("restarted")
+            self.session += 1
+            self.eventtime = float(groups["mono"])
+            self.wall = float(groups["wall"]) - self.eventtime
+            return summary
+        if groups["sd"] is not None:
+            if groups["sd"] == b"Exiting":
+                if current is not None:
+                    current.exited = self.eventtime
+                return None
+            if groups["position"] != b"0" and current is not None:
+                current.resume(self.eventtime)
+                return None
+            summary = self._end("stopped")
+            self.prints += 1
+            self.current = PrintTimeline(
+                self.prints, self.session, self.eventtime, self.wall
+            )
+            return summary
+        if groups["finished"] is not None:
+            return self._end("complete")
+        if current is None:
+            return None
+        if groups["level"] is not None:
+            _append(
+                current.events,
+                {
+                    "at": round(self.eventtime - current.start, 1),
+                    "level": groups["level"].decode(),
+                    "title": groups["title"].decode("utf-8", "replace"),
+                    "message": groups["message"].decode("utf-8", "replace"),
+                },
+            )
+            return None
+        message = match.group(0).decode("utf-8", "replace").rstrip()
+        # Errors are logged again when they are reported to the console
+        if message == self.last_error:
+            return None
+        self.last_error = message
+        if groups["shutdown"] is not None:
+            current.shutdown = groups["shutdown"].decode("utf-8", "replace")
+        macro = groups["macro"]
+        current.error(message, macro.decode("utf-8", "replace") if macro else None)
+        return None
+
+
+def _duration(seconds: Optional[float]) -> str:
+    """Format a duration (Eg: 754 = '12m34s')."""
+    if seconds is None:
+        return "-"
+    minutes, secs = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m"
+    if minutes:
+        return f"{minutes}m{secs:02d}s"
+    return f"{secs}s"
+
+
+def print_summary(summary: Dict[str, Any], output: TextIO = sys.stdout):
+    """Print a print summary."""
+    color = {"complete": "32", "running": "36"}.get(summary["result"], "33")
+    start = _duration(summary["start_seconds"])
+    if summary["soak_seconds"]:
+        start += f" (soak {_duration(summary['soak_seconds'])})"
+    started = summary["started"] or "unknown time"
+    print(
+        f"\033[{color}mPrint {summary['print']} ({started}): {summary['result']}"
+        f" after {_duration(summary['seconds'])}, start {start}\033[0m",
+        file=output,
+    )
+    if summary["heating"]:
+        steps = ", ".join(
+            f"{step['heater']} {step['target']:g} in {_duration(step['seconds'])}"
+            for step in summary["heating"]
+        )
+        print(f"  Heating: {steps}", file=output)
+    if summary["pauses"]:
+        print(
+            f"  Paused: {summary['pauses']} time(s), "
+            f"{_duration(summary['paused_seconds'])}",
+            file=output,
+        )
+    buffer_min = summary["buffer_time_min"]
+    print(
+        f"  Buffer: min {'-' if buffer_min is None else f'{buffer_min:.2f}s'}, "
+        f"{summary['low_buffer_samples']} low sample(s), "
+        f"{summary['print_stalls']} stall(s), "
+        f"host load max {summary['sysload_max']:.2f}",
+        file=output,
+    )
+    for name, mcu in summary["mcus"].items():
+        print(
+            f"  MCU {name}: awake max {mcu['awake_max']:.3f}, "
+            f"task avg max {mcu['task_avg_max'] * 1000:.3f}ms, "
+            f"{mcu['retransmit_bytes']} bytes retransmitted",
+            file=output,
+        )
+    if summary["errors"]:
+        macros = ", ".join(
+            f"{name} x{count}" for name, count in summary["macro_errors"].items()
+        )
+        print(
+            f"\033[31m  Errors: {summary['errors']}"
+            f"{f' (macros: {macros})' if macros else ''}\033[0m",
+            file=output,
+        )
+        for message in summary["messages"]:
+            print(f"    {message}", file=output)
+    if summary["shutdown"]:
+        print(f"\033[31m  Shutdown: {summary['shutdown']}\033[0m", file=output)
+    for event in summary["events"]:
+        print(
+            f"  +{_duration(event['at'])} {event['level']}: "
+            f"{event['title']}: {event['message']}",
+            file=output,
+        )
+
+
+def main(argv: List[str]) -> int:
+    """Summarize the prints of klippy.log files."""
+    files: List[str] = []
+    as_json = False
+    output_path = None
+    args = argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == "--json":
+            as_json = True
+        elif arg == "--output" and args:
+            output_path = args.pop(0)
+        elif arg.startswith("--"):
+            print(
+                "Usage: python3 analyze_log.py [<klippy.log> ...] [--json] "
+                "[--output <file>]"
+            )
+            return 1
+        else:
+            files.append(arg)
+    analyzer = LogAnalyzer()
+    count = 0
+    output = None
+    try:
+        if output_path:
+            output = open(output_path, "w", encoding="utf-8")
+
+        def report(summary: Optional[Dict[str, Any]]):
+            nonlocal count
+            if summary is None:
+                return
+            count += 1
+            line = json.dumps(summary)
+            if output is not None:
+                output.write(line + "\n")
+            if as_json:
+                print(line)
+            else:
+                print_summary(summary)
+
+        for path in files or [KLIPPY_LOG]:
+            logger.info("Analyzing %s", path)
+            for summary in analyzer.analyze(path):
+                report(summary)
+        report(analyzer.close())
+    except OSError as err:
+        print(f"\033[31mError: {err}\033[0m")
+        logger.error("Log analysis failed: %s", err)
+        return 1
+    finally:
+        if output is not None:
+            output.close()
+    if not as_json:
+        print(f"{count} print(s) found.")
+    return 0
+
+
+def cmd_analyze(args: List[str]) -> bool:
+    """Run the analyzer from the printcfg CLI."""
+    return main(["analyze_log.py"] + args) == 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
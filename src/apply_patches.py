@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script applies version patches to the user config and user profile.
+# Every version between the '# Patch:' marker of each file and the latest
+# version in the profile's patch notes is applied in order, each file is
+# read and written once, and the marker is updated in the same write.
+#
+# Variable patches are not appended blindly to the user profile. When the
+# profile was deployed by sync_profile.py, the new variables.cfg is merged
+# three-way against the deployed copy in .printcfg_base (see
+# merge_variables.py), so user values are kept and deleted variables are
+# not added back. Otherwise only the variables the user profile does not
+# have yet are inserted.
+#
+# Usage:
+#   python3 apply_patches.py [--check] [<config_dir>] [<repo_dir>]
+#
+# Options:
+#   --check: Show the patches that would be applied without writing.
+#
+# Example:
+#   python3 apply_patches.py ~/printer_data/config ~/printcfg
+
+import os
+import sys
+from typing import List, NamedTuple, Optional, Tuple
+
+from klipper_config import parse_lines
+from log_setup import get_logger
+from merge_variables import merge_lines, new_variables
+from read_patch_notes import PatchEntry, load_index, version_key
+from search_replace import read_lines, write_lines_atomic
+from snapshots import take_snapshot
+from sync_profile import BASE_DIR, Manifest
+
+logger = get_logger("apply_patches")
+
+# Markers that identify profile name and version
+PROFILE_MARKER = "# Profile:"
+PATCH_MARKER = "# Patch:"
+# Marker after the user-editable variables of the user profile
+END_VARIABLES_MARKER = "End Custom Variables"
+# Section holding the printcfg variables
+VARIABLES_SECTION = "gcode_macro _printcfg"
+# Patch files of the user profile
+VARS_PATCH = "vars.patch"
+
+
+class PatchResult(NamedTuple):
+    """The outcome of patching a single file."""
+
+    file_name: str
+    profile: str
+    old_version: str
+    new_version: str
+    applied: List[str]
+    skipped: List[str]
+
+
+class PatchError(Exception):
+    """Raised when a file cannot be patched."""
+
+
+def find_marker(lines: List[str], marker: str) -> Tuple[int, str]:
+    """
+    Finds a marker line.
+
+    Returns:
+        The index of the line and the rest of the line after the marker.
+
+    Raises:
+        PatchError: If the marker is missing.
+    """
+    for index, line in enumerate(lines):
+        if line.startswith(marker):
+            return index, line[len(marker) :].strip()
+    raise PatchError(f"Marker not found: {marker}")
+
+
+def find_insert_point(lines: List[str]) -> int:
+    """
+    Finds where variable patches are inserted in the user profile:
+    before the end of custom variables marker, or failing that
+    before the gcode option of the printcfg variables section.
+    """
+    config = parse_lines(lines)
+    marker = config.marker(END_VARIABLES_MARKER)
+    if marker is not None:
+        return marker.line - 1
+    logger.warning("End of custom variables marker not found, using 'gcode:'")
+    section = config.section(VARIABLES_SECTION)
+    if section is not None and "gcode" in section.options:
+        return section.options["gcode"].start - 1
+    raise PatchError(f"Neither '# {END_VARIABLES_MARKER} #' nor 'gcode:' found")
+
+
+def merge_base(file_name: str, profile_dir: str, repo_dir: str) -> Optional[str]:
+    """
+    Finds the deployed copy of the profile variables of a user profile.
+
+    Returns:
+        The path of the copy in .printcfg_base, or None if the user profile
+        was not deployed from this profile by sync_profile.py.
+    """
+    config_dir = os.path.dirname(os.path.abspath(file_name))
+    target = os.path.basename(file_name)
+    base_path = os.path.join(config_dir, BASE_DIR, target)
+    source = os.path.relpath(os.path.join(profile_dir, "variables.cfg"), repo_dir)
+    deployed = Manifest(config_dir).files.get(target, {}).get("source")
+    if deployed != source or not os.path.isfile(base_path):
+        return None
+    return base_path
+
+
+def merge_variables(
+    lines: List[str], added: List[str], file_name: str, profile_dir: str, repo_dir: str
+) -> Tuple[List[str], Optional[str]]:
+    """
+    Applies variable patches to the lines of a user profile.
+
+    Args:
+        lines: The lines of the user profile.
+        added: The lines of the variable patches.
+        file_name: The user profile.
+        profile_dir: The profile directory in the repo.
+        repo_dir: The printcfg repo directory.
+
+    Returns:
+        The patched lines, and the deployed copy to update with the new
+        variables.cfg (None when there is none).
+
+    Raises:
+        PatchError: If the insert point is missing.
+    """
+    base_path = merge_base(file_name, profile_dir, repo_dir)
+    if base_path is not None:
+        new_lines = read_lines(os.path.join(profile_dir, "variables.cfg"))
+        result = merge_lines(read_lines(base_path), new_lines, lines)
+        for name in result.updated + result.added + result.removed:
+            logger.info("Merged %s into %s", name, file_name)
+        for conflict in result.conflicts:
+            logger.warning(
+                "Conflict in %s: %s (%s)", file_name, conflict.name, conflict.resolution
+            )
+        return result.lines, base_path
+    added = new_variables(added, lines)
+    if added:
+        insert_at = find_insert_point(lines)
+        lines[insert_at:insert_at] = added
+    return lines, None
+
+
+def pending_entries(entries: List[PatchEntry], current: str) -> List[PatchEntry]:
+    """Get the patch notes entries newer than the current version, oldest first."""
+    return [entry for entry in entries if entry.key > version_key(current)]
+
+
+def read_patch(path: str) -> List[str]:
+    """Read a patch file, making sure it ends with a newline."""
+    lines = read_lines(path)
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    return lines
+
+
+def patch_file(
+    file_name: str, patch_name: str, repo_dir: str, check: bool = False
+) -> PatchResult:
+    """
+    Applies every pending patch of a user file in one read and one write.
+
+    Args:
+        file_name: The user config or user profile to patch.
+        patch_name: The name of the patch files (config.patch or vars.patch).
+        repo_dir: The printcfg repo directory.
+        check: Only work out the patches without writing the file.
+
+    Returns:
+        The versions applied and skipped (no patch file for this file).
+
+    Raises:
+        PatchError: If a marker is missing.
+    """
+    lines = read_lines(file_name)
+    _, profile = find_marker(lines, PROFILE_MARKER)
+    _, current = find_marker(lines, PATCH_MARKER)
+    profile_dir = os.path.join(repo_dir, "profiles", profile)
+    entries = load_index(os.path.join(profile_dir, "patch_notes.txt"))
+    pending = pending_entries(entries, current)
+    applied: List[str] = []
+    skipped: List[str] = []
+    added: List[str] = []
+    for entry in pending:
+        if not entry.patches.get(patch_name):
+            skipped.append(entry.version)
+            continue
+        path = os.path.join(profile_dir, "patches", entry.version, patch_name)
+        logger.info("Applying %s to %s", path, file_name)
+        added.extend(read_patch(path))
+        added.append("\n")
+        applied.append(entry.version)
+    if not pending:
+        return PatchResult(file_name, profile, current, current, [], [])
+    new_version = pending[-1].version
+    base_path: Optional[str] = None
+    if added:
+        if patch_name == VARS_PATCH:
+            lines, base_path = merge_variables(
+                lines, added, file_name, profile_dir, repo_dir
+            )
+        else:
+            if lines and not lines[-1].endswith("\n"):
+                lines[-1] += "\n"
+            lines.extend(added)
+    # Update the version marker, keeping its spacing
+    patch_index, _ = find_marker(lines, PATCH_MARKER)
+    rest = lines[patch_index][len(PATCH_MARKER) :]
+    spacing = rest[: len(rest) - len(rest.lstrip())]
+    lines[patch_index] = f"{PATCH_MARKER}{spacing}{new_version}\n"
+    if not check:
+        write_lines_atomic(file_name, lines)
+        if base_path is not None:
+            # The merged variables are the base of the next merge
+            write_lines_atomic(
+                base_path, read_lines(os.path.join(profile_dir, "variables.cfg"))
+            )
+        logger.info("Patched %s from %s to %s", file_name, current, new_version)
+    return PatchResult(file_name, profile, current, new_version, applied, skipped)
+
+
+def main(argv: List[str]) -> int:
+    """Patch the user config and user profile."""
+    check = "--check" in argv
+    args = [arg for arg in argv[1:] if arg != "--check"]
+    home = os.path.expanduser("~")
+    config_dir = args[0] if args else f"{home}/printer_data/config"
+    repo_dir = args[1] if len(args) > 1 else f"{home}/printcfg"
+    targets = [
+        (os.path.join(config_dir, "user_config.cfg"), "config.patch", "User config"),
+        (os.path.join(config_dir, "user_profile.cfg"), VARS_PATCH, "User profile"),
+    ]
+    if not check:
+        take_snapshot("patch", "Before patching", config_dir)
+    results: List[Tuple[str, Optional[PatchResult]]] = []
+    for file_name, patch_name, label in targets:
+        print(f"Checking {label.lower()}...")
+        try:
+            result = patch_file(file_name, patch_name, repo_dir, check)
+        except (OSError, PatchError) as err:
+            print(f"\033[31m{label} could not be patched: {err}\033[0m")
+            logger.error("%s could not be patched: %s", file_name, err)
+            return 1
+        print(f"Profile: {result.profile}")
+        print(f"Version: {result.old_version}")
+        results.append((label, result))
+    print()
+    print("Summary:")
+    for label, result in results:
+        if result.old_version == result.new_version:
+            print(f"\033[32m{label} patch was not needed.\033[0m")
+        else:
+            verb = "would be" if check else "was successfully"
+            print(f"\033[32m{label} {verb} patched.\033[0m")
+            for version in result.applied:
+                print(f"  Applied: {version}")
+            for version in result.skipped:
+                print(f"  No patch needed: {version}")
+        print(f"Version: {result.new_version}")
+    print()
+    print("\033[32mPatching completed successfully.\033[0m")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script measures the startup time of the printcfg CLI.
+# Each run starts a fresh interpreter, like Moonraker and the
+# shell scripts do. Results are appended to a history file so
+# startup time can be tracked over time.
+#
+# The commands run with systemctl replaced by a stub (PRINTCFG_SYSTEMCTL)
+# and Moonraker pointed at a closed local port (PRINTCFG_MOONRAKER), so
+# 'status' measures the startup of printcfg rather than the latency of
+# the services.
+#
+# Usage:
+#   python3 bench_startup.py [runs] [command ...]
+#
+# Example:
+#   python3 bench_startup.py 20 help status
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+# Path to the printcfg CLI
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "printcfg.py")
+# Benchmark history file
+HISTORY_FILE = os.path.expanduser("~/printcfg/logs/startup_bench.jsonl")
+# Commands measured by default
+DEFAULT_COMMANDS = ["help", "status"]
+# Stand-ins for the services queried by the commands
+BENCH_ENV = {
+    # Reports every unit as loaded and running, ignoring its arguments
+    "PRINTCFG_SYSTEMCTL": (
+        "sh -c 'printf \"%s\\n\" LoadState=loaded ActiveState=active"
+        " SubState=running' systemctl"
+    ),
+    "PRINTCFG_MOONRAKER": "http://127.0.0.1:9",
+}
+
+
+def measure(command: str, runs: int) -> Dict[str, float]:
+    """
+    Measures the wall time of a printcfg command in fresh interpreters.
+
+    Args:
+        command: The printcfg subcommand to run.
+        runs: The number of runs.
+
+    Returns:
+        The min, median and max time in milliseconds.
+    """
+    times: List[float] = []
+    env = dict(os.environ, **BENCH_ENV)
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, SCRIPT, command],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env=env,
+            check=False,
+        )
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        "min": round(min(times), 2),
+        "median": round(statistics.median(times), 2),
+        "max": round(max(times), 2),
+    }
+
+
+def git_revision() -> Optional[str]:
+    """Get the current printcfg revision."""
+    result = subprocess.run(
+        ["git", "-C", os.path.dirname(SCRIPT), "rev-parse", "--short", "HEAD"],
+        capture_output=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode("utf-8").strip()
+
+
+def last_result(command: str) -> Optional[dict]:
+    """Get the previous result of a command from the history file."""
+    if not os.path.exists(HISTORY_FILE):
+        return None
+    previous = None
+    with open(HISTORY_FILE, "r", encoding="utf-8") as history:
+        for line in history:
+            entry = json.loads(line)
+            if entry.get("command") == command:
+                previous = entry
+    return previous
+
+
+def main(argv: List[str]) -> int:
+    """Run the startup benchmark."""
+    runs = 10
+    if len(argv) > 1 and argv[1].isdigit():
+        runs = int(argv.pop(1))
+    commands = argv[1:] or DEFAULT_COMMANDS
+    revision = git_revision()
+    os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
+    print(f"{'command':<10} {'min':>9} {'median':>9} {'max':>9} {'previous':>9}")
+    for command in commands:
+        previous = last_result(command)
+        result = measure(command, runs)
+        entry = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "revision": revision,
+            "command": command,
+            "runs": runs,
+            **result,
+        }
+        with open(HISTORY_FILE, "a", encoding="utf-8") as history:
+            history.write(json.dumps(entry) + "\n")
+        before = f"{previous['median']:.2f}" if previous else "-"
+        print(
+            f"{command:<10} {result['min']:>9.2f} {result['median']:>9.2f} "
+            f"{result['max']:>9.2f} {before:>9}"
+        )
+    print(f"Times in ms over {runs} runs. History: {HISTORY_FILE}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A persistent cache of parsed config files.
+
+Each parsed file is stored in ~/printcfg/cache/ in marshal
+format, keyed by its path, inode, mtime_ns and size. When
+the stat of a file changed but its content did not (Eg: after
+a git checkout), the SHA-256 of the content still matches and
+the entry is reused. Every hit touches its entry, and the
+least recently used entries are removed past CACHE_ENTRIES.
+
+Usage:
+    python3 config_cache.py <file> [--tree]
+    python3 config_cache.py --clear
+"""
+
+import hashlib
+import marshal
+import os
+import sys
+import time
+from typing import List, Optional
+
+from klipper_config import (
+    ConfigFile,
+    ConfigTree,
+    Include,
+    Marker,
+    Option,
+    Section,
+    parse_lines,
+    parse_tree,
+)
+from search_replace import write_temp
+
+# Cache directory
+CACHE_DIR = os.path.join(os.path.expanduser("~"), "printcfg", "cache")
+# Number of parsed files kept
+CACHE_ENTRIES = 64
+# Bump when the cached layout or the parser output changes
+CACHE_FORMAT = 1
+# Extension of the cache entries
+CACHE_SUFFIX = ".parsed"
+
+
+def _entry_path(path: str, cache_dir: str) -> str:
+    """Get the cache entry of a config file."""
+    name = hashlib.sha1(path.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{name}{CACHE_SUFFIX}")
+
+
+def _dump_sections(sections: List[Section]) -> list:
+    """Convert sections into plain data."""
+    return [
+        (
+            section.name,
+            section.start,
+            section.end,
+            section.file_name,
+            [
+                (o.name, o.value, o.comment, o.start, o.end)
+                for o in section.options.values()
+            ],
+        )
+        for section in sections
+    ]
+
+
+def _load_sections(data: list) -> List[Section]:
+    """Convert plain data back into sections."""
+    sections = []
+    for name, start, end, file_name, options in data:
+        section = Section(name, start, file_name)
+        section.end = end
+        for option_name, value, comment, option_start, option_end in options:
+            option = Option(option_name, value, option_start, comment)
+            option.end = option_end
+            section.options[option_name] = option
+        sections.append(section)
+    return sections
+
+
+def dump_config(config: ConfigFile) -> tuple:
+    """Convert a parsed file into plain data."""
+    return (
+        config.path,
+        config.line_count,
+        _dump_sections(config.sections),
+        [(include.pattern, include.line) for include in config.includes],
+        [(marker.key, marker.value, marker.line) for marker in config.markers],
+        _dump_sections(config.autosave),
+    )
+
+
+def load_config_data(data: tuple) -> ConfigFile:
+    """Convert plain data back into a parsed file."""
+    path, line_count, sections, includes, markers, autosave = data
+    config = ConfigFile(path)
+    config.line_count = line_count
+    config.sections = _load_sections(sections)
+    config.includes = [Include(pattern, line) for pattern, line in includes]
+    config.markers = [Marker(key, value, line) for key, value, line in markers]
+    config.autosave = _load_sections(autosave)
+    return config
+
+
+def _stat_key(stat: os.stat_result) -> tuple:
+    """Get the part of a file's stat that identifies its version."""
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _write_entry(entry_path: str, entry: tuple):
+    """Write a cache entry atomically."""
+    directory = os.path.dirname(entry_path)
+    os.makedirs(directory, exist_ok=True)
+    # A lost entry is only parsed again: no need to sync it
+    temp_name = write_temp(
+        directory,
+        os.path.basename(entry_path),
+        lambda file: file.write(marshal.dumps(entry)),
+        sync=False,
+    )
+    try:
+        os.replace(temp_name, entry_path)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+def _evict(cache_dir: str, keep: int = CACHE_ENTRIES):
+    """Remove the least recently used entries."""
+    with os.scandir(cache_dir) as entries:
+        cached = [
+            (entry.stat().st_mtime_ns, entry.path)
+            for entry in entries
+            if entry.name.endswith(CACHE_SUFFIX)
+        ]
+    cached.sort()
+    for _, entry_path in cached[: max(len(cached) - keep, 0)]:
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
+
+
+def load_config(path: str, cache_dir: Optional[str] = None) -> ConfigFile:
+    """
+    Parses a config file, or loads it from the cache when it did not change.
+
+    Args:
+        path: The config file.
+        cache_dir: The cache directory (default: ~/printcfg/cache).
+
+    Returns:
+        The parsed file.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    path = os.path.abspath(path)
+    entry_path = _entry_path(path, cache_dir)
+    stat_key = _stat_key(os.stat(path))
+    try:
+        with open(entry_path, "rb") as file:
+            entry = marshal.loads(file.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        entry = None
+    valid = (
+        isinstance(entry, tuple)
+        and len(entry) == 5
+        and entry[0] == CACHE_FORMAT
+        and entry[1] == path
+    )
+    if valid and entry[2] == stat_key:
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return load_config_data(entry[4])
+    with open(path, "rb") as file:
+        content = file.read()
+    digest = hashlib.sha256(content).hexdigest()
+    if valid and entry[3] == digest:
+        # Only the stat changed, the content is the same
+        data = entry[4]
+        config = load_config_data(data)
+    else:
+        config = parse_lines(content.decode("utf-8").splitlines(keepends=True), path)
+        data = dump_config(config)
+    try:
+        _write_entry(entry_path, (CACHE_FORMAT, path, stat_key, digest, data))
+        _evict(cache_dir)
+    except OSError:
+        pass
+    return config
+
+
+def load_tree(path: str, cache_dir: Optional[str] = None) -> ConfigTree:
+    """Parses a config file and its includes through the cache."""
+    return parse_tree(path, lambda file_name: load_config(file_name, cache_dir))
+
+
+def clear_cache(cache_dir: Optional[str] = None):
+    """Remove all cache entries."""
+    _evict(cache_dir or CACHE_DIR, keep=0)
+
+
+def main(argv: List[str]) -> int:
+    """Load a config file through the cache and show the timing."""
+    if argv[1:] == ["--clear"]:
+        if os.path.isdir(CACHE_DIR):
+            clear_cache()
+        print(f"Cleared {CACHE_DIR}")
+        return 0
+    if len(argv) < 2:
+        print("Usage: python3 config_cache.py <file> [--tree] | --clear")
+        return 1
+    start = time.perf_counter()
+    if "--tree" in argv:
+        files = load_tree(argv[1]).files
+    else:
+        files = [load_config(argv[1])]
+    elapsed = (time.perf_counter() - start) * 1000
+    sections = sum(len(config.sections) for config in files)
+    print(f"Loaded {len(files)} file(s), {sections} sections in {elapsed:.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A stand-in Moonraker server for tests.
+
+It serves the endpoints used by moonraker.py (server info, object
+queries, G-code scripts and restarts) over keep-alive HTTP, and object
+subscriptions over a websocket. The printer objects hold the _printcfg
+variables of a profile, and can be changed with update(), which also
+notifies the subscribers. The connections and requests are counted.
+
+Usage:
+    python3 fake_moonraker.py [--port <port>] [--state <print_state>]
+                              [--profile <variables.cfg>]
+
+Example:
+    python3 fake_moonraker.py --port 7126 --state printing &
+    PRINTCFG_MOONRAKER=http://127.0.0.1:7126 python3 moonraker.py idle
+"""
+
+import copy
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from moonraker import (
+    CLOSE,
+    PING,
+    PONG,
+    PRINTCFG_OBJECT,
+    TEXT,
+    read_frame,
+    send_frame,
+    websocket_accept,
+)
+
+# The profile whose variables are served by default
+DEFAULT_PROFILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "profiles",
+    "default",
+    "variables.cfg",
+)
+
+
+def default_objects(profile: Optional[str] = None) -> Dict[str, dict]:
+    """Get printer objects of an idle printer with the variables of a profile."""
+    from config_cache import load_config
+    from macro_graph import profile_variables
+
+    variables = profile_variables(load_config(profile or DEFAULT_PROFILE))
+    return {
+        "webhooks": {"state": "ready", "state_message": "Printer is ready"},
+        "print_stats": {"state": "standby", "filename": "", "print_duration": 0.0},
+        "idle_timeout": {"state": "Idle"},
+        "configfile": {"settings": {}},
+        PRINTCFG_OBJECT: variables,
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Serves one keep-alive connection."""
+
+    protocol_version = "HTTP/1.1"
+    server: "FakeMoonraker"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format: str, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _reply(self, status: int, data: Any):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method: str):
+        parts = urlsplit(self.path)
+        params = dict(parse_qsl(parts.query, keep_blank_values=True))
+        if self.headers.get("Content-Length"):
+            self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            self.server.requests.append((method, parts.path))
+        if method == "GET" and parts.path == "/websocket":
+            self._websocket()
+            return
+        try:
+            result = self.server.handle(method, parts.path, params)
+        except KeyError:
+            self._reply(404, {"error": {"code": 404, "message": "Not Found"}})
+        except ValueError as err:
+            self._reply(400, {"error": {"code": 400, "message": str(err)}})
+        else:
+            self._reply(200, {"result": result})
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._handle("GET")
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self._handle("POST")
+
+    def _websocket(self):
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", websocket_accept(key))
+        self.end_headers()
+        self.wfile.flush()
+        subscriber = _Subscriber(self.connection)
+        try:
+            while True:
+                opcode, payload = read_frame(self.rfile)
+                if opcode == CLOSE:
+                    break
+                if opcode == PING:
+                    subscriber.send(payload, PONG)
+                    continue
+                if opcode != TEXT:
+                    continue
+                request = json.loads(payload.decode("utf-8"))
+                response = self.server.handle_rpc(request, subscriber)
+                subscriber.send(json.dumps(response).encode("utf-8"))
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.server.lock:
+                if subscriber in self.server.subscribers:
+                    self.server.subscribers.remove(subscriber)
+            self.close_connection = True
+
+
+class _Subscriber:
+    """A websocket client subscribed to printer objects."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.objects: List[str] = []
+        self._lock = threading.Lock()
+
+    def send(self, payload: bytes, opcode: int = TEXT):
+        with self._lock:
+            send_frame(self.connection, payload, opcode, mask=False)
+
+
+class FakeMoonraker(ThreadingHTTPServer):
+    """A Moonraker stand-in serving in a thread."""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port: int = 0,
+        objects: Optional[Dict[str, dict]] = None,
+        klippy_state: str = "ready",
+    ):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.objects = objects if objects is not None else default_objects()
+        self.klippy_state = klippy_state
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests: List[Tuple[str, str]] = []
+        self.scripts: List[str] = []
+        self.restarts: List[str] = []
+        self.subscribers: List[_Subscriber] = []
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """The URL of the server."""
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "FakeMoonraker":
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the websockets."""
+        self.shutdown()
+        for subscriber in list(self.subscribers):
+            try:
+                send_frame(subscriber.connection, b"", CLOSE, mask=False)
+            except OSError:
+                pass
+        self.server_close()
+
+    def __enter__(self) -> "FakeMoonraker":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def update(self, changes: Dict[str, dict]):
+        """
+        Changes printer objects and notifies the subscribers.
+
+        Args:
+            changes: The changed fields of each object
+                     (Eg: {'print_stats': {'state': 'printing'}}).
+        """
+        with self.lock:
+            for name, fields in changes.items():
+                self.objects.setdefault(name, {}).update(fields)
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            status = {
+                name: fields
+                for name, fields in changes.items()
+                if name in subscriber.objects
+            }
+            if not status:
+                continue
+            notification = {
+                "jsonrpc": "2.0",
+                "method": "notify_status_update",
+                "params": [status, time.monotonic()],
+            }
+            try:
+                subscriber.send(json.dumps(notification).encode("utf-8"))
+            except OSError:
+                pass
+
+    def _status(self, names: List[str]) -> Dict[str, Any]:
+        """Get a copy of printer objects."""
+        with self.lock:
+            return {
+                name: copy.deepcopy(self.objects[name])
+                for name in names
+                if name in self.objects
+            }
+
+    def handle(self, method: str, path: str, params: Dict[str, str]) -> Any:
+        """
+        Answers an HTTP request.
+
+        Raises:
+            KeyError: For unknown endpoints.
+            ValueError: For invalid requests.
+        """
+        if method == "GET" and path == "/server/info":
+            return {
+                "klippy_connected": self.klippy_state != "disconnected",
+                "klippy_state": self.klippy_state,
+                "moonraker_version": "fake",
+            }
+        if method == "GET" and path == "/printer/info":
+            return {"state": self.klippy_state, "software_version": "fake"}
+        if method == "GET" and path == "/printer/objects/list":
+            with self.lock:
+                return {"objects": list(self.objects)}
+        if method == "GET" and path == "/printer/objects/query":
+            return {"eventtime": time.monotonic(), "status": self._status(list(params))}
+        if method == "POST" and path == "/printer/gcode/script":
+            if "script" not in params:
+                raise ValueError("No script given")
+            with self.lock:
+                self.scripts.append(params["script"])
+            return "ok"
+        if method == "POST" and path in (
+            "/printer/restart",
+            "/printer/firmware_restart",
+        ):
+            with self.lock:
+                self.restarts.append(path.rsplit("/", 1)[1])
+            return "ok"
+        raise KeyError(path)
+
+    def handle_rpc(self, request: dict, subscriber: _Subscriber) -> dict:
+        """Answers a websocket JSON-RPC request."""
+        response: Dict[str, Any] = {"jsonrpc": "2.0", "id": request.get("id")}
+        if request.get("method") == "printer.objects.subscribe":
+            objects = list(request.get("params", {}).get("objects", {}))
+            subscriber.objects = objects
+            with self.lock:
+                if subscriber not in self.subscribers:
+                    self.subscribers.append(subscriber)
+            response["result"] = {
+                "eventtime": time.monotonic(),
+                "status": self._status(objects),
+            }
+        else:
+            response["error"] = {"code": -32601, "message": "Method not found"}
+        return response
+
+
+def main(argv: List[str]) -> int:
+    """Run the stand-in server until interrupted."""
+    args = argv[1:]
+    port = 7125
+    state = "standby"
+    profile = None
+    try:
+        while args:
+            arg = args.pop(0)
+            if arg == "--port":
+                port = int(args.pop(0))
+            elif arg == "--state":
+                state = args.pop(0)
+            elif arg == "--profile":
+                profile = args.pop(0)
+            else:
+                raise ValueError(arg)
+    except (IndexError, ValueError) as err:
+        print(f"Error: Invalid argument {err}")
+        print(
+            "Usage: python3 fake_moonraker.py [--port <port>] [--state <state>] "
+            "[--profile <variables.cfg>]"
+        )
+        return 1
+    server = FakeMoonraker(port, default_objects(profile))
+    server.objects["print_stats"]["state"] = state
+    print(f"Fake Moonraker on {server.url} (print state: {state})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -16,15 +16,16 @@
 # You should have received a copy of the GNU General Public License
 # along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
 
-import datetime
-import getpass
+import json
 import logging
 import os
+import re
+import shlex
 import sys
+from typing import Dict, List, Optional, Tuple
+
+from log_setup import get_logger
 
-# Get the current user name
-CURRENT_USER = getpass.getuser()
-USER_HOME = os.path.expanduser("~")
 # Get the current script name
 SCRIPT_NAME = os.path.basename(__file__)
 
@@ -32,47 +33,23 @@ SCRIPT_NAME = os.path.basename(__file__)
 S_TEXT: str
 F_NAME: str
 
+# Patterns used to build the section/variable index
+SECTION_PATTERN = re.compile(r"^\[([^\]]+)\]")
+VARIABLE_PATTERN = re.compile(r"^(variable_\w+)\s*[:=]\s*(.*)$")
+INLINE_COMMENT_PATTERN = re.compile(r"\s[;#].*$")
+
 
 def show_help():
     """Show help message."""
     print(f"Usage: {SCRIPT_NAME} <search_text> <file_name>")
+    print(
+        f"       {SCRIPT_NAME} --batch <file_name> <key> [<key> ...]"
+        " [--file <file_name> <key> ...] [--json|--shell]"
+    )
     sys.exit(1)
 
 
-if len(sys.argv) < 3:
-    print("Not enough arguments.")
-    show_help()
-    sys.exit(1)
-else:
-    S_TEXT = sys.argv[1]
-    F_NAME = sys.argv[2]
-
-logger: logging.Logger = logging.getLogger(__name__)
-
-# Set the logfile
-logfile = f"{USER_HOME}/printcfg/logs/find_string.log"
-
-# Check the date of the first log entry
-# If it is older than 30 days, delete the logfile
-if os.path.exists(logfile):
-    with open(logfile, "r", encoding="utf-8") as file:
-        first_line = file.readline()
-        if first_line:
-            first_line = first_line.split(" - ")[0]
-            first_date = datetime.datetime.strptime(first_line, "%Y-%m-%d %H:%M:%S,%f")
-            thirty_days_ago = datetime.datetime.now() - datetime.timedelta(days=30)
-            if first_date < thirty_days_ago:
-                os.remove(logfile)
-
-# Set the logging level
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-handler = logging.FileHandler(logfile)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-
-# Log start of script
-logger.info("Starting script: %s", __file__)
+logger: logging.Logger = get_logger("find_string")
 
 
 def check_file(file_name: str) -> bool:
@@ -158,27 +135,198 @@ def string_exists(search_text: str, file_name: str) -> bool:
     return False
 
 
+def build_index(
+    file_name: str, patterns: Optional[List[str]] = None
+) -> Tuple[Dict[str, Dict[str, Tuple[str, int]]], Dict[str, Tuple[str, int]]]:
+    """Index a config file and search it for patterns in a single pass.
+
+    Arguments:
+        file_name: The name of the file to index.
+        patterns: Literal texts to search for while indexing.
+
+    Returns:
+        A tuple of the section index and the pattern matches.
+        The section index maps each [section] to its variable_* options
+        and their (value, line number). The pattern matches map each
+        pattern to the (rest of line, line number) of its first match.
+    """
+    index: Dict[str, Dict[str, Tuple[str, int]]] = {}
+    matches: Dict[str, Tuple[str, int]] = {}
+    pending = list(dict.fromkeys(patterns or []))
+    section = ""
+    with open(file_name, "r", encoding="utf-8") as sfile:
+        for line_no, line in enumerate(sfile, start=1):
+            line = line.rstrip("\n")
+            # Check the literal patterns that have not matched yet
+            if pending:
+                for pattern in pending:
+                    if pattern in line:
+                        matches[pattern] = (line.split(pattern, 1)[1].strip(), line_no)
+                pending = [pattern for pattern in pending if pattern not in matches]
+            # Track the current section
+            section_match = SECTION_PATTERN.match(line)
+            if section_match:
+                section = section_match.group(1).strip()
+                index.setdefault(section, {})
+                continue
+            # Index the variable options
+            variable_match = VARIABLE_PATTERN.match(line)
+            if variable_match:
+                value = INLINE_COMMENT_PATTERN.sub("", variable_match.group(2)).strip()
+                index.setdefault(section, {}).setdefault(
+                    variable_match.group(1), (value, line_no)
+                )
+    logger.info("Indexed %s sections in %s", len(index), file_name)
+    return index, matches
+
+
+def batch_lookup(keys: List[str], file_name: str) -> Dict[str, Optional[dict]]:
+    """Look up several keys in a file with a single read.
+
+    A key may be a variable name (variable_version), a variable
+    scoped to a section (gcode_macro _printcfg/variable_version)
+    or any other literal text, which returns the rest of the line
+    like find_string() does.
+
+    Arguments:
+        keys: The keys to look up.
+        file_name: The name of the file to search.
+
+    Returns:
+        A dict mapping each key to its value, line and section,
+        or to None if the key was not found.
+    """
+    if not check_file(file_name):
+        return {key: None for key in keys}
+    patterns = [key for key in keys if not _is_variable_key(key)]
+    index, matches = build_index(file_name, patterns)
+    results: Dict[str, Optional[dict]] = {}
+    for key in keys:
+        results[key] = None
+        if key in matches:
+            value, line_no = matches[key]
+            results[key] = {"value": value, "line": line_no, "section": None}
+            continue
+        section_name, _, variable = key.rpartition("/")
+        for section, variables in index.items():
+            if section_name and section != section_name:
+                continue
+            if variable in variables:
+                value, line_no = variables[variable]
+                results[key] = {"value": value, "line": line_no, "section": section}
+                break
+        if results[key] is None:
+            logger.error("Search text not found: %s", key)
+    return results
+
+
+def _is_variable_key(key: str) -> bool:
+    """Check whether a key refers to an indexed variable."""
+    return re.match(r"^variable_\w+$", key.rpartition("/")[2]) is not None
+
+
+def shell_name(key: str) -> str:
+    """Convert a lookup key into a shell variable name."""
+    name = re.sub(r"\W+", "_", key.rpartition("/")[2]).strip("_").lower()
+    if not name or name[0].isdigit():
+        name = f"key_{name}"
+    return name
+
+
+def batch_main(args: List[str]) -> int:
+    """Run a batch lookup from the command line.
+
+    Arguments:
+        args: The file name followed by the keys and output options.
+              A key may be prefixed with 'name=' to choose the
+              shell variable name it is printed as. '--file <file_name>'
+              switches the file of the keys that follow it.
+
+    Returns:
+        The exit code.
+    """
+    output = "json"
+    if args and args[-1] in ("--json", "--shell"):
+        output = args.pop()[2:]
+    if len(args) < 2:
+        print("Not enough arguments.")
+        show_help()
+    # The keys of each file, as (key, shell name) pairs
+    lookups: Dict[str, List[Tuple[str, str]]] = {args[0]: []}
+    file_name = args[0]
+    pending = args[1:]
+    while pending:
+        arg = pending.pop(0)
+        if arg == "--file":
+            if not pending:
+                print("Missing file name after --file.")
+                show_help()
+            file_name = pending.pop(0)
+            lookups.setdefault(file_name, [])
+            continue
+        alias = re.match(r"^([A-Za-z_]\w*)=(.+)$", arg)
+        if alias:
+            lookups[file_name].append((alias.group(2), alias.group(1)))
+        else:
+            lookups[file_name].append((arg, shell_name(arg)))
+    results = {
+        name: batch_lookup([key for key, _ in pairs], name)
+        for name, pairs in lookups.items()
+    }
+    if output == "json":
+        # A single file keeps the flat key: result layout
+        print(json.dumps(results if len(results) > 1 else results[args[0]], indent=2))
+        return 0
+    for name, pairs in lookups.items():
+        for key, variable in pairs:
+            result = results[name][key]
+            # The flag tells a missing key from an empty value
+            print(f"{variable}={shlex.quote(result['value'] if result else '')}")
+            print(f"{variable}_found={1 if result else 0}")
+    return 0
+
+
 # Check if the script was run from the command line
 if __name__ == "__main__":
+    import getpass
+
+    # Log start of script
+    logger.info("Starting script: %s", __file__)
     # Log the current user
-    logger.info("Current user: %s", CURRENT_USER)
+    logger.info("Current user: %s", getpass.getuser())
     # Log arguments
     logger.info("Arguments: %s", sys.argv)
     # Check for help argument
-    if len(sys.argv) == 2 and sys.argv[1] == "--help" or sys.argv[1] == "-h":
+    if len(sys.argv) == 2 and sys.argv[1] in ("--help", "-h"):
         print(f"Usage: {SCRIPT_NAME} <search_text> <file_name> [options]")
         print("Search for a string in a file.")
         print(f"Example: {SCRIPT_NAME} 'hello world' hello.txt")
         print("Options:")
         print("  --exists, -e  Search for the string and return True or False.")
         print("  --help, -h   Show this help message and exit.")
+        print(f"Batch usage: {SCRIPT_NAME} --batch <file_name> <key> [<key> ...]")
+        print("Look up many keys with a single read of the file.")
+        print(f"Example: {SCRIPT_NAME} --batch user_profile.cfg variable_version")
+        print("Batch options:")
+        print("  --json       Print the results as JSON (default).")
+        print("  --shell      Print the results as shell assignments for eval,")
+        print("               with <name>_found=0 or 1 for each key.")
+        print("  --file <file_name>  Look up the keys that follow in another file.")
         exit(0)
+    if len(sys.argv) < 3:
+        print("Not enough arguments.")
+        show_help()
+    if sys.argv[1] in ("--batch", "-b"):
+        # Look up all of the keys in one pass
+        sys.exit(batch_main(sys.argv[2:]))
+    S_TEXT = sys.argv[1]
+    F_NAME = sys.argv[2]
     if len(sys.argv) == 3:
         # Call the find_string function
         result = find_string(S_TEXT, F_NAME)
         # Return the result
         print(result)
-    elif len(sys.argv) == 4 and sys.argv[3] == "--exists" or sys.argv[3] == "-e":
+    elif len(sys.argv) == 4 and sys.argv[3] in ("--exists", "-e"):
         # Call the find_string function
         if string_exists(S_TEXT, F_NAME):
             exists = "True"
@@ -192,9 +340,3 @@ if __name__ == "__main__":
         show_help()
         # Exit with an error code
         exit(1)
-else:
-    # Print an error message
-    print("This script must be run from the command line.")
-    show_help()
-    # Exit with an error code
-    sys.exit(1)
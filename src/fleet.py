@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script runs a printcfg command on every Klipper instance of the host.
+# Instances are the ~/printer_data and ~/printer_*_data directories. Each
+# instance runs 'printcfg <command>' in its own process with PRINTCFG_DATA
+# pointing at it, a bounded number at a time, and its output is written
+# to a log file per instance. A summary table is printed at the end.
+#
+# The printcfg repo is shared by all instances, so 'update' updates it with
+# the first instance alone and then updates the other instances in parallel.
+# If the first update fails the other instances are skipped, since each of
+# them would update the shared repo again at the same time.
+#
+# Usage:
+#   printcfg --all [--jobs N] <status|update|repair>
+#
+# Example:
+#   printcfg --all --jobs 4 update
+
+import glob
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+
+from log_setup import LOG_DIR, get_logger
+
+logger = get_logger("fleet")
+
+# Commands that can be run on all instances
+FLEET_COMMANDS = ("status", "update", "repair")
+# Commands that update the shared printcfg repo
+REPO_COMMANDS = ("update",)
+# Default number of instances handled at once
+DEFAULT_JOBS = 4
+# Path to the printcfg CLI
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "printcfg.py")
+
+
+class InstanceResult(NamedTuple):
+    """The outcome of a command on one instance."""
+
+    name: str
+    path: str
+    returncode: int
+    seconds: float
+    log_file: str
+    skipped: bool = False
+
+
+def instance_name(path: str) -> str:
+    """Get the name of an instance (Eg: '~/printer_2_data' = 'printer_2')."""
+    name = os.path.basename(os.path.normpath(path))
+    return name[: -len("_data")] if name.endswith("_data") else name
+
+
+def _natural_key(path: str) -> list:
+    """Sort printer_10_data after printer_9_data."""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", path)]
+
+
+def discover_instances(home: Optional[str] = None) -> List[str]:
+    """
+    Finds the Klipper instances of the host.
+
+    Args:
+        home: The home directory to search (default: the user's home).
+
+    Returns:
+        The printer_data directories that have a config directory,
+        the default ~/printer_data first.
+    """
+    home = home or os.path.expanduser("~")
+    paths = [os.path.join(home, "printer_data")]
+    paths += sorted(glob.glob(os.path.join(home, "printer_*_data")), key=_natural_key)
+    return [path for path in paths if os.path.isdir(os.path.join(path, "config"))]
+
+
+def run_instance(
+    command: str, path: str, log_dir: str, extra_env: Optional[Dict[str, str]] = None
+) -> InstanceResult:
+    """
+    Runs a printcfg command for one instance.
+
+    Args:
+        command: The printcfg command.
+        path: The printer_data directory of the instance.
+        log_dir: The directory of the instance logs.
+        extra_env: Additional environment variables.
+
+    Returns:
+        The outcome of the command.
+    """
+    name = instance_name(path)
+    log_file = os.path.join(log_dir, f"{name}-{command}.log")
+    env = dict(os.environ, PRINTCFG_DATA=path, PRINTCFG_INSTANCE=name)
+    env.update(extra_env or {})
+    logger.info("Running %s on %s", command, path)
+    start = time.perf_counter()
+    with open(log_file, "w", encoding="utf-8") as log:
+        try:
+            returncode = subprocess.run(
+                [sys.executable, SCRIPT, command],
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                env=env,
+                check=False,
+            ).returncode
+        except OSError as err:
+            log.write(f"Error: {err}\n")
+            returncode = 1
+    seconds = time.perf_counter() - start
+    logger.info("%s on %s finished with code %s", command, path, returncode)
+    return InstanceResult(name, path, returncode, seconds, log_file)
+
+
+def run_fleet(
+    command: str,
+    instances: List[str],
+    jobs: int = DEFAULT_JOBS,
+    log_dir: Optional[str] = None,
+) -> List[InstanceResult]:
+    """
+    Runs a printcfg command on several instances in parallel.
+
+    Args:
+        command: The printcfg command.
+        instances: The printer_data directories of the instances.
+        jobs: The number of instances handled at once.
+        log_dir: The directory of the instance logs (default: logs/fleet).
+
+    Returns:
+        The outcome of each instance, in the order of instances.
+    """
+    log_dir = log_dir or os.path.join(LOG_DIR, "fleet")
+    os.makedirs(log_dir, exist_ok=True)
+    results: List[InstanceResult] = []
+    extra_env: Dict[str, str] = {}
+    pending = list(instances)
+    if command in REPO_COMMANDS and pending:
+        # Update the shared repo once before the instances run in parallel
+        first = run_instance(command, pending.pop(0), log_dir)
+        results.append(first)
+        if first.returncode != 0:
+            logger.error(
+                "%s failed on %s, skipping %s instance(s)",
+                command,
+                first.path,
+                len(pending),
+            )
+            results += [
+                InstanceResult(instance_name(path), path, 1, 0.0, "", skipped=True)
+                for path in pending
+            ]
+            return results
+        extra_env["PRINTCFG_REPO_UPDATED"] = "1"
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        results += pool.map(
+            lambda path: run_instance(command, path, log_dir, extra_env), pending
+        )
+    return results
+
+
+def print_summary(command: str, results: List[InstanceResult]):
+    """Print the summary table of a fleet run."""
+    width = max([len("instance")] + [len(result.name) for result in results])
+    print()
+    print(f"Summary of '{command}':")
+    print(f"{'instance':<{width}}  {'result':<7}  {'time':>7}  log")
+    for result in results:
+        if result.skipped:
+            status = "\033[33mskipped\033[0m"
+        elif result.returncode == 0:
+            status = "\033[32mok     \033[0m"
+        else:
+            status = f"\033[31m{'failed':<7}\033[0m"
+        print(
+            f"{result.name:<{width}}  {status}  {result.seconds:>6.1f}s  "
+            f"{result.log_file}"
+        )
+
+
+def main(args: List[str]):
+    """Run a printcfg command on all instances."""
+    jobs = DEFAULT_JOBS
+    if len(args) > 2 and args[0] == "--jobs" and args[1].isdigit():
+        jobs = int(args[1])
+        args = args[2:]
+    if len(args) != 1 or args[0] not in FLEET_COMMANDS:
+        print(f"Usage: printcfg --all [--jobs N] <{'|'.join(FLEET_COMMANDS)}>")
+        sys.exit(1)
+    command = args[0]
+    instances = discover_instances()
+    if not instances:
+        print("Error: No printer_data directories found.")
+        logger.error("No printer_data directories found.")
+        sys.exit(1)
+    print(f"Running '{command}' on {len(instances)} instance(s), {jobs} at a time...")
+    for path in instances:
+        print(f"  {instance_name(path)}: {path}")
+    results = run_fleet(command, instances, jobs)
+    print_summary(command, results)
+    failed = [result for result in results if result.returncode != 0]
+    skipped = [result for result in failed if result.skipped]
+    logger.info(
+        "%s finished on %s instance(s), %s failed, %s skipped",
+        command,
+        len(results),
+        len(failed) - len(skipped),
+        len(skipped),
+    )
+    sys.exit(1 if failed else 0)
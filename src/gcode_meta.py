@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script checks G-code files against the printcfg profile before
+# they are printed.
+#
+# Only the head and the tail of each file are read (memory-mapped), for
+# the slicer metadata (temperatures, filament type, nozzle, estimated time)
+# and the START_PRINT / SET_START_PRINT call. The metadata is cached in
+# ~/printcfg/cache/gcode_meta.json, keyed by the size and a hash of the
+# first and last HASH_SIZE bytes, and found from the path, size and mtime,
+# so a file is only read again when it changed (a renamed or copied file
+# is found by its hash).
+#
+# The start call is checked against the macros of print_macros.cfg and
+# the _printcfg variables of the user profile:
+#
+#   - The file calls START_PRINT (or the macro given by --start-macro).
+#   - The parameters are used by the macro they are passed to.
+#   - The temperatures used (parameter or profile default) match the
+#     first layer temperatures of the slicer.
+#   - The nozzle diameter matches the profile (variable_nozzle_diameter).
+#   - A chamber temperature is set in the slicer only if the profile has a
+#     chamber.
+#
+# Usage:
+#   python3 gcode_meta.py [<file.gcode|directory> ...] [--json] [--no-cache]
+#                         [--profile <file>] [--start-macro <macro>] [--live]
+#
+# With --live, the variables loaded by Klipper are read from Moonraker
+# instead of the profile file.
+#
+# Example:
+#   python3 gcode_meta.py ~/printer_data/gcodes/benchy.gcode
+
+import hashlib
+import json
+import mmap
+import os
+import re
+import sys
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from config_cache import load_config
+from log_setup import get_logger
+from macro_graph import CONFIG_DIR, REPO_DIR, profile_variables
+from search_replace import write_lines_atomic
+
+logger = get_logger("gcode_meta")
+
+# File content: memory-mapped, or bytes for empty files (they cannot be mapped)
+Buffer = Union[bytes, mmap.mmap]
+
+# The G-code directory of the instance
+GCODE_DIR = os.path.join(os.path.dirname(CONFIG_DIR), "gcodes")
+# The metadata cache
+CACHE_FILE = os.path.join(
+    os.path.expanduser("~"), "printcfg", "cache", "gcode_meta.json"
+)
+# Bump when the cached metadata changes
+CACHE_FORMAT = 1
+# Number of files kept in the cache
+CACHE_ENTRIES = 256
+# Bytes hashed at each end of a file for its cache key
+HASH_SIZE = 64 * 1024
+# Bytes searched for the start call (thumbnails come before it)
+HEAD_LIMIT = 1024 * 1024
+# Bytes read at the head when there is no start call
+HEAD_SIZE = 64 * 1024
+# Bytes read at the tail (slicer config blocks and estimates)
+TAIL_SIZE = 256 * 1024
+# The start macro of printcfg, and the start macros looked for
+START_MACRO = "START_PRINT"
+START_MACROS = ("SET_START_PRINT", "START_PRINT", "PRINT_START")
+# Degrees a start temperature may differ from the slicer
+TEMP_TOLERANCE = 1.0
+
+# Slicer setting names, by metadata field, in order of preference
+METADATA_KEYS = {
+    "extruder_temp": (
+        "first_layer_temperature",
+        "nozzle_temperature_initial_layer",
+        "temperature",
+        "nozzle_temperature",
+        "EXTRUDER_TRAIN.0.INITIAL_TEMPERATURE",
+    ),
+    "bed_temp": (
+        "first_layer_bed_temperature",
+        "bed_temperature_initial_layer_single",
+        "hot_plate_temp_initial_layer",
+        "bed_temperature",
+        "hot_plate_temp",
+        "BUILD_PLATE.INITIAL_TEMPERATURE",
+    ),
+    "chamber_temp": ("chamber_temperature", "BUILD_VOLUME.TEMPERATURE"),
+    "filament_type": ("filament_type", "EXTRUDER_TRAIN.0.MATERIAL.NAME"),
+    "nozzle_diameter": ("nozzle_diameter", "EXTRUDER_TRAIN.0.NOZZLE.DIAMETER"),
+    "estimated_time": (
+        "estimated printing time (normal mode)",
+        "estimated printing time",
+        "model printing time",
+        "TIME",
+    ),
+    "layer_height": ("layer_height", "Layer height"),
+    "filament_used_g": ("total filament used [g]", "filament used [g]"),
+}
+NUMERIC_FIELDS = ("extruder_temp", "bed_temp", "chamber_temp", "nozzle_diameter")
+NUMERIC_FIELDS += ("layer_height", "filament_used_g")
+
+# '; key = value' (PrusaSlicer, SuperSlicer, OrcaSlicer) or ';KEY:value' (Cura)
+SETTING = re.compile(
+    rb"^;\s*([A-Za-z][\w .\[\]()-]{0,60}?)\s*[=:]\s*(.*?)\s*$", re.MULTILINE
+)
+GENERATOR = re.compile(rb"^;\s*(?:generated by|Generated with)\s+(\S+)", re.I | re.M)
+START_CALL = re.compile(
+    rb"^[ \t]*(" + b"|".join(name.encode() for name in START_MACROS) + rb")\b(.*)$",
+    re.I | re.M,
+)
+HEATER_COMMAND = re.compile(rb"^M(104|109|140|190)\s+S([\d.]+)", re.M)
+ARGUMENT = re.compile(r"(\w+)=(\"[^\"]*\"|'[^']*'|\S+)")
+DURATION = re.compile(r"(\d+)\s*([dhms])")
+PARAMETER = re.compile(r"\bparams\.(\w+)")
+ALIAS = re.compile(r"^\s*(\w+)\s*{\s*rawparams\s*}\s*$")
+PARAMETER_DEFAULT = re.compile(
+    r"\bparams\.(\w+)\s*\|\s*default\s*\(\s*printcfg\.(\w+)\s*\)"
+)
+
+
+def _first(value: str) -> str:
+    """Get the value of the first extruder of a list (Eg: '240,240' = '240')."""
+    return re.split(r"[,;]", value, maxsplit=1)[0].strip().strip("\"'")
+
+
+def parse_duration(value: str) -> Optional[int]:
+    """Get the seconds of a slicer estimate (Eg: '1h 2m 3s' or '3723')."""
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parts = DURATION.findall(value)
+    if not parts:
+        return None
+    scale = {"d": 86400, "h": 3600, "m": 60, "s": 1}
+    return sum(int(number) * scale[unit] for number, unit in parts)
+
+
+def _settings(data: Buffer, start: int, end: int) -> Dict[str, str]:
+    """Get the slicer settings of a part of a file."""
+    settings: Dict[str, str] = {}
+    for match in SETTING.finditer(data, start, end):
+        key = match.group(1).decode("utf-8", "replace").strip()
+        settings.setdefault(key, match.group(2).decode("utf-8", "replace"))
+    return settings
+
+
+def extract(data: Buffer) -> Dict[str, Any]:
+    """
+    Gets the metadata of a memory-mapped G-code file.
+
+    Args:
+        data: The file.
+
+    Returns:
+        The slicer, the metadata fields and the start calls.
+    """
+    size = len(data)
+    calls: List[Dict[str, Any]] = []
+    head_end = min(size, HEAD_SIZE)
+    position = 0
+    while True:
+        match = START_CALL.search(data, position, min(size, HEAD_LIMIT))
+        if not match:
+            break
+        arguments = match.group(2).decode("utf-8", "replace").split(";")[0]
+        calls.append(
+            {
+                "macro": match.group(1).decode().upper(),
+                "params": {
+                    name.upper(): value.strip("\"'")
+                    for name, value in ARGUMENT.findall(arguments)
+                },
+                "line": data[: match.start()].count(b"\n") + 1,
+            }
+        )
+        head_end = max(head_end, match.end())
+        position = match.end()
+        if match.group(1).upper() != b"SET_START_PRINT":
+            # The start macro is called last
+            break
+    tail_start = max(head_end, size - TAIL_SIZE)
+    settings = _settings(data, tail_start, size)
+    for key, value in _settings(data, 0, head_end).items():
+        settings.setdefault(key, value)
+    generator = GENERATOR.search(data, 0, min(size, HEAD_SIZE))
+    metadata: Dict[str, Any] = {
+        "slicer": generator.group(1).decode("utf-8", "replace") if generator else None,
+        "calls": calls,
+    }
+    for field, keys in METADATA_KEYS.items():
+        value = next((settings[key] for key in keys if key in settings), None)
+        if value is not None and field != "estimated_time":
+            value = _first(value)
+        if value is not None and field == "estimated_time":
+            value = parse_duration(value)
+        elif value is not None and field in NUMERIC_FIELDS:
+            try:
+                value = float(value)
+            except ValueError:
+                value = None
+        metadata[field] = value
+    # Slicers without settings: the first heater commands
+    for command, temp in HEATER_COMMAND.findall(data, 0, head_end):
+        field = "bed_temp" if command in (b"140", b"190") else "extruder_temp"
+        if metadata[field] is None:
+            metadata[field] = float(temp)
+    return metadata
+
+
+def _cache_key(data: Buffer) -> str:
+    """Get the cache key of a file: its size and a hash of both ends."""
+    digest = hashlib.sha256(data[:HASH_SIZE])
+    digest.update(data[-HASH_SIZE:])
+    return f"{len(data)}:{digest.hexdigest()}"
+
+
+class MetadataCache:
+    """The metadata of the G-code files already read."""
+
+    def __init__(self, path: str = CACHE_FILE):
+        self.path = path
+        self.changed = False
+        self.files: Dict[str, list] = {}
+        self.metadata: Dict[str, dict] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                cache = json.load(file)
+            if cache.get("format") == CACHE_FORMAT:
+                self.files = cache["files"]
+                self.metadata = cache["metadata"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def get(self, path: str) -> Tuple[Dict[str, Any], bool]:
+        """
+        Gets the metadata of a G-code file, from the cache when it did not change.
+
+        Args:
+            path: The G-code file.
+
+        Returns:
+            The metadata, and whether it was cached.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.files.get(path)
+        if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            if known[2] in self.metadata:
+                return self._hit(known[2]), True
+        with open(path, "rb") as file:
+            if stat.st_size == 0:
+                data: Buffer = b""
+            else:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                key = _cache_key(data)
+                cached = key in self.metadata
+                metadata = self._hit(key) if cached else extract(data)
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+        self.metadata[key] = metadata
+        self.files[path] = [stat.st_size, stat.st_mtime_ns, key]
+        self.changed = True
+        return metadata, cached
+
+    def _hit(self, key: str) -> Dict[str, Any]:
+        """Get cached metadata, keeping it as the most recently used."""
+        metadata = self.metadata.pop(key)
+        self.metadata[key] = metadata
+        return metadata
+
+    def save(self):
+        """Write the cache, without the least recently used files."""
+        if not self.changed:
+            return
+        for key in list(self.metadata)[: max(len(self.metadata) - CACHE_ENTRIES, 0)]:
+            del self.metadata[key]
+        self.files = {
+            path: known
+            for path, known in self.files.items()
+            if known[2] in self.metadata
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        cache = {"format": CACHE_FORMAT, "files": self.files, "metadata": self.metadata}
+        write_lines_atomic(self.path, [json.dumps(cache)])
+        self.changed = False
+
+
+def macro_parameters(
+    macro_files: List[str],
+) -> Tuple[Dict[str, Dict[str, Optional[str]]], Dict[str, str]]:
+    """
+    Gets the parameters of the printcfg macros.
+
+    Args:
+        macro_files: The macro files.
+
+    Returns:
+        The parameters of each macro, with the _printcfg variable they
+        default to (Eg: {'SET_START_PRINT': {'BED_TEMP': 'bed_temp'}}),
+        and the aliases (Eg: {'PRINT_START': 'START_PRINT'}).
+    """
+    macros: Dict[str, Dict[str, Optional[str]]] = {}
+    aliases: Dict[str, str] = {}
+    for macro_file in macro_files:
+        for section in load_config(macro_file).sections:
+            kind, _, name = section.name.partition(" ")
+            if kind != "gcode_macro" or "gcode" not in section.options:
+                continue
+            template = section.options["gcode"].value
+            alias = ALIAS.match(template)
+            if alias:
+                aliases[name.upper()] = alias.group(1).upper()
+            parameters: Dict[str, Optional[str]] = {
+                parameter.upper(): None for parameter in PARAMETER.findall(template)
+            }
+            for parameter, variable in PARAMETER_DEFAULT.findall(template):
+                parameters[parameter.upper()] = variable
+            macros[name.upper()] = parameters
+    for alias, target in aliases.items():
+        macros[alias] = macros.get(target, {})
+    return macros, aliases
+
+
+def check(
+    metadata: Dict[str, Any],
+    variables: Dict[str, Any],
+    macros: Dict[str, Dict[str, Optional[str]]],
+    aliases: Dict[str, str],
+    start_macro: str = START_MACRO,
+) -> List[Tuple[str, str]]:
+    """
+    Checks the metadata of a G-code file against the profile.
+
+    Args:
+        metadata: The metadata of the file.
+        variables: The _printcfg variables of the profile.
+        macros: The parameters of the printcfg macros.
+        aliases: The macros calling another macro with their parameters.
+        start_macro: The macro that must be called.
+
+    Returns:
+        The problems found ('error' or 'warning', message).
+    """
+    problems: List[Tuple[str, str]] = []
+    called = [aliases.get(call["macro"], call["macro"]) for call in metadata["calls"]]
+    if start_macro not in called:
+        problems.append(("error", f"{start_macro} is not called"))
+    # Values used by the print: the parameters, or the profile defaults
+    used = dict(variables)
+    for call in metadata["calls"]:
+        parameters = macros.get(call["macro"])
+        if parameters is None:
+            problems.append(("warning", f"{call['macro']} is not a printcfg macro"))
+            continue
+        for name, value in call["params"].items():
+            if name not in parameters:
+                problems.append(
+                    (
+                        "warning",
+                        f"{call['macro']} does not use {name}={value} "
+                        f"(line {call['line']})",
+                    )
+                )
+            elif parameters[name]:
+                used[parameters[name]] = value
+    for variable in ("extruder_temp", "bed_temp"):
+        try:
+            value = float(used.get(variable, 0))
+        except (TypeError, ValueError):
+            problems.append(("error", f"{variable} is not a number: {used[variable]}"))
+            continue
+        sliced = metadata[variable]
+        if value <= 0:
+            problems.append(("error", f"{variable} is not set"))
+        elif sliced and abs(value - sliced) > TEMP_TOLERANCE:
+            problems.append(
+                (
+                    "warning",
+                    f"{variable} is {value:g} but the slicer first layer is {sliced:g}",
+                )
+            )
+    nozzle = variables.get("nozzle_diameter") or 0
+    if nozzle and metadata["nozzle_diameter"]:
+        if abs(float(nozzle) - metadata["nozzle_diameter"]) > 0.001:
+            problems.append(
+                (
+                    "error",
+                    f"Sliced for a {metadata['nozzle_diameter']:g} mm nozzle, "
+                    f"the profile has {float(nozzle):g} mm",
+                )
+            )
+    if metadata["chamber_temp"] and str(variables.get("chamber_type", "none")) in (
+        "none",
+        "",
+    ):
+        problems.append(
+            (
+                "warning",
+                f"The slicer sets a {metadata['chamber_temp']:g}°C chamber "
+                "but the profile has no chamber",
+            )
+        )
+    return problems
+
+
+def gcode_files(paths: List[str]) -> List[str]:
+    """Get the G-code files of files and directories."""
+    files: List[str] = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for directory, _, names in os.walk(path):
+            files.extend(
+                os.path.join(directory, name)
+                for name in sorted(names)
+                if name.lower().endswith(".gcode")
+            )
+    return files
+
+
+def _duration(seconds: Optional[int]) -> str:
+    """Format a duration (Eg: 3723 = '1h02m')."""
+    if seconds is None:
+        return "-"
+    hours, minutes = divmod(seconds // 60, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds % 60:02d}s"
+
+
+def print_result(path: str, metadata: Dict[str, Any], problems: List[Tuple[str, str]]):
+    """Print the metadata and problems of a file."""
+    errors = any(level == "error" for level, _ in problems)
+    color = "31" if errors else "33" if problems else "32"
+    print(f"\033[{color}m{path}\033[0m")
+
+    def temp(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value:g}"
+
+    print(
+        f"  {metadata['slicer'] or 'unknown slicer'}: "
+        f"{metadata['filament_type'] or '-'}, "
+        f"nozzle {temp(metadata['nozzle_diameter'])}, "
+        f"extruder {temp(metadata['extruder_temp'])}, "
+        f"bed {temp(metadata['bed_temp'])}, "
+        f"estimated {_duration(metadata['estimated_time'])}"
+    )
+    for call in metadata["calls"]:
+        params = " ".join(f"{name}={value}" for name, value in call["params"].items())
+        print(f"  line {call['line']}: {call['macro']} {params}".rstrip())
+    for level, message in problems:
+        print(f"\033[{'31' if level == 'error' else '33'}m  {level}: {message}\033[0m")
+
+
+def live_variables() -> Dict[str, Any]:
+    """
+    Get the _printcfg variables loaded by Klipper.
+
+    Raises:
+        MoonrakerError: If Moonraker is unreachable or has no _printcfg macro.
+    """
+    from moonraker import MoonrakerError, default_client
+
+    variables = default_client().printcfg_variables()
+    if not variables:
+        raise MoonrakerError("Klipper has no _printcfg variables loaded")
+    return variables
+
+
+def main(argv: List[str]) -> int:
+    """Check G-code files against the profile."""
+    args = argv[1:]
+    paths: List[str] = []
+    as_json = False
+    use_cache = True
+    start_macro = START_MACRO
+    profile = os.path.join(CONFIG_DIR, "user_profile.cfg")
+    live = False
+    try:
+        while args:
+            arg = args.pop(0)
+            if arg == "--json":
+                as_json = True
+            elif arg == "--no-cache":
+                use_cache = False
+            elif arg == "--profile":
+                profile = args.pop(0)
+            elif arg == "--start-macro":
+                start_macro = args.pop(0).upper()
+            elif arg == "--live":
+                live = True
+            elif arg.startswith("--"):
+                raise ValueError(arg)
+            else:
+                paths.append(arg)
+    except (IndexError, ValueError) as err:
+        print(f"Error: Invalid argument {err}")
+        print(
+            "Usage: python3 gcode_meta.py [<file.gcode|directory> ...] [--json] "
+            "[--no-cache] [--profile <file>] [--start-macro <macro>] [--live]"
+        )
+        return 1
+    if not os.path.exists(profile):
+        profile = os.path.join(REPO_DIR, "profiles", "default", "variables.cfg")
+    cache = MetadataCache(CACHE_FILE if use_cache else os.devnull)
+    failed = False
+    try:
+        if live:
+            variables = live_variables()
+        else:
+            variables = profile_variables(load_config(profile))
+        macros, aliases = macro_parameters([os.path.join(REPO_DIR, "print_macros.cfg")])
+        for path in gcode_files(paths or [GCODE_DIR]):
+            metadata, cached = cache.get(path)
+            problems = check(metadata, variables, macros, aliases, start_macro)
+            failed = failed or any(level == "error" for level, _ in problems)
+            logger.info("Checked %s (cached: %s): %s", path, cached, problems)
+            if as_json:
+                result = {"file": path, "cached": cached, "problems": problems}
+                print(json.dumps(dict(metadata, **result)))
+            else:
+                print_result(path, metadata, problems)
+        if use_cache:
+            cache.save()
+    except (OSError, RuntimeError) as err:
+        print(f"\033[31mError: {err}\033[0m")
+        logger.error("G-code check failed: %s", err)
+        return 1
+    return 1 if failed else 0
+
+
+def cmd_check(args: List[str]) -> bool:
+    """Run the check from the printcfg CLI."""
+    return main(["gcode_meta.py"] + args) == 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A local bare mirror of the printcfg repo.
+
+Updates fetch the branches of the remote into the mirror with a single
+'git fetch', and the printcfg checkout is updated from the mirror. The
+branches that exist and whether an update is available are answered
+from the refs of the mirror, without contacting the remote again.
+
+The fetch holds a lock and is skipped when the mirror was fetched less
+than FETCH_TTL seconds ago, so the instances of a fleet update share
+one fetch.
+
+The mirror path (PRINTCFG_MIRROR) can be any local bare repo. In
+offline mode (PRINTCFG_OFFLINE=1 or --offline) nothing is fetched and
+everything is served from that mirror. The remote (PRINTCFG_REMOTE)
+can also be a local bare repo, for example in tests.
+
+Usage:
+    python3 git_mirror.py [--offline] [--mirror <path>] <fetch|branches|check>
+                          [<branch>]
+
+Example:
+    python3 git_mirror.py check dev
+"""
+
+import fcntl
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+from log_setup import get_logger
+
+logger = get_logger("git_mirror")
+
+# Set the dev and repo name
+DEV = "rootiest"
+REPO = "printcfg"
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REMOTE_URL = os.environ.get("PRINTCFG_REMOTE", f"https://github.com/{DEV}/{REPO}")
+MIRROR_DIR = os.environ.get(
+    "PRINTCFG_MIRROR",
+    os.path.join(os.path.expanduser("~"), REPO, "cache", "mirror.git"),
+)
+# How long a fetch is reused, in seconds
+FETCH_TTL = 60.0
+# How long a fetch may take, in seconds
+FETCH_TIMEOUT = 300.0
+
+
+class MirrorError(RuntimeError):
+    """Raised when the mirror cannot be created, fetched or read."""
+
+
+def offline_default() -> bool:
+    """Whether offline mode is enabled in the environment."""
+    return os.environ.get("PRINTCFG_OFFLINE", "") not in ("", "0")
+
+
+def git(*args: str, cwd: Optional[str] = None, timeout: Optional[float] = None) -> str:
+    """
+    Runs a git command.
+
+    Args:
+        args: The git arguments.
+        cwd: The directory to run in.
+        timeout: The timeout of the command, in seconds.
+
+    Returns:
+        The output of the command.
+
+    Raises:
+        MirrorError: If git fails.
+    """
+    command = ["git", *args]
+    logger.debug("Running %s", command)
+    try:
+        result = subprocess.run(
+            command,
+            cwd=cwd,
+            capture_output=True,
+            stdin=subprocess.DEVNULL,
+            timeout=timeout,
+            check=False,
+        )
+    except (OSError, subprocess.TimeoutExpired) as err:
+        raise MirrorError(f"git {args[0]} failed: {err}") from err
+    if result.returncode != 0:
+        error = result.stderr.decode("utf-8", "replace").strip()
+        raise MirrorError(f"git {args[0]} failed: {error}")
+    return result.stdout.decode("utf-8", "replace")
+
+
+class Mirror:
+    """A bare mirror of the branches of the printcfg repo."""
+
+    def __init__(
+        self,
+        path: str = MIRROR_DIR,
+        url: str = REMOTE_URL,
+        offline: Optional[bool] = None,
+    ):
+        """
+        Args:
+            path: The bare mirror.
+            url: The remote repo.
+            offline: Never contact the remote (default: PRINTCFG_OFFLINE).
+        """
+        self.path = path
+        self.url = url
+        self.offline = offline_default() if offline is None else offline
+        self._branches: Optional[Dict[str, str]] = None
+
+    def _git(self, *args: str, timeout: Optional[float] = None) -> str:
+        return git("--git-dir", self.path, *args, timeout=timeout)
+
+    def exists(self) -> bool:
+        """Whether the mirror was created."""
+        return os.path.isfile(os.path.join(self.path, "HEAD"))
+
+    def create(self):
+        """Create the empty mirror of the remote branches."""
+        if self.exists():
+            return
+        if self.offline:
+            raise MirrorError(f"No mirror at {self.path} in offline mode")
+        logger.info("Creating the mirror of %s in %s", self.url, self.path)
+        os.makedirs(self.path, exist_ok=True)
+        self._git("init", "--quiet", "--bare")
+        self._git("remote", "add", "origin", self.url)
+        # Only the branches: the pull request refs are not needed
+        self._git("config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*")
+
+    def last_fetch(self) -> float:
+        """Get the time of the last fetch (0 if never fetched)."""
+        try:
+            return os.stat(os.path.join(self.path, "FETCH_HEAD")).st_mtime
+        except OSError:
+            return 0.0
+
+    def fetch(self, max_age: float = FETCH_TTL) -> bool:
+        """
+        Fetches the branches of the remote into the mirror.
+
+        Args:
+            max_age: Skip the fetch if the mirror was fetched this many
+                     seconds ago or less.
+
+        Returns:
+            True if the remote was fetched.
+
+        Raises:
+            MirrorError: If the fetch fails, or there is no mirror in
+                         offline mode.
+        """
+        if self.offline:
+            if not self.exists():
+                raise MirrorError(f"No mirror at {self.path} in offline mode")
+            logger.info("Offline: using the mirror %s as it is", self.path)
+            return False
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f"{self.path}.lock", "w", encoding="utf-8") as lock:
+            # Wait for a fetch by another instance, then reuse it
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.create()
+            if time.time() - self.last_fetch() <= max_age:
+                logger.info("The mirror was fetched recently, not fetching")
+                return False
+            logger.info("Fetching %s", self.url)
+            self._git("fetch", "--quiet", "--prune", "origin", timeout=FETCH_TIMEOUT)
+            self._branches = None
+        return True
+
+    def branches(self) -> Dict[str, str]:
+        """Get the branches of the mirror and their commits."""
+        if self._branches is None:
+            if not self.exists():
+                raise MirrorError(f"No mirror at {self.path}")
+            output = self._git(
+                "for-each-ref",
+                "--format=%(refname:lstrip=2) %(objectname)",
+                "refs/heads",
+            )
+            self._branches = dict(
+                line.split(" ", 1) for line in output.splitlines() if line
+            )
+        return self._branches
+
+    def has_branch(self, branch: str) -> bool:
+        """Whether a branch exists in the mirror."""
+        return branch in self.branches()
+
+    def commits_behind(self, commit: str, branch: str) -> Optional[int]:
+        """
+        Counts the commits of a branch that a commit does not have.
+
+        Args:
+            commit: The commit of the checkout.
+            branch: The branch of the mirror.
+
+        Returns:
+            The number of new commits, or None if the commit is not in
+            the mirror (Eg: a local commit).
+        """
+        head = self.branches().get(branch)
+        if head is None:
+            raise MirrorError(f"Branch {branch} does not exist")
+        if head == commit:
+            return 0
+        try:
+            return int(self._git("rev-list", "--count", f"{commit}..{head}"))
+        except (MirrorError, ValueError):
+            return None
+
+    def checkout_fetch_args(self) -> List[str]:
+        """
+        Get the git arguments that update the origin branches of a
+        checkout from the mirror.
+
+        The checkout keeps its origin remote, so 'git switch <branch>'
+        and '@{upstream}' work as they would after 'git fetch origin'.
+        """
+        return [
+            "fetch",
+            "--quiet",
+            "--prune",
+            os.path.abspath(self.path),
+            "+refs/heads/*:refs/remotes/origin/*",
+        ]
+
+    def update_checkout(self, repo_dir: str = REPO_DIR):
+        """Update the origin branches of a checkout from the mirror."""
+        git(*self.checkout_fetch_args(), cwd=repo_dir)
+
+
+def checkout_commit(repo_dir: str = REPO_DIR) -> Dict[str, str]:
+    """Get the branch and commit of a checkout."""
+    return {
+        "branch": git("branch", "--show-current", cwd=repo_dir).strip(),
+        "commit": git("rev-parse", "HEAD", cwd=repo_dir).strip(),
+    }
+
+
+def check_update(
+    mirror: Mirror, branch: Optional[str] = None, repo_dir: str = REPO_DIR
+) -> Dict[str, object]:
+    """
+    Checks whether an update is available from the local refs.
+
+    Args:
+        mirror: The mirror (it is not fetched).
+        branch: The branch (default: the branch of the checkout).
+        repo_dir: The checkout.
+
+    Returns:
+        The branch, the commits of the checkout and the mirror, and the
+        number of new commits ('behind', None when it is unknown).
+    """
+    current = checkout_commit(repo_dir)
+    branch = branch or current["branch"]
+    behind = mirror.commits_behind(current["commit"], branch)
+    return {
+        "branch": branch,
+        "commit": current["commit"],
+        "latest": mirror.branches()[branch],
+        "behind": behind,
+    }
+
+
+def main(argv: List[str]) -> int:
+    """Run the mirror commands from the command line."""
+    args = argv[1:]
+    offline: Optional[bool] = None
+    path = MIRROR_DIR
+    positional: List[str] = []
+    try:
+        while args:
+            arg = args.pop(0)
+            if arg == "--offline":
+                offline = True
+            elif arg == "--mirror":
+                path = args.pop(0)
+            elif arg.startswith("--"):
+                raise ValueError(arg)
+            else:
+                positional.append(arg)
+        if not positional or positional[0] not in ("fetch", "branches", "check"):
+            raise ValueError(positional[0] if positional else "(no command)")
+    except (IndexError, ValueError) as err:
+        print(f"Error: Invalid argument {err}")
+        print(
+            "Usage: python3 git_mirror.py [--offline] [--mirror <path>] "
+            "<fetch|branches|check> [<branch>]"
+        )
+        return 1
+    command = positional[0]
+    mirror = Mirror(path, offline=offline)
+    try:
+        if command == "fetch":
+            fetched = mirror.fetch(max_age=0)
+            print(f"{'Fetched' if fetched else 'Using'} {mirror.path}")
+        elif command == "branches":
+            for branch, commit in sorted(mirror.branches().items()):
+                print(f"{commit[:10]} {branch}")
+        else:
+            mirror.fetch()
+            branch = positional[1] if len(positional) > 1 else None
+            update = check_update(mirror, branch)
+            if update["behind"] == 0:
+                print(f"{REPO} is up to date on {update['branch']}.")
+            elif update["behind"] is None:
+                print(f"{REPO} has local commits not in {update['branch']}.")
+            else:
+                print(f"{update['behind']} new commits on {update['branch']}.")
+                return 2
+    except MirrorError as err:
+        print(f"\033[31mError: {err}\033[0m")
+        logger.error("%s failed: %s", command, err)
+        return 1
+    return 0
+
+
+def cmd_check(args: List[str]) -> bool:
+    """Handle 'printcfg check-update [--offline] [<branch>]'."""
+    return main([sys.argv[0], "check", *args]) != 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A parser for Klipper config files.
+
+A file is parsed into a small tree of sections and options
+with their line spans (1-based, inclusive), following the
+rules of Klipper's config parser:
+
+- Options are 'name: value' or 'name = value', names are lowercase.
+- Indented lines continue the previous option (Eg: gcode blocks).
+- ';' or '#' after whitespace starts an inline comment.
+- Full-line comments are skipped, also inside multi-line values.
+- [include <glob>] sections include other files.
+- The '#*#' SAVE_CONFIG trailer is parsed into autosave sections.
+
+Top-level comments of the form '# Key: value' or '# Text #'
+are kept as markers (Eg: '# Profile: default').
+
+Usage:
+    python3 klipper_config.py <file> [--tree]
+"""
+
+import glob
+import os
+import re
+import sys
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+# First line of the SAVE_CONFIG trailer
+AUTOSAVE_HEADER = "#*# <---------------------- SAVE_CONFIG ---------------------->"
+# Prefix of the lines of the SAVE_CONFIG trailer
+AUTOSAVE_PREFIX = "#*#"
+
+SECTION_PATTERN = re.compile(r"\[([^\]]+)\]")
+INLINE_COMMENT_PATTERN = re.compile(r"\s[#;]")
+BOXED_MARKER_PATTERN = re.compile(r"#\s+(.+?)\s+#\s*$")
+MARKER_PATTERN = re.compile(r"#[ \t]+([A-Za-z][\w ]*?)\s*:\s*(.*?)\s*$")
+GLOB_CHARS = "*?["
+
+
+class ConfigError(Exception):
+    """Raised when a config file cannot be parsed."""
+
+
+class Option:
+    """An option of a section. Multi-line values are joined with newlines."""
+
+    __slots__ = ("name", "value", "comment", "start", "end")
+
+    def __init__(self, name: str, value: str, line: int, comment: str = ""):
+        self.name = name
+        self.value = value
+        self.comment = comment
+        self.start = line
+        self.end = line
+
+    @property
+    def lines(self) -> List[str]:
+        """The lines of a multi-line value, without the empty first line."""
+        lines = self.value.split("\n")
+        return lines[1:] if not lines[0] else lines
+
+    def __repr__(self) -> str:
+        return f"Option({self.name!r}, lines {self.start}-{self.end})"
+
+
+class Section:
+    """A config section and its options."""
+
+    __slots__ = ("name", "options", "start", "end", "file_name")
+
+    def __init__(self, name: str, line: int, file_name: str):
+        self.name = name
+        self.options: Dict[str, Option] = {}
+        self.start = line
+        self.end = line
+        self.file_name = file_name
+
+    @property
+    def kind(self) -> str:
+        """The type of the section (Eg: 'gcode_macro' for [gcode_macro M600])."""
+        return self.name.split(None, 1)[0]
+
+    @property
+    def title(self) -> str:
+        """The name after the type (Eg: 'M600' for [gcode_macro M600])."""
+        parts = self.name.split(None, 1)
+        return parts[1] if len(parts) > 1 else ""
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        """Get the value of an option."""
+        option = self.options.get(name.lower())
+        return option.value if option is not None else default
+
+    def __repr__(self) -> str:
+        return f"Section({self.name!r}, lines {self.start}-{self.end})"
+
+
+class Marker:
+    """A top-level marker comment (Eg: '# Patch: 4.0.0')."""
+
+    __slots__ = ("key", "value", "line")
+
+    def __init__(self, key: str, value: str, line: int):
+        self.key = key
+        self.value = value
+        self.line = line
+
+    def __repr__(self) -> str:
+        return f"Marker({self.key!r}, {self.value!r}, line {self.line})"
+
+
+class Include:
+    """An [include] section and the files it matched."""
+
+    __slots__ = ("pattern", "line", "files")
+
+    def __init__(self, pattern: str, line: int):
+        self.pattern = pattern
+        self.line = line
+        self.files: List[str] = []
+
+    def __repr__(self) -> str:
+        return f"Include({self.pattern!r}, line {self.line})"
+
+
+class ConfigFile:
+    """A parsed config file."""
+
+    __slots__ = ("path", "sections", "includes", "markers", "autosave", "line_count")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sections: List[Section] = []
+        self.includes: List[Include] = []
+        self.markers: List[Marker] = []
+        # Sections of the SAVE_CONFIG trailer
+        self.autosave: List[Section] = []
+        self.line_count = 0
+
+    def section(self, name: str) -> Optional[Section]:
+        """Get a section by name (the last one if it is repeated)."""
+        found = None
+        for section in self.sections:
+            if section.name == name:
+                found = section
+        return found
+
+    def marker(self, key: str) -> Optional[Marker]:
+        """Get the first marker with the given key."""
+        for marker in self.markers:
+            if marker.key == key:
+                return marker
+        return None
+
+    def __repr__(self) -> str:
+        return f"ConfigFile({self.path!r}, {len(self.sections)} sections)"
+
+
+class ConfigTree:
+    """A config file and all the files it includes, in include order."""
+
+    __slots__ = ("root", "files")
+
+    def __init__(self, root: ConfigFile):
+        self.root = root
+        self.files: List[ConfigFile] = [root]
+
+    def sections(self) -> Iterator[Section]:
+        """Iterate over the sections of all files."""
+        for config in self.files:
+            yield from config.sections
+
+    def find_sections(self, name: str) -> List[Section]:
+        """Get every section with the given name, in include order."""
+        return [section for section in self.sections() if section.name == name]
+
+
+def _split_comment(text: str) -> List[str]:
+    """Split the inline comment off a line."""
+    match = INLINE_COMMENT_PATTERN.search(text)
+    if match is None:
+        return [text, ""]
+    return [text[: match.start()], text[match.start() + 2 :].strip()]
+
+
+def _close(section: Optional[Section]):
+    """Set the end line of a finished section."""
+    if section is not None and section.options:
+        section.end = max(option.end for option in section.options.values())
+
+
+def parse_lines(lines: List[str], path: str = "<string>") -> ConfigFile:
+    """
+    Parses the lines of a config file.
+
+    Args:
+        lines: The lines of the file.
+        path: The name of the file.
+
+    Returns:
+        The parsed file.
+    """
+    config = ConfigFile(path)
+    config.line_count = len(lines)
+    sections = config.sections
+    section: Optional[Section] = None
+    option: Optional[Option] = None
+    for number, raw in enumerate(lines, 1):
+        line = raw.rstrip("\r\n")
+        if sections is config.autosave:
+            if not line.startswith(AUTOSAVE_PREFIX):
+                continue
+            line = line[len(AUTOSAVE_PREFIX) :]
+            line = line[1:] if line.startswith(" ") else line
+        elif line.startswith(AUTOSAVE_HEADER):
+            _close(section)
+            section = option = None
+            sections = config.autosave
+            continue
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if stripped[0] in "#;":
+            # Full-line comments do not end a multi-line value
+            if line[0] == "#" and sections is config.sections:
+                marker = BOXED_MARKER_PATTERN.match(line)
+                if marker:
+                    config.markers.append(Marker(marker.group(1), "", number))
+                else:
+                    marker = MARKER_PATTERN.match(line)
+                    if marker:
+                        config.markers.append(
+                            Marker(marker.group(1), marker.group(2), number)
+                        )
+            continue
+        if line[0] in " \t":
+            if option is not None:
+                value = _split_comment(line)[0].strip()
+                if value:
+                    option.value += "\n" + value
+                    option.end = number
+            continue
+        header = SECTION_PATTERN.match(line)
+        if header:
+            _close(section)
+            option = None
+            name = header.group(1).strip()
+            if name.startswith("include "):
+                config.includes.append(Include(name[len("include ") :].strip(), number))
+                section = None
+                continue
+            section = Section(name, number, path)
+            sections.append(section)
+            continue
+        option = None
+        if section is None:
+            continue
+        text, comment = _split_comment(line)
+        positions = [pos for pos in (text.find(":"), text.find("=")) if pos >= 0]
+        if not positions:
+            continue
+        split = min(positions)
+        option = Option(
+            text[:split].strip().lower(), text[split + 1 :].strip(), number, comment
+        )
+        section.options[option.name] = option
+    _close(section)
+    return config
+
+
+def parse_file(path: str) -> ConfigFile:
+    """Parses a config file."""
+    with open(path, "r", encoding="utf-8") as file:
+        return parse_lines(file.readlines(), path)
+
+
+def parse_tree(
+    path: str, load: Callable[[str], ConfigFile] = parse_file
+) -> ConfigTree:
+    """
+    Parses a config file and every file it includes.
+
+    Args:
+        path: The config file (Eg: printer.cfg).
+        load: The function parsing each file (Eg: a cached parse_file).
+
+    Returns:
+        The parsed files, in include order.
+
+    Raises:
+        ConfigError: If an included file does not exist.
+    """
+    tree = ConfigTree(load(path))
+    seen = {os.path.realpath(path)}
+
+    def visit(config: ConfigFile):
+        directory = os.path.dirname(config.path)
+        for include in config.includes:
+            pattern = os.path.join(directory, include.pattern)
+            include.files = sorted(glob.glob(pattern))
+            if not include.files and not any(c in pattern for c in GLOB_CHARS):
+                raise ConfigError(
+                    f"Include file '{pattern}' does not exist "
+                    f"({config.path}:{include.line})"
+                )
+            for file_name in include.files:
+                real_path = os.path.realpath(file_name)
+                if real_path in seen:
+                    continue
+                seen.add(real_path)
+                included = load(file_name)
+                tree.files.append(included)
+                visit(included)
+
+    visit(tree.root)
+    return tree
+
+
+def main(argv: List[str]) -> int:
+    """Print a summary of a parsed config file."""
+    if len(argv) < 2:
+        print("Usage: python3 klipper_config.py <file> [--tree]")
+        return 1
+    start = time.perf_counter()
+    try:
+        if "--tree" in argv:
+            files = parse_tree(argv[1]).files
+        else:
+            files = [parse_file(argv[1])]
+    except (OSError, ConfigError) as err:
+        print(f"Error: {err}")
+        return 1
+    elapsed = (time.perf_counter() - start) * 1000
+    for config in files:
+        options = sum(len(section.options) for section in config.sections)
+        print(
+            f"{config.path}: {config.line_count} lines, "
+            f"{len(config.sections)} sections, {options} options, "
+            f"{len(config.includes)} includes, {len(config.autosave)} autosave"
+        )
+        for marker in config.markers:
+            print(f"  line {marker.line}: {marker.key}: {marker.value}")
+    print(f"Parsed {len(files)} file(s) in {elapsed:.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script collects the entries of the 'logger' macro from klippy.log.
+# Entries written by the macro with variable_echo enabled (LOGGER INFO:
+# title: msg) and the entries of 'logger output=1' dumps (INFO: title: msg)
+# are stored in an SQLite file indexed by print, level and title, so the
+# history lives outside of the Klipper process. Once a Klipper session
+# echoes its entries, the dumps of that session are not stored again.
+#
+# klippy.log is read from where the last run stopped, and read again
+# from the start when it was rotated. Prints are delimited by the
+# virtual_sdcard 'Starting/Finished SD card print' lines ('Exiting' is also
+# logged when a print is paused, so it only ends a print that is not
+# resumed), and the time of each entry is worked out from the 'Start printer
+# at' and 'Stats' lines.
+#
+# Usage:
+#   python3 log_collector.py collect [--follow] [--log <klippy.log>]
+#   python3 log_collector.py query [--print <id|last>] [--level <level>]
+#                                  [--title <title>] [--limit <n>] [--json]
+#   python3 log_collector.py prints [--limit <n>]
+#
+# Example:
+#   python3 log_collector.py query --print last --level warning
+
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from typing import Any, Dict, List, Optional, Union
+
+from log_setup import get_logger
+
+logger = get_logger("log_collector")
+
+# The printer_data directory (PRINTCFG_DATA selects another instance)
+PRINTER_DATA = os.environ.get(
+    "PRINTCFG_DATA", os.path.join(os.path.expanduser("~"), "printer_data")
+)
+# The Klipper log
+KLIPPY_LOG = os.path.join(PRINTER_DATA, "logs", "klippy.log")
+# The entry database, next to the Klipper log of the instance
+DATABASE = os.path.join(PRINTER_DATA, "logs", "printcfg_logger.db")
+# Levels of the logger macro
+LEVELS = [
+    "DEBUG",
+    "INFO",
+    "NOTICE",
+    "WARNING",
+    "ERROR",
+    "CRITICAL",
+    "ALERT",
+    "EMERGENCY",
+]
+# Seconds between two reads of klippy.log with --follow
+FOLLOW_INTERVAL = 1.0
+# Bytes read from klippy.log at once
+READ_SIZE = 1024 * 1024
+
+ENTRY_PATTERN = re.compile(rf"^(LOGGER )?({'|'.join(LEVELS)}): ?(.*?): (.*)$")
+START_PATTERN = re.compile(r"^Start printer at .*\(([\d.]+) ([\d.]+)\)")
+STATS_PATTERN = re.compile(r"^Stats ([\d.]+):")
+PRINT_PATTERN = re.compile(
+    r"^(Starting|Finished|Exiting) SD card print(?: \(position (\d+)\))?"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL,
+    print_id INTEGER,
+    logged_at REAL NOT NULL,
+    level INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_print ON entries (print_id, level);
+CREATE INDEX IF NOT EXISTS entries_level ON entries (level);
+CREATE INDEX IF NOT EXISTS entries_title ON entries (title, level);
+CREATE TABLE IF NOT EXISTS prints (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    ended_at REAL,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def parse_level(level: Union[str, int]) -> int:
+    """Get the number of a level name (Eg: 'warning' = 3) or number."""
+    text = str(level).strip().upper()
+    if text in LEVELS:
+        return LEVELS.index(text)
+    if not text.isdigit():
+        raise ValueError(level)
+    return min(int(text), len(LEVELS) - 1)
+
+
+class LogStore:
+    """The entry database and the position reached in klippy.log."""
+
+    def __init__(self, path: str = DATABASE):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.state: Dict[str, Any] = {
+            "inode": None,
+            "offset": 0,
+            "session": 0,
+            "print_id": None,
+            "echo": False,
+            # The wall and monotonic time of the last Klipper start
+            "clock": [],
+        }
+        row = self.db.execute(
+            "SELECT value FROM state WHERE key = 'reader'"
+        ).fetchone()
+        if row:
+            self.state.update(json.loads(row["value"]))
+
+    def close(self):
+        """Close the database."""
+        self.db.close()
+
+    def _now(self, monotonic: Optional[float] = None) -> float:
+        """Get the wall time of a Klipper clock value, or the current time."""
+        clock = self.state["clock"]
+        if clock and monotonic is not None:
+            return clock[0] + monotonic - clock[1]
+        if clock and self.state.get("last_stats") is not None:
+            return clock[0] + self.state["last_stats"] - clock[1]
+        return time.time()
+
+    def _line(self, line: str, pending: List[tuple]):
+        """Handle a line of klippy.log."""
+        match = ENTRY_PATTERN.match(line)
+        if match:
+            echoed, level, title, message = match.groups()
+            if echoed and not self.state["echo"]:
+                self.state["echo"] = True
+            elif not echoed and self.state["echo"]:
+                # Already collected when it was echoed
+                return
+            pending.append(
+                (
+                    self.state["session"],
+                    self.state["print_id"],
+                    self._now(),
+                    LEVELS.index(level),
+                    title,
+                    message,
+                )
+            )
+            return
+        match = STATS_PATTERN.match(line)
+        if match:
+            self.state["last_stats"] = float(match.group(1))
+            return
+        match = START_PATTERN.match(line)
+        if match:
+            self.state["session"] += 1
+            self.state["echo"] = False
+            self.state["last_stats"] = None
+            self.state["clock"] = [float(match.group(1)), float(match.group(2))]
+            self._end_print("stopped" if self.state.get("exited_at") else "restarted")
+            return
+        match = PRINT_PATTERN.match(line)
+        if match:
+            action, position = match.groups()
+            if action == "Starting":
+                if position == "0" or self.state["print_id"] is None:
+                    self._end_print("stopped")
+                    cursor = self.db.execute(
+                        "INSERT INTO prints (session, started_at) VALUES (?, ?)",
+                        (self.state["session"], self._now()),
+                    )
+                    self.state["print_id"] = cursor.lastrowid
+                # Resumed
+                self.state["exited_at"] = None
+            elif action == "Exiting":
+                # Paused, cancelled or failed: the print ends if it is not resumed
+                self.state["exited_at"] = self._now()
+            else:
+                self._end_print("complete")
+
+    def _end_print(self, result: str):
+        """Close the current print."""
+        if self.state["print_id"] is None:
+            return
+        self.db.execute(
+            "UPDATE prints SET ended_at = ?, result = ? "
+            "WHERE id = ? AND ended_at IS NULL",
+            (
+                self.state.get("exited_at") or self._now(),
+                result,
+                self.state["print_id"],
+            ),
+        )
+        self.state["print_id"] = None
+        self.state["exited_at"] = None
+
+    def collect(self, log_file: str = KLIPPY_LOG) -> int:
+        """
+        Stores the new logger entries of klippy.log.
+
+        Args:
+            log_file: The Klipper log.
+
+        Returns:
+            The number of entries stored.
+        """
+        stat = os.stat(log_file)
+        if stat.st_ino != self.state["inode"] or stat.st_size < self.state["offset"]:
+            # Rotated or truncated
+            logger.info("Reading %s from the start", log_file)
+            self.state["inode"] = stat.st_ino
+            self.state["offset"] = 0
+        stored = 0
+        with open(log_file, "rb") as file:
+            file.seek(self.state["offset"])
+            while True:
+                block = file.read(READ_SIZE)
+                if not block:
+                    break
+                # Keep a partial last line for the next read
+                end = block.rfind(b"\n") + 1
+                if end == 0:
+                    if len(block) < READ_SIZE:
+                        break
+                    end = len(block)
+                elif end < len(block):
+                    file.seek(end - len(block), os.SEEK_CUR)
+                pending: List[tuple] = []
+                text = block[:end].decode("utf-8", "replace")
+                for line in text.splitlines():
+                    self._line(line, pending)
+                self.db.executemany(
+                    "INSERT INTO entries (session, print_id, logged_at, level, title, "
+                    "message) VALUES (?, ?, ?, ?, ?, ?)",
+                    pending,
+                )
+                stored += len(pending)
+                self.state["offset"] += end
+                self._save_state()
+        return stored
+
+    def _save_state(self):
+        """Store the reader state with the entries read so far."""
+        self.db.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES ('reader', ?)",
+            (json.dumps(self.state),),
+        )
+        self.db.commit()
+
+    def query(
+        self,
+        print_id: Union[int, str, None] = None,
+        level: Union[int, str, None] = None,
+        title: Optional[str] = None,
+        since: Optional[float] = None,
+        limit: int = 100,
+    ) -> List[dict]:
+        """
+        Gets stored entries, newest last.
+
+        Args:
+            print_id: Only entries of this print ('last' for the latest one).
+            level: Only entries of this level and higher.
+            title: Only entries with this title.
+            since: Only entries logged after this time.
+            limit: The maximum number of entries (the newest are kept).
+
+        Returns:
+            The entries.
+        """
+        where: List[str] = []
+        args: List[Any] = []
+        if print_id == "last":
+            row = self.db.execute("SELECT MAX(id) AS id FROM prints").fetchone()
+            print_id = row["id"] if row and row["id"] is not None else -1
+        if print_id is not None:
+            where.append("print_id = ?")
+            args.append(int(print_id))
+        if level is not None:
+            where.append("level >= ?")
+            args.append(parse_level(level))
+        if title is not None:
+            where.append("title = ?")
+            args.append(title)
+        if since is not None:
+            where.append("logged_at >= ?")
+            args.append(since)
+        sql = "SELECT * FROM entries"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ?"
+        args.append(limit)
+        rows = self.db.execute(sql, args).fetchall()
+        return [dict(row, level=LEVELS[row["level"]]) for row in reversed(rows)]
+
+    def prints(self, limit: int = 20) -> List[dict]:
+        """Gets the latest prints with their entry counts, newest last."""
+        rows = self.db.execute(
+            "SELECT prints.*, COUNT(entries.id) AS entries FROM prints "
+            "LEFT JOIN entries ON entries.print_id = prints.id "
+            "GROUP BY prints.id ORDER BY prints.id DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+
+def _format_time(value: Optional[float]) -> str:
+    """Format a stored time."""
+    if value is None:
+        return "-"
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(value))
+
+
+def main(argv: List[str]) -> int:
+    """Collect or query the logger entries."""
+    if len(argv) < 2 or argv[1] not in ("collect", "query", "prints"):
+        print(
+            "Usage: python3 log_collector.py collect [--follow] [--log <file>]\n"
+            "       python3 log_collector.py query [--print <id|last>] "
+            "[--level <level>] [--title <title>] [--limit <n>] [--json]\n"
+            "       python3 log_collector.py prints [--limit <n>]"
+        )
+        return 1
+    command, args = argv[1], argv[2:]
+    options: Dict[str, Any] = {"limit": "100" if command == "query" else "20"}
+    try:
+        while args:
+            arg = args.pop(0)
+            if arg in ("--follow", "--json"):
+                options[arg[2:]] = True
+            elif arg in ("--log", "--print", "--level", "--title", "--limit", "--db"):
+                options[arg[2:]] = args.pop(0)
+            else:
+                raise ValueError(arg)
+        limit = int(options["limit"])
+        level = parse_level(options["level"]) if "level" in options else None
+    except (IndexError, ValueError) as err:
+        print(f"Error: Invalid argument {err}")
+        return 1
+    store = LogStore(options.get("db", DATABASE))
+    try:
+        if command == "collect":
+            log_file = options.get("log", KLIPPY_LOG)
+            while True:
+                stored = store.collect(log_file)
+                if stored:
+                    logger.info("Stored %s logger entries", stored)
+                if not options.get("follow"):
+                    print(f"Stored {stored} new entries in {store.path}")
+                    break
+                time.sleep(FOLLOW_INTERVAL)
+        elif command == "query":
+            entries = store.query(
+                options.get("print"), level, options.get("title"), limit=limit
+            )
+            if options.get("json"):
+                print(json.dumps(entries, indent=2))
+            for entry in [] if options.get("json") else entries:
+                print(
+                    f"{_format_time(entry['logged_at'])} "
+                    f"[{entry['print_id'] or '-'}] {entry['level']}: "
+                    f"{entry['title']}: {entry['message']}"
+                )
+        else:
+            for row in store.prints(limit):
+                print(
+                    f"print {row['id']}: {_format_time(row['started_at'])} -> "
+                    f"{_format_time(row['ended_at'])} {row['result'] or 'running'}, "
+                    f"{row['entries']} entries"
+                )
+    except OSError as err:
+        print(f"\033[31mError: {err}\033[0m")
+        logger.error("Log collector failed: %s", err)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared logging setup for the printcfg modules.
+
+Importing a module never touches the disk: the log directory
+and log files are only set up when the first record is written.
+
+Records are handed to a queue and written by a background
+listener thread, so logging calls never block on the disk.
+Each log file is rotated when it grows past LOG_MAX_BYTES or
+at the first write of a new day, and the old logs are kept as
+gzip archives (<name>.log.<timestamp>.gz), newest LOG_BACKUPS only.
+The log files are only ever stat'ed, never read.
+"""
+
+import atexit
+import glob
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+from typing import Dict, Optional
+
+# Default log directory
+LOG_DIR = os.path.join(os.path.expanduser("~"), "printcfg", "logs")
+# Log line format
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+# Rotate a log when it grows past this size
+LOG_MAX_BYTES = 1024 * 1024
+# Number of compressed archives kept for each log
+LOG_BACKUPS = 30
+# Timestamp format of the archive names
+ARCHIVE_TIME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+
+class CompressedRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """A file handler rotating on size and on day change into gzip archives."""
+
+    def __init__(
+        self,
+        filename: str,
+        max_bytes: int = LOG_MAX_BYTES,
+        backup_count: int = LOG_BACKUPS,
+    ):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        super().__init__(filename, "a", encoding="utf-8", delay=True)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        # Rotate at the first midnight after the last write
+        try:
+            last_write = os.stat(filename).st_mtime
+        except OSError:
+            last_write = time.time()
+        self.rollover_at = _next_midnight(last_write)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.time() >= self.rollover_at:
+            if os.path.exists(self.baseFilename):
+                return True
+            self.rollover_at = _next_midnight(time.time())
+        if self.max_bytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        message = f"{self.format(record)}\n"
+        return self.stream.tell() + len(message) >= self.max_bytes
+
+    def doRollover(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.rollover_at = _next_midnight(time.time())
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename):
+            stamp = f"{self.baseFilename}.{time.strftime(ARCHIVE_TIME_FORMAT)}"
+            archive = f"{stamp}.gz"
+            suffix = 0
+            while os.path.exists(archive):
+                suffix += 1
+                archive = f"{stamp}_{suffix:02d}.gz"
+            with open(self.baseFilename, "rb") as source:
+                with gzip.open(archive, "wb") as target:
+                    shutil.copyfileobj(source, target)
+            os.remove(self.baseFilename)
+        # Keep the newest archives only
+        archives = sorted(glob.glob(f"{glob.escape(self.baseFilename)}.*.gz"))
+        for archive in archives[: max(len(archives) - self.backup_count, 0)]:
+            os.remove(archive)
+
+
+def _next_midnight(timestamp: float) -> float:
+    """Get the local midnight following a timestamp."""
+    day = time.localtime(timestamp)
+    return time.mktime((day.tm_year, day.tm_mon, day.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
+
+class _FileRouter(logging.Handler):
+    """Writes each queued record to the log file it was logged for."""
+
+    def __init__(self):
+        super().__init__()
+        self.handlers: Dict[str, logging.Handler] = {}
+
+    def _handler(self, logfile: str) -> logging.Handler:
+        handler = self.handlers.get(logfile)
+        if handler is None:
+            try:
+                handler = CompressedRotatingFileHandler(logfile)
+            except OSError as err:
+                print(f"Error creating log file: {err}")
+                handler = logging.NullHandler()
+            handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            self.handlers[logfile] = handler
+        return handler
+
+    def emit(self, record: logging.LogRecord):
+        self._handler(getattr(record, "printcfg_logfile")).handle(record)
+
+    def flush(self):
+        for handler in self.handlers.values():
+            handler.flush()
+
+    def close(self):
+        for handler in self.handlers.values():
+            handler.close()
+        super().close()
+
+
+# The queue between the loggers and the writer thread
+_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_listener: Optional[logging.handlers.QueueListener] = None
+_listener_lock = threading.Lock()
+
+
+def _start_listener():
+    """Start the writer thread on the first record."""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            router = _FileRouter()
+            _listener = logging.handlers.QueueListener(_queue, router)
+            _listener.start()
+            atexit.register(shutdown)
+
+
+def shutdown():
+    """Write the queued records and stop the writer thread."""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+
+class LogfileQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the writer thread, tagged with their log file."""
+
+    def __init__(self, logfile: str):
+        super().__init__(_queue)
+        self.logfile = logfile
+
+    def enqueue(self, record: logging.LogRecord):
+        if _listener is None:
+            _start_listener()
+        record.printcfg_logfile = self.logfile
+        super().enqueue(record)
+
+
+def get_logger(
+    name: str, log_name: Optional[str] = None, log_dir: Optional[str] = None
+) -> logging.Logger:
+    """
+    Get a logger that writes to a file in the printcfg log directory.
+
+    Args:
+        name: The name of the logger.
+        log_name: The name of the log file without extension (default: name).
+        log_dir: The log directory (default: ~/printcfg/logs).
+
+    Returns:
+        The logger.
+    """
+    logger = logging.getLogger(name)
+    if not any(isinstance(h, LogfileQueueHandler) for h in logger.handlers):
+        logfile = os.path.join(log_dir or LOG_DIR, f"{log_name or name}.log")
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(LogfileQueueHandler(logfile))
+        logger.propagate = False
+    return logger
@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script measures how long each gcode_macro template takes to render.
+# Templates are compiled and rendered with jinja2 the way Klipper does it,
+# against a mock 'printer' object built from a profile: the variables of
+# every gcode_macro, the configfile settings and default status values of
+# the usual Klipper objects. Each printer object lookup and status field
+# read is counted, so macros that keep re-reading printer state stand out.
+#
+# Results are appended to a history file so render times can be tracked
+# across releases, like bench_startup.py does for the CLI.
+#
+# Usage:
+#   python3 macro_bench.py [options] [config_file ...]
+#
+# Options:
+#   --profile <name>: The profile the mock printer is built from (default).
+#   --runs <n>: The number of renders per macro (20).
+#   --macro <name>: Only benchmark this macro (can be repeated).
+#   --param <NAME=VALUE>: A macro parameter (can be repeated).
+#   --state <file>: A JSON file of status values merged into the mock
+#                   (Eg: {"print_stats": {"state": "printing"}}).
+#   --printer <file>: The printer.cfg the configfile settings are read from.
+#                     Without it, a minimal cartesian printer is used.
+#   --top <n>: Only show the n slowest macros.
+#
+# Example:
+#   python3 macro_bench.py --macro START_PRINT --param BED_TEMP=100
+
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from klipper_config import (
+    ConfigError,
+    ConfigFile,
+    Section,
+    parse_file,
+    parse_lines,
+    parse_tree,
+)
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+# Path to the printcfg repo
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Benchmark history file
+HISTORY_FILE = os.path.expanduser("~/printcfg/logs/macro_bench.jsonl")
+# Config files benchmarked by default
+DEFAULT_FILES = ["print_macros.cfg"]
+# Number of renders per macro
+DEFAULT_RUNS = 20
+
+
+class Coord(NamedTuple):
+    """A position, like Klipper's gcode Coord."""
+
+    x: float
+    y: float
+    z: float
+    e: float
+
+
+# Printer config used when no printer.cfg is given
+DEFAULT_PRINTER_CFG = """
+[printer]
+kinematics: cartesian
+max_velocity: 300
+max_accel: 3000
+max_accel_to_decel: 1500
+[stepper_x]
+position_endstop: 0
+position_max: 300
+[stepper_y]
+position_endstop: 0
+position_max: 300
+[stepper_z]
+position_endstop: 0
+position_max: 300
+[tmc2209 stepper_x]
+run_current: 0.8
+[tmc2209 stepper_y]
+run_current: 0.8
+[extruder]
+nozzle_diameter: 0.4
+min_extrude_temp: 170
+control: pid
+pid_kp: 22.2
+pid_ki: 1.08
+pid_kd: 114
+[heater_bed]
+control: pid
+pid_kp: 54.0
+pid_ki: 0.77
+pid_kd: 948
+[bed_mesh]
+mesh_min: 10, 10
+mesh_max: 290, 290
+probe_count: 5, 5
+[force_move]
+enable_force_move: True
+"""
+
+# Status of the Klipper objects every printer has, or that the macros use
+DEFAULT_STATUS: Dict[str, Dict[str, Any]] = {
+    "toolhead": {
+        "homed_axes": "xyz",
+        "position": Coord(150.0, 150.0, 10.0, 0.0),
+        "axis_minimum": Coord(0.0, 0.0, 0.0, 0.0),
+        "axis_maximum": Coord(300.0, 300.0, 300.0, 0.0),
+        "extruder": "extruder",
+        "max_velocity": 300.0,
+        "max_accel": 3000.0,
+        "max_accel_to_decel": 1500.0,
+        "square_corner_velocity": 5.0,
+        "stalls": 0,
+        "print_time": 0.0,
+        "estimated_print_time": 0.0,
+    },
+    "gcode_move": {
+        "speed_factor": 1.0,
+        "speed": 1500.0,
+        "extrude_factor": 1.0,
+        "absolute_coordinates": True,
+        "absolute_extrude": False,
+        "homing_origin": Coord(0.0, 0.0, 0.0, 0.0),
+        "position": Coord(150.0, 150.0, 10.0, 0.0),
+        "gcode_position": Coord(150.0, 150.0, 10.0, 0.0),
+    },
+    "extruder": {
+        "temperature": 25.0,
+        "target": 0.0,
+        "power": 0.0,
+        "can_extrude": False,
+        "pressure_advance": 0.04,
+        "smooth_time": 0.04,
+    },
+    "heater_bed": {"temperature": 25.0, "target": 0.0, "power": 0.0},
+    "fan": {"speed": 0.0, "rpm": None},
+    "print_stats": {
+        "filename": "",
+        "total_duration": 0.0,
+        "print_duration": 0.0,
+        "filament_used": 0.0,
+        "state": "standby",
+        "message": "",
+        "info": {"total_layer": None, "current_layer": None},
+    },
+    "virtual_sdcard": {
+        "file_path": None,
+        "progress": 0.0,
+        "is_active": False,
+        "file_position": 0,
+        "file_size": 0,
+    },
+    "pause_resume": {"is_paused": False},
+    "idle_timeout": {"state": "Idle", "printing_time": 0.0},
+    "bed_mesh": {"profile_name": "", "mesh_min": [0.0, 0.0], "mesh_max": [0.0, 0.0]},
+    "quad_gantry_level": {"applied": False},
+    "z_tilt": {"applied": False},
+    "exclude_object": {"objects": [], "excluded_objects": [], "current_object": None},
+    "save_variables": {"variables": {}},
+    "system_stats": {"sysload": 0.1, "cputime": 1.0, "memavail": 1000000},
+    "motion_report": {
+        "live_position": Coord(150.0, 150.0, 10.0, 0.0),
+        "live_velocity": 0.0,
+    },
+    "webhooks": {"state": "ready", "state_message": "Printer is ready"},
+}
+
+
+class StatusDict(dict):
+    """A status dict that counts the reads of its fields."""
+
+    __slots__ = ("counts",)
+
+    def __init__(self, data: dict, counts: Counter):
+        super().__init__(data)
+        self.counts = counts
+
+    def __getitem__(self, key):
+        self.counts["reads"] += 1
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.counts["reads"] += 1
+        return super().get(key, default)
+
+
+class MockPrinter:
+    """The 'printer' template object, counting the object lookups."""
+
+    def __init__(self, status: Dict[str, dict]):
+        self.status = status
+        self.counts: Counter = Counter()
+        self.objects: Counter = Counter()
+        self._cache: Dict[str, StatusDict] = {}
+
+    def reset(self):
+        """Start counting a new render (Klipper wraps the printer per render)."""
+        self.counts = Counter()
+        self.objects = Counter()
+        self._cache = {}
+
+    def __getitem__(self, name):
+        name = str(name).strip()
+        self.counts["lookups"] += 1
+        self.objects[name] += 1
+        if name in self._cache:
+            return self._cache[name]
+        if name not in self.status:
+            raise KeyError(name)
+        wrapped = StatusDict(self.status[name], self.counts)
+        self._cache[name] = wrapped
+        return wrapped
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError as err:
+            raise AttributeError(name) from err
+
+    def __contains__(self, name):
+        self.counts["lookups"] += 1
+        return str(name).strip() in self.status
+
+    def __iter__(self):
+        return iter(self.status)
+
+
+class MacroError(Exception):
+    """Raised by action_raise_error() in a template."""
+
+
+class MacroResult(NamedTuple):
+    """The benchmark of a single macro."""
+
+    name: str
+    compile_ms: float
+    median_ms: float
+    max_ms: float
+    output_bytes: int
+    output_lines: int
+    lookups: int
+    reads: int
+    hot_object: str
+    error: str
+
+
+def _literal(value: str) -> Any:
+    """Convert a config value like Klipper's getters would (numbers only)."""
+    if "," in value and "\n" not in value:
+        parts = [_literal(part.strip()) for part in value.split(",")]
+        if all(isinstance(part, (int, float)) for part in parts):
+            return tuple(float(part) for part in parts)
+        return value
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def macro_variables(section: Section) -> Dict[str, Any]:
+    """Get the variables of a gcode_macro, parsed like Klipper does."""
+    variables = {}
+    for name, option in section.options.items():
+        if name.startswith("variable_"):
+            try:
+                variables[name[len("variable_") :]] = ast.literal_eval(option.value)
+            except (ValueError, SyntaxError):
+                variables[name[len("variable_") :]] = option.value
+    return variables
+
+
+def build_status(
+    configs: List[ConfigFile], overrides: Optional[Dict[str, dict]] = None
+) -> Dict[str, dict]:
+    """
+    Builds the status of the mock printer.
+
+    Args:
+        configs: The parsed config files, later files win.
+        overrides: Status values merged over the defaults.
+
+    Returns:
+        The status of each printer object.
+    """
+    status: Dict[str, dict] = {
+        name: dict(values) for name, values in DEFAULT_STATUS.items()
+    }
+    config: Dict[str, Dict[str, str]] = {}
+    settings: Dict[str, Dict[str, Any]] = {}
+    for parsed in configs:
+        for section in parsed.sections:
+            config.setdefault(section.name, {}).update(
+                {name: option.value for name, option in section.options.items()}
+            )
+            settings.setdefault(section.name.lower(), {}).update(
+                {
+                    name: _literal(option.value)
+                    for name, option in section.options.items()
+                }
+            )
+            if section.kind == "gcode_macro":
+                status.setdefault(section.name, {}).update(macro_variables(section))
+            else:
+                status.setdefault(section.name, {})
+    status["configfile"] = {
+        "config": config,
+        "settings": settings,
+        "save_config_pending": False,
+        "warnings": [],
+    }
+    for name, values in (overrides or {}).items():
+        status.setdefault(name, {}).update(values)
+    return status
+
+
+def create_environment():
+    """Create a jinja2 environment with the syntax of Klipper templates."""
+    return jinja2.Environment("{%", "%}", "{", "}", extensions=["jinja2.ext.do"])
+
+
+def bench_macro(
+    env,
+    section: Section,
+    printer: MockPrinter,
+    params: Dict[str, str],
+    runs: int = DEFAULT_RUNS,
+) -> MacroResult:
+    """
+    Compiles and renders a macro several times.
+
+    Args:
+        env: The jinja2 environment.
+        section: The gcode_macro section.
+        printer: The mock printer.
+        params: The macro parameters.
+        runs: The number of renders.
+
+    Returns:
+        The benchmark of the macro.
+    """
+    name = section.title
+    template_text = section.get("gcode", "")
+    start = time.perf_counter()
+    try:
+        template = env.from_string(template_text)
+    except jinja2.TemplateSyntaxError as err:
+        error = f"line {err.lineno}: {err}"
+        return MacroResult(name, 0.0, 0.0, 0.0, 0, 0, 0, 0, "", error)
+    compile_ms = (time.perf_counter() - start) * 1000
+    messages: List[str] = []
+
+    def action_raise_error(msg):
+        raise MacroError(msg)
+
+    def action_respond_info(msg):
+        messages.append(msg)
+        return ""
+
+    context = {
+        "printer": printer,
+        "action_respond_info": action_respond_info,
+        "action_raise_error": action_raise_error,
+        "action_emergency_stop": action_raise_error,
+        "action_call_remote_method": lambda method, **kwargs: "",
+        "params": {key.upper(): value for key, value in params.items()},
+        "rawparams": " ".join(f"{key}={value}" for key, value in params.items()),
+    }
+    context.update(macro_variables(section))
+    times: List[float] = []
+    output = ""
+    for _ in range(runs):
+        printer.reset()
+        start = time.perf_counter()
+        try:
+            output = template.render(context)
+        except Exception as err:  # pylint: disable=broad-except
+            error = f"{type(err).__name__}: {err}"
+            return MacroResult(name, compile_ms, 0.0, 0.0, 0, 0, 0, 0, "", error)
+        times.append((time.perf_counter() - start) * 1000)
+    hot = printer.objects.most_common(1)
+    return MacroResult(
+        name,
+        round(compile_ms, 3),
+        round(statistics.median(times), 3),
+        round(max(times), 3),
+        len(output.encode("utf-8")),
+        sum(1 for line in output.splitlines() if line.strip()),
+        printer.counts["lookups"],
+        printer.counts["reads"],
+        f"{hot[0][0]} x{hot[0][1]}" if hot else "",
+        "",
+    )
+
+
+def git_revision() -> Optional[str]:
+    """Get the current printcfg revision."""
+    result = subprocess.run(
+        ["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"],
+        capture_output=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode("utf-8").strip()
+
+
+def previous_results() -> Dict[str, dict]:
+    """Get the last result of each macro from the history file."""
+    previous: Dict[str, dict] = {}
+    if not os.path.exists(HISTORY_FILE):
+        return previous
+    with open(HISTORY_FILE, "r", encoding="utf-8") as history:
+        for line in history:
+            entry = json.loads(line)
+            previous[entry["macro"]] = entry
+    return previous
+
+
+def save_results(results: List[MacroResult], profile: str, runs: int):
+    """Append the results to the history file."""
+    revision = git_revision()
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
+    with open(HISTORY_FILE, "a", encoding="utf-8") as history:
+        for result in results:
+            if result.error:
+                continue
+            entry = {
+                "time": now,
+                "revision": revision,
+                "profile": profile,
+                "runs": runs,
+                "macro": result.name,
+                "median": result.median_ms,
+                "output_bytes": result.output_bytes,
+                "lookups": result.lookups,
+                "reads": result.reads,
+            }
+            history.write(json.dumps(entry) + "\n")
+
+
+def print_results(results: List[MacroResult], previous: Dict[str, dict]):
+    """Print the results table, slowest macro first."""
+    width = max([len("macro")] + [len(result.name) for result in results])
+    print(
+        f"{'macro':<{width}} {'median':>8} {'max':>8} {'previous':>8} "
+        f"{'bytes':>6} {'lookups':>7} {'reads':>6}  hottest object"
+    )
+    for result in results:
+        if result.error:
+            print(f"{result.name:<{width}} \033[31merror: {result.error}\033[0m")
+            continue
+        before = previous.get(result.name)
+        before_text = f"{before['median']:.3f}" if before else "-"
+        print(
+            f"{result.name:<{width}} {result.median_ms:>8.3f} {result.max_ms:>8.3f} "
+            f"{before_text:>8} {result.output_bytes:>6} {result.lookups:>7} "
+            f"{result.reads:>6}  {result.hot_object}"
+        )
+
+
+def load_configs(
+    profile: str, files: List[str], printer_cfg: Optional[str] = None
+) -> Tuple[list, list]:
+    """
+    Parses the printer, the profile and the benchmarked files.
+
+    Args:
+        profile: The name of the profile.
+        files: The benchmarked config files.
+        printer_cfg: The printer.cfg (default: DEFAULT_PRINTER_CFG).
+
+    Returns:
+        The printer and profile files, and the benchmarked files with
+        their includes.
+    """
+    profile_dir = os.path.join(REPO_DIR, "profiles", profile)
+    if printer_cfg:
+        profile_configs = [parse_file(printer_cfg)]
+    else:
+        lines = DEFAULT_PRINTER_CFG.splitlines(keepends=True)
+        profile_configs = [parse_lines(lines, "printer.cfg")]
+    profile_configs += [
+        parse_file(os.path.join(profile_dir, "config.cfg")),
+        parse_file(os.path.join(profile_dir, "variables.cfg")),
+    ]
+    configs: List[ConfigFile] = []
+    for file_name in files:
+        configs += parse_tree(file_name).files
+    return profile_configs, configs
+
+
+def main(argv: List[str]) -> int:
+    """Run the macro render benchmark."""
+    if jinja2 is None:
+        print("Error: jinja2 is required (pip3 install jinja2).")
+        return 1
+    args = argv[1:]
+    profile = "default"
+    runs = DEFAULT_RUNS
+    top = 0
+    macros: List[str] = []
+    params: Dict[str, str] = {}
+    overrides: Dict[str, dict] = {}
+    files: List[str] = []
+    printer_cfg = None
+    try:
+        while args:
+            arg = args.pop(0)
+            if arg == "--profile":
+                profile = args.pop(0)
+            elif arg == "--runs":
+                runs = max(int(args.pop(0)), 1)
+            elif arg == "--top":
+                top = int(args.pop(0))
+            elif arg == "--macro":
+                macros.append(args.pop(0).upper())
+            elif arg == "--param":
+                key, _, value = args.pop(0).partition("=")
+                params[key] = value
+            elif arg == "--printer":
+                printer_cfg = args.pop(0)
+            elif arg == "--state":
+                with open(args.pop(0), "r", encoding="utf-8") as file:
+                    overrides = json.load(file)
+            else:
+                files.append(arg)
+    except (IndexError, ValueError, OSError) as err:
+        print(f"Error: Invalid arguments ({err})")
+        print("Usage: python3 macro_bench.py [options] [config_file ...]")
+        return 1
+    files = files or [os.path.join(REPO_DIR, name) for name in DEFAULT_FILES]
+    try:
+        profile_configs, configs = load_configs(profile, files, printer_cfg)
+    except (OSError, ConfigError) as err:
+        print(f"Error: {err}")
+        return 1
+    printer = MockPrinter(build_status(profile_configs + configs, overrides))
+    env = create_environment()
+    sections = [
+        section
+        for config in configs
+        for section in config.sections
+        if section.kind == "gcode_macro" and "gcode" in section.options
+    ]
+    if macros:
+        sections = [s for s in sections if s.title.upper() in macros]
+    if not sections:
+        print("Error: No macros found.")
+        return 1
+    results = [
+        bench_macro(env, section, printer, params, runs) for section in sections
+    ]
+    results.sort(key=lambda result: (not result.error, -result.median_ms))
+    previous = previous_results()
+    print_results(results[:top] if top else results, previous)
+    save_results(results, profile, runs)
+    total = sum(result.median_ms for result in results)
+    errors = sum(1 for result in results if result.error)
+    print(
+        f"{len(results)} macro(s), {total:.2f} ms in total, {errors} error(s). "
+        f"Times in ms over {runs} runs. History: {HISTORY_FILE}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,658 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script builds the call graph of the printcfg macros and writes a
+# bundle holding only the macros a printer can reach.
+#
+# Each gcode template is scanned for the commands it runs, the macros it
+# references (SET_GCODE_VARIABLE MACRO=, UPDATE_DELAYED_GCODE ID=,
+# printer['gcode_macro ...']) and the _printcfg variables it reads.
+# Commands held in _printcfg variables (Eg: {printcfg.status_ready}) are
+# resolved with the user profile, and calls inside '{% if %}' blocks on
+# _printcfg variables are dropped when the profile turns them off.
+#
+# Variables changed at runtime with SET_GCODE_VARIABLE by a kept macro
+# are not taken from the profile, and the graph is scanned again until
+# the kept macros do not change any more profile-decided variable.
+#
+# The roots are the public macros, the private ones with a description
+# (listed by HELP) or in ENTRY_MACROS, the delayed_gcode started at boot,
+# the macros named by _printcfg variables and the macros called from the
+# user's own config, except the macros of features the profile turns off
+# (see FEATURES). Every macro reachable from a root is kept.
+#
+# Usage:
+#   python3 macro_graph.py [options]
+#
+# Options:
+#   --profile <file>: The user profile (default: user_profile.cfg).
+#   --config <file>: A user config whose macros are roots, with its
+#                    includes (default: printer.cfg, or the config.cfg
+#                    of the profile). Can be repeated.
+#   --keep <macro>: Always keep this macro. Can be repeated.
+#   --output <file>: Write the pruned bundle to this file.
+#   --report: Show the calls and variables of each macro.
+#
+# Example:
+#   python3 macro_graph.py --output ~/printer_data/config/printcfg_bundle.cfg
+
+import ast
+import os
+import re
+import sys
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from klipper_config import (
+    ConfigError,
+    ConfigFile,
+    Section,
+    parse_file,
+    parse_lines,
+    parse_tree,
+)
+from log_setup import get_logger
+from search_replace import read_lines, write_lines_atomic
+
+logger = get_logger("macro_graph")
+
+# Path to the printcfg repo
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Path to the klipper config directory
+CONFIG_DIR = os.path.join(
+    os.environ.get("PRINTCFG_DATA", os.path.expanduser("~/printer_data")), "config"
+)
+# The macro files of the suite, in include order
+MACRO_FILES = ["print_macros.cfg", "print_extras.cfg", "print_debug.cfg"]
+# Section holding the printcfg variables
+VARIABLES_SECTION = "gcode_macro _printcfg"
+# Section types holding a gcode template
+TEMPLATE_KINDS = ("gcode_macro", "delayed_gcode")
+
+# Private macros run from outside the suite (Eg: by a filament sensor)
+ENTRY_MACROS = ("_INSERT_FILAMENT",)
+
+# Features a profile can turn off: the variable, the values turning the
+# feature off and the macros only used by the feature
+FEATURES = {
+    "chamber": ("chamber_type", ("none", ""), ("PREP_CHAMBER", "SET_CHAMBER")),
+    "doors": (
+        "doors",
+        (0, False),
+        ("_door_cfg", "_open_door", "_close_door", "door_debounce"),
+    ),
+    "scrubber": ("use_scrubber", (False,), ("SCRUBBER", "scrub_timer")),
+    "air filter": (
+        "nevermore",
+        (False,),
+        (
+            "RESET_AIR_FILTER",
+            "QUERY_AIR_FILTER",
+            "_AIR_FILTER_TIMER",
+            "_AIR_FILTER_FLUSH_TIMER",
+        ),
+    ),
+}
+
+PRINTCFG_OBJECT = re.compile(r"printer\[\s*['\"]gcode_macro _printcfg['\"]\s*\]")
+# Name the _printcfg object is replaced with before scanning
+PRINTCFG_ALIAS = "__printcfg__"
+STATEMENT = re.compile(r"({%-?.*?-?%})")
+COMMENT = re.compile(r"{#.*?#}")
+MACRO_OBJECT = re.compile(r"printer\[\s*['\"]gcode_macro\s+(\w+)['\"]\s*\]")
+MACRO_ARGUMENT = re.compile(r"\bMACRO=(\w+)", re.IGNORECASE)
+DELAYED_ARGUMENT = re.compile(r"\bUPDATE_DELAYED_GCODE\b.*?\bID=(\w+)", re.IGNORECASE)
+VARIABLE_WRITE = re.compile(
+    r"\bSET_GCODE_VARIABLE\b(?=.*\bMACRO=_printcfg\b).*?\bVARIABLE=(\w+)",
+    re.IGNORECASE,
+)
+COMMAND = re.compile(r"([A-Za-z_][\w.]*)(?![\w{])")
+EXPRESSION_COMMAND = re.compile(r"{\s*(\w+)\.(\w+)\s*}")
+SET_ALIAS = re.compile(rf"set\s+(\w+)\s*=\s*{PRINTCFG_ALIAS}\s*$")
+SET_LOCAL = re.compile(r"set\s+(\w+)\s*=\s*(\w+)\.(\w+)\s*$")
+CONDITION = re.compile(
+    r"(not\s+)?(\w+)(?:\.(\w+))?(?:\s*\|\s*(\w+))?"
+    r"(?:\s*(==|!=|>=|<=|>|<)\s*(.+?))?\s*$"
+)
+FILTERS = {"int": int, "float": float, "string": str, "lower": lambda v: str(v).lower()}
+
+
+class Call(NamedTuple):
+    """A reference from a template to another section."""
+
+    target: str
+    live: bool
+
+
+class Node:
+    """A section with a gcode template and what it references."""
+
+    def __init__(self, key: str, section: Section, file_name: str):
+        self.key = key
+        self.section = section
+        self.file_name = file_name
+        self.calls: List[Call] = []
+        self.reads: Set[str] = set()
+        self.dynamic = False
+        self.external: Set[str] = set()
+        self.writes: Set[str] = set()
+
+
+def section_key(section: Section) -> str:
+    """Get the graph key of a section (macro names are not case sensitive)."""
+    if section.kind == "gcode_macro":
+        return f"gcode_macro {section.title.upper()}"
+    return section.name
+
+
+def profile_variables(config: ConfigFile) -> Dict[str, Any]:
+    """Get the _printcfg variables of a user profile."""
+    section = config.section(VARIABLES_SECTION)
+    variables: Dict[str, Any] = {}
+    if section is None:
+        return variables
+    for name, option in section.options.items():
+        if name.startswith("variable_"):
+            try:
+                value = ast.literal_eval(option.value)
+            except (ValueError, SyntaxError):
+                value = option.value
+            variables[name[len("variable_") :]] = value
+    return variables
+
+
+def _value(text: str) -> Any:
+    """Evaluate the right side of a comparison, None when it is not a literal."""
+    try:
+        return ast.literal_eval(text.strip())
+    except (ValueError, SyntaxError):
+        return None
+
+
+def evaluate(
+    condition: str, aliases: Set[str], local: Dict[str, str], variables: Dict[str, Any]
+) -> Optional[bool]:
+    """
+    Evaluates a template condition against the profile, when it can be.
+
+    Args:
+        condition: The condition of an if or elif.
+        aliases: The names of the _printcfg object in the template.
+        local: Template variables set from a _printcfg variable.
+        variables: The _printcfg variables of the profile.
+
+    Returns:
+        The value of the condition, or None when it depends on anything
+        else than the profile (parameters, printer state).
+    """
+    if "(" in condition:
+        return None
+    if " or " in condition:
+        parts = [
+            evaluate(part, aliases, local, variables)
+            for part in condition.split(" or ")
+        ]
+        if any(part is True for part in parts):
+            return True
+        return False if all(part is False for part in parts) else None
+    if " and " in condition:
+        parts = [
+            evaluate(part, aliases, local, variables)
+            for part in condition.split(" and ")
+        ]
+        if any(part is False for part in parts):
+            return False
+        return True if all(part is True for part in parts) else None
+    match = CONDITION.match(condition.strip())
+    if match is None:
+        return None
+    negate, name, attribute, filter_name, operator, right = match.groups()
+    if attribute is not None and name in aliases:
+        variable = attribute
+    elif attribute is None and name in local:
+        variable = local[name]
+    else:
+        return None
+    if variable not in variables:
+        return None
+    value = variables[variable]
+    try:
+        if filter_name:
+            if filter_name not in FILTERS:
+                return None
+            value = FILTERS[filter_name](value)
+        if operator:
+            other = _value(right)
+            if other is None and right.strip() != "None":
+                return None
+            result = {
+                "==": lambda: value == other,
+                "!=": lambda: value != other,
+                ">=": lambda: value >= other,
+                "<=": lambda: value <= other,
+                ">": lambda: value > other,
+                "<": lambda: value < other,
+            }[operator]()
+        else:
+            result = bool(value)
+    except (TypeError, ValueError):
+        return None
+    return not result if negate else bool(result)
+
+
+class _Branches:
+    """The state of an if block while scanning a template."""
+
+    def __init__(self, current: Optional[bool]):
+        self.current = current
+        self.taken = current is True
+        self.all_false = current is False
+
+    def branch(self, current: Optional[bool]):
+        """Move to an elif (or an else, with current=True)."""
+        if self.taken:
+            self.current = False
+            return
+        self.current = current
+        self.taken = current is True
+        self.all_false = self.all_false and current is False
+
+
+def scan_node(node: Node, variables: Dict[str, Any], keys: Dict[str, str]):
+    """
+    Scans the template of a section for its calls and variable reads.
+
+    Args:
+        node: The node to fill in.
+        variables: The _printcfg variables of the profile.
+        keys: The graph key of every section, by lowercase name and by
+              uppercase macro name.
+    """
+    node.calls, node.reads, node.external, node.writes = [], set(), set(), set()
+    node.dynamic = False
+    aliases = {PRINTCFG_ALIAS}
+    local: Dict[str, str] = {}
+    stack: List[_Branches] = []
+
+    def live() -> bool:
+        return all(frame.current is not False for frame in stack)
+
+    def call(name: str, kind: str = "gcode_macro"):
+        key = keys.get(f"{kind} {name.upper() if kind == 'gcode_macro' else name}")
+        if key is None:
+            node.external.add(name)
+        elif key != node.key:
+            node.calls.append(Call(key, live()))
+
+    def read(text: str):
+        for alias in aliases:
+            for match in re.finditer(rf"\b{alias}\.(\w+)", text):
+                node.reads.add(match.group(1))
+            for match in re.finditer(rf"\b{alias}\[\s*(.)", text):
+                quoted = re.match(r"['\"](\w+)['\"]\s*\]", text[match.start(1) :])
+                if quoted:
+                    node.reads.add(quoted.group(1))
+                else:
+                    node.dynamic = True
+
+    for raw in (node.section.get("gcode") or "").split("\n"):
+        line = COMMENT.sub("", PRINTCFG_OBJECT.sub(PRINTCFG_ALIAS, raw))
+        command_seen = False
+        for part in STATEMENT.split(line):
+            if not part:
+                continue
+            for name in MACRO_OBJECT.findall(part):
+                call(name)
+            read(part)
+            if part.startswith("{%"):
+                statement = part.strip("{%-} \t")
+                word = statement.split(None, 1)[0] if statement else ""
+                condition = statement[len(word) :].strip()
+                if word == "if":
+                    value = evaluate(condition, aliases, local, variables)
+                    stack.append(_Branches(value))
+                elif word == "elif" and stack:
+                    stack[-1].branch(evaluate(condition, aliases, local, variables))
+                elif word == "else" and stack:
+                    stack[-1].branch(True)
+                elif word == "endif" and stack:
+                    stack.pop()
+                elif word == "set":
+                    alias = SET_ALIAS.match(statement)
+                    if alias:
+                        aliases.add(alias.group(1))
+                    source = SET_LOCAL.match(statement)
+                    if source and source.group(2) in aliases:
+                        local[source.group(1)] = source.group(3)
+                continue
+            text = part.strip()
+            if not text:
+                continue
+            for name in MACRO_ARGUMENT.findall(text):
+                call(name)
+            for name in DELAYED_ARGUMENT.findall(text):
+                call(name, "delayed_gcode")
+            node.writes.update(name.lower() for name in VARIABLE_WRITE.findall(text))
+            if command_seen:
+                continue
+            command_seen = True
+            expression = EXPRESSION_COMMAND.match(text)
+            if expression and expression.group(1) in aliases:
+                value = variables.get(expression.group(2))
+                if isinstance(value, str) and value.split():
+                    call(value.split()[0])
+                continue
+            command = COMMAND.match(text)
+            if command:
+                call(command.group(1))
+
+
+class MacroGraph:
+    """The sections of the macro files and the references between them."""
+
+    def __init__(self):
+        self.files: List[ConfigFile] = []
+        self.lines: Dict[str, List[str]] = {}
+        self.nodes: Dict[str, Node] = {}
+        self.keys: Dict[str, str] = {}
+
+    def load(self, file_names: List[str]):
+        """Parse the macro files and their includes."""
+        for file_name in file_names:
+            for config in parse_tree(file_name, self._parse).files:
+                if any(loaded.path == config.path for loaded in self.files):
+                    continue
+                self.files.append(config)
+                for section in config.sections:
+                    if section.kind in TEMPLATE_KINDS:
+                        key = section_key(section)
+                        self.nodes[key] = Node(key, section, config.path)
+                        self.keys[key] = key
+
+    def _parse(self, file_name: str) -> ConfigFile:
+        """Parse a file, keeping its lines for the bundle."""
+        lines = read_lines(file_name)
+        self.lines[file_name] = lines
+        return parse_lines(lines, file_name)
+
+    def scan(self, variables: Dict[str, Any]):
+        """Scan every template against the profile."""
+        for node in self.nodes.values():
+            scan_node(node, variables, self.keys)
+
+    def reachable(self, roots: Set[str]) -> Set[str]:
+        """Get the sections reachable from the roots through live calls."""
+        seen: Set[str] = set()
+        pending = [root for root in roots if root in self.nodes]
+        while pending:
+            key = pending.pop()
+            if key in seen:
+                continue
+            seen.add(key)
+            pending += [c.target for c in self.nodes[key].calls if c.live]
+        return seen
+
+
+def disabled_macros(variables: Dict[str, Any]) -> Dict[str, str]:
+    """Get the macros of the features the profile turns off, with the feature."""
+    disabled: Dict[str, str] = {}
+    for feature, (variable, off_values, macros) in FEATURES.items():
+        value = variables.get(variable)
+        if isinstance(value, str):
+            value = value.lower()
+        if variable in variables and value in off_values:
+            for macro in macros:
+                disabled[macro.upper()] = feature
+    return disabled
+
+
+def user_nodes(graph: MacroGraph, configs: List[ConfigFile]) -> List[Node]:
+    """Get the templates of the user configs, without the suite's own files."""
+    own = {os.path.realpath(config.path) for config in graph.files}
+    nodes = []
+    for config in configs:
+        if os.path.realpath(config.path) in own:
+            continue
+        for section in config.sections:
+            if "gcode" in section.options or section.kind in TEMPLATE_KINDS:
+                nodes.append(Node(section.name, section, config.path))
+    return nodes
+
+
+def find_roots(
+    graph: MacroGraph,
+    variables: Dict[str, Any],
+    users: List[Node],
+    keep: List[str],
+) -> Set[str]:
+    """
+    Gets the sections a printer can run directly.
+
+    Args:
+        graph: The macro graph.
+        variables: The _printcfg variables decided by the profile.
+        users: The scanned templates of the user configs.
+        keep: Macros to keep in any case.
+
+    Returns:
+        The keys of the root sections.
+    """
+    disabled = disabled_macros(variables)
+    roots: Set[str] = set()
+    for key, node in graph.nodes.items():
+        section = node.section
+        if section.title.upper() in disabled:
+            continue
+        if section.kind == "gcode_macro" and (
+            not section.title.startswith("_")
+            or "description" in section.options
+            or section.title.upper() in ENTRY_MACROS
+        ):
+            roots.add(key)
+        elif section.kind == "delayed_gcode":
+            try:
+                if float(section.get("initial_duration", "0")) > 0:
+                    roots.add(key)
+            except ValueError:
+                roots.add(key)
+    # Macros named by variables are run from the user's own macros
+    for value in variables.values():
+        if isinstance(value, str) and value.split():
+            key = graph.keys.get(f"gcode_macro {value.split()[0].upper()}")
+            if key is not None:
+                roots.add(key)
+    for node in users:
+        roots.update(call.target for call in node.calls if call.live)
+    for node in users:
+        # A user macro of the same name replaces the suite's one
+        roots.discard(section_key(node.section))
+    for name in keep:
+        roots.add(graph.keys.get(f"gcode_macro {name.upper()}", name))
+    return roots
+
+
+def analyze(
+    graph: MacroGraph,
+    variables: Dict[str, Any],
+    configs: List[ConfigFile],
+    keep: List[str],
+) -> Tuple[Set[str], Set[str]]:
+    """
+    Finds the sections to keep for a profile.
+
+    Args:
+        graph: The macro graph.
+        variables: The _printcfg variables of the profile.
+        configs: The user configs, their templates call into the graph.
+        keep: Macros to keep in any case.
+
+    Returns:
+        The keys of the kept sections and the variables changed at runtime.
+    """
+    users = user_nodes(graph, configs)
+    runtime: Set[str] = set()
+    while True:
+        decided = {k: v for k, v in variables.items() if k not in runtime}
+        graph.scan(decided)
+        for node in users:
+            scan_node(node, decided, graph.keys)
+        kept = graph.reachable(find_roots(graph, decided, users, keep))
+        writes = set().union(
+            *(node.writes for node in users),
+            *(graph.nodes[key].writes for key in kept),
+        )
+        if writes <= runtime:
+            return kept, runtime
+        runtime |= writes
+
+
+def write_bundle(graph: MacroGraph, kept: Set[str], output: str) -> int:
+    """
+    Writes the kept sections into a single config file.
+
+    Args:
+        graph: The macro graph.
+        kept: The keys of the sections to keep.
+        output: The bundle file.
+
+    Returns:
+        The number of lines written.
+    """
+    lines = [
+        "## printcfg macro bundle, generated by macro_graph.py\n",
+        f"## {time.strftime('%Y-%m-%d %H:%M:%S')}: {len(kept)} sections\n",
+        "## Do not edit: changes are lost when the bundle is generated again.\n",
+    ]
+    for config in graph.files:
+        source = graph.lines[config.path]
+        lines.append(f"\n## From {os.path.relpath(config.path, REPO_DIR)}\n")
+        for section in config.sections:
+            if section.kind in TEMPLATE_KINDS and section_key(section) not in kept:
+                continue
+            lines.append("\n")
+            lines += source[section.start - 1 : section.end]
+    if not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    write_lines_atomic(output, lines)
+    return len(lines)
+
+
+def print_report(graph: MacroGraph, kept: Set[str]):
+    """Print the calls and variable reads of each section."""
+    for key, node in graph.nodes.items():
+        state = "\033[32mkept  \033[0m" if key in kept else "\033[33mpruned\033[0m"
+        print(f"{state} {key}")
+        calls = sorted({c.target for c in node.calls if c.live})
+        dead = sorted({c.target for c in node.calls if not c.live} - set(calls))
+        if calls:
+            print(f"         calls: {', '.join(calls)}")
+        if dead:
+            print(f"         off in profile: {', '.join(dead)}")
+        if node.reads or node.dynamic:
+            dynamic = " (+ dynamic)" if node.dynamic else ""
+            print(f"         reads: {', '.join(sorted(node.reads))}{dynamic}")
+
+
+def main(argv: List[str]) -> int:
+    """Analyze the macro graph and write a pruned bundle."""
+    args = argv[1:]
+    profile = os.path.join(CONFIG_DIR, "user_profile.cfg")
+    config_files: List[str] = []
+    keep: List[str] = []
+    output = None
+    report = False
+    try:
+        while args:
+            arg = args.pop(0)
+            if arg == "--profile":
+                profile = args.pop(0)
+            elif arg == "--config":
+                config_files.append(args.pop(0))
+            elif arg == "--keep":
+                keep.append(args.pop(0))
+            elif arg == "--output":
+                output = args.pop(0)
+            elif arg == "--report":
+                report = True
+            else:
+                raise ValueError(arg)
+    except (IndexError, ValueError) as err:
+        print(f"Error: Invalid argument {err}")
+        print(
+            "Usage: python3 macro_graph.py [--profile <file>] [--config <file>] "
+            "[--keep <macro>] [--output <file>] [--report]"
+        )
+        return 1
+    if not os.path.exists(profile):
+        profile = os.path.join(REPO_DIR, "profiles", "default", "variables.cfg")
+    if not config_files and os.path.exists(os.path.join(CONFIG_DIR, "printer.cfg")):
+        config_files = [os.path.join(CONFIG_DIR, "printer.cfg")]
+    graph = MacroGraph()
+    try:
+        graph.load([os.path.join(REPO_DIR, name) for name in MACRO_FILES])
+        profile_config = parse_lines(read_lines(profile), profile)
+        variables = profile_variables(profile_config)
+        configs = [config for name in config_files for config in parse_tree(name).files]
+        if not config_files:
+            # No printer.cfg: use the user config of the profile
+            marker = profile_config.marker("Profile")
+            name = marker.value if marker and marker.value else "default"
+            user_config = os.path.join(REPO_DIR, "profiles", name, "config.cfg")
+            configs = [parse_file(user_config)]
+    except (OSError, ConfigError) as err:
+        print(f"\033[31mError: {err}\033[0m")
+        logger.error("Macro graph failed: %s", err)
+        return 1
+    kept, runtime = analyze(graph, variables, configs, keep)
+    if report:
+        print_report(graph, kept)
+    total_lines = sum(
+        node.section.end - node.section.start + 1 for node in graph.nodes.values()
+    )
+    kept_lines = sum(
+        node.section.end - node.section.start + 1
+        for key, node in graph.nodes.items()
+        if key in kept
+    )
+    print(
+        f"Profile {profile}: keeping {len(kept)} of {len(graph.nodes)} sections "
+        f"({kept_lines} of {total_lines} template lines)."
+    )
+    decided = {k: v for k, v in variables.items() if k not in runtime}
+    for feature in sorted(set(disabled_macros(decided).values())):
+        print(f"  {feature}: off")
+    if output:
+        try:
+            written = write_bundle(graph, kept, output)
+        except OSError as err:
+            print(f"\033[31mError: {err}\033[0m")
+            logger.error("Could not write the macro bundle: %s", err)
+            return 1
+        print(f"\033[32mWrote {output} ({written} lines).\033[0m")
+        print("Include it in place of the printcfg macro files to use it.")
+        logger.info("Wrote macro bundle %s with %s sections", output, len(kept))
+    return 0
+
+
+def cmd_bundle(args: List[str]) -> bool:
+    """Run the analyzer from the printcfg CLI."""
+    return main(["macro_graph.py"] + args) == 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
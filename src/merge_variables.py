@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script merges a profile update into the user profile, variable by variable.
+# The variables of the [gcode_macro _printcfg] section are compared between
+# the old shipped variables.cfg (base), the new shipped variables.cfg (new)
+# and the user profile (user):
+#
+#   - Values the user changed are kept.
+#   - Values only changed by the update are updated.
+#   - Variables added by the update are inserted after the variable that
+#     precedes them in the new file, with their comments.
+#   - Variables removed by the update are removed.
+#   - Variables the user added are kept.
+#   - Variables the user deleted are not added back.
+#   - Variables changed differently by both are conflicts: the user value
+#     is kept and the conflict is reported.
+#
+# The layout and comments of the user profile are kept, and the
+# '# Patch:' marker is set to the one of the new file.
+#
+# Usage:
+#   python3 merge_variables.py [--check] <base> <new> <user>
+#   python3 merge_variables.py [--check] --base-rev <git_rev> <new> <user>
+#
+# Options:
+#   --check: Show the merge result without writing the user profile.
+#   --base-rev: Read the base from the printcfg repo at a git revision
+#               (Eg: ORIG_HEAD after a git pull).
+#
+# Example:
+#   python3 merge_variables.py --base-rev ORIG_HEAD \
+#       ~/printcfg/profiles/default/variables.cfg \
+#       ~/printer_data/config/user_profile.cfg
+
+import os
+import subprocess
+import sys
+from typing import Dict, List, NamedTuple, Optional
+
+from klipper_config import ConfigFile, Option, parse_lines
+from log_setup import get_logger
+from search_replace import read_lines, write_lines_atomic
+
+logger = get_logger("merge_variables")
+
+# Section holding the printcfg variables
+VARIABLES_SECTION = "gcode_macro _printcfg"
+# Prefix of the variable options
+VARIABLE_PREFIX = "variable_"
+
+
+class Conflict(NamedTuple):
+    """A variable changed differently by the update and by the user."""
+
+    name: str
+    base: Optional[str]
+    new: Optional[str]
+    user: str
+    resolution: str
+
+
+class MergeResult(NamedTuple):
+    """The merged user profile and what changed."""
+
+    lines: List[str]
+    updated: List[str]
+    added: List[str]
+    removed: List[str]
+    kept: List[str]
+    conflicts: List[Conflict]
+
+
+def variables(config: ConfigFile, section_name: str) -> Dict[str, Option]:
+    """Get the variables of a section, in file order."""
+    section = config.section(section_name)
+    if section is None:
+        return {}
+    return {
+        name: option
+        for name, option in section.options.items()
+        if name.startswith(VARIABLE_PREFIX)
+    }
+
+
+def _chunks(lines: List[str], config: ConfigFile, section_name: str) -> Dict[str, list]:
+    """
+    Get the lines of each variable of a section, with the comment
+    and blank lines between it and the option before it.
+    """
+    section = config.section(section_name)
+    chunks: Dict[str, list] = {}
+    if section is None:
+        return chunks
+    previous_end = section.start
+    for name, option in section.options.items():
+        if name.startswith(VARIABLE_PREFIX):
+            chunks[name] = lines[previous_end : option.end]
+        previous_end = option.end
+    return chunks
+
+
+def merge_lines(
+    base_lines: List[str],
+    new_lines: List[str],
+    user_lines: List[str],
+    section_name: str = VARIABLES_SECTION,
+) -> MergeResult:
+    """
+    Merges the variables of a profile update into the user profile.
+
+    Args:
+        base_lines: The lines of the old shipped variables file.
+        new_lines: The lines of the new shipped variables file.
+        user_lines: The lines of the user profile.
+        section_name: The section holding the variables.
+
+    Returns:
+        The merged lines and the merge report.
+    """
+    base_config = parse_lines(base_lines, "base")
+    new_config = parse_lines(new_lines, "new")
+    user_config = parse_lines(user_lines, "user")
+    base = variables(base_config, section_name)
+    new = variables(new_config, section_name)
+    user = variables(user_config, section_name)
+    new_chunks = _chunks(new_lines, new_config, section_name)
+
+    # Anchor each added variable to the variable before it in the new file
+    pending: Dict[Optional[str], List[str]] = {}
+    anchor: Optional[str] = None
+    for name in new:
+        if name in user:
+            anchor = name
+        elif name not in base:
+            pending.setdefault(anchor, []).append(name)
+
+    result = MergeResult([], [], [], [], [], [])
+    starts = {option.start: name for name, option in user.items()}
+    section = user_config.section(section_name)
+    line_no = 0
+    while line_no < len(user_lines):
+        line_no += 1
+        line = user_lines[line_no - 1]
+        name = starts.get(line_no)
+        if name is None:
+            result.lines.append(line)
+            if section is not None and line_no == section.start:
+                _insert(result, pending.pop(None, []), new_chunks)
+            continue
+        option = user[name]
+        option_lines = user_lines[option.start - 1 : option.end]
+        line_no = option.end
+        user_value = option.value
+        base_value = base[name].value if name in base else None
+        if name not in new:
+            if base_value is None:
+                result.lines.extend(option_lines)
+                continue
+            # Removed by the update
+            result.removed.append(name)
+            if user_value != base_value:
+                result.conflicts.append(
+                    Conflict(name, base_value, None, user_value, "removed")
+                )
+            continue
+        new_value = new[name].value
+        if user_value == new_value:
+            result.lines.extend(option_lines)
+        elif base_value is not None and user_value == base_value:
+            result.lines.extend(new_lines[new[name].start - 1 : new[name].end])
+            result.updated.append(name)
+        elif base_value is not None and new_value == base_value:
+            result.lines.extend(option_lines)
+            result.kept.append(name)
+        else:
+            result.lines.extend(option_lines)
+            result.conflicts.append(
+                Conflict(name, base_value, new_value, user_value, "kept user value")
+            )
+        _insert(result, pending.pop(name, []), new_chunks)
+    # Added variables that could not be anchored go before gcode
+    for names in pending.values():
+        _insert(result, names, new_chunks, before_gcode=True)
+    _update_patch_marker(result.lines, new_config)
+    return result
+
+
+def new_variables(
+    patch_lines: List[str],
+    user_lines: List[str],
+    section_name: str = VARIABLES_SECTION,
+) -> List[str]:
+    """
+    Drops the variables the user profile already has from a variables patch.
+
+    Args:
+        patch_lines: The lines of the patch (options of the section, without
+                     the section header).
+        user_lines: The lines of the user profile.
+        section_name: The section holding the variables.
+
+    Returns:
+        The lines of the patch without those variables and their comments,
+        or no lines when no variable is left.
+    """
+    lines = [f"[{section_name}]\n"] + patch_lines
+    section = parse_lines(lines, "patch").section(section_name)
+    if section is None:
+        return list(patch_lines)
+    user = variables(parse_lines(user_lines, "user"), section_name)
+    kept: List[str] = []
+    previous_end = section.start
+    for name, option in section.options.items():
+        if name in user:
+            logger.info("Not adding %s: the user profile has it", name)
+        else:
+            kept.extend(lines[previous_end : option.end])
+        previous_end = option.end
+    if not kept:
+        return []
+    kept.extend(lines[previous_end:])
+    return kept
+
+
+def _insert(
+    result: MergeResult,
+    names: List[str],
+    chunks: Dict[str, list],
+    before_gcode: bool = False,
+):
+    """Insert added variables with their comments."""
+    if not names:
+        return
+    added: List[str] = []
+    for name in names:
+        added.extend(chunks[name])
+        result.added.append(name)
+    if added and not added[-1].endswith("\n"):
+        added[-1] += "\n"
+    if not before_gcode:
+        result.lines.extend(added)
+        return
+    merged = parse_lines(result.lines)
+    section = merged.section(VARIABLES_SECTION)
+    if section is not None and "gcode" in section.options:
+        at = section.options["gcode"].start - 1
+    else:
+        at = len(result.lines)
+    result.lines[at:at] = added
+
+
+def _update_patch_marker(lines: List[str], new_config: ConfigFile):
+    """Set the '# Patch:' marker of the user profile to the new version."""
+    new_marker = new_config.marker("Patch")
+    if new_marker is None:
+        return
+    marker = parse_lines(lines).marker("Patch")
+    if marker is None or marker.value == new_marker.value:
+        return
+    line = lines[marker.line - 1]
+    lines[marker.line - 1] = line.replace(marker.value, new_marker.value, 1)
+
+
+def git_show(repo_dir: str, rev: str, path: str) -> List[str]:
+    """
+    Reads a file of the printcfg repo at a git revision.
+
+    Args:
+        repo_dir: The printcfg repo directory.
+        rev: The git revision.
+        path: The file, inside the repo.
+
+    Returns:
+        The lines of the file at that revision.
+    """
+    toplevel = subprocess.run(
+        ["git", "-C", repo_dir, "rev-parse", "--show-toplevel"],
+        capture_output=True,
+        check=True,
+    ).stdout.decode("utf-8")
+    relative = os.path.relpath(os.path.realpath(path), toplevel.strip())
+    content = subprocess.run(
+        ["git", "-C", repo_dir, "show", f"{rev}:{relative}"],
+        capture_output=True,
+        check=True,
+    ).stdout.decode("utf-8")
+    return content.splitlines(keepends=True)
+
+
+def print_report(result: MergeResult):
+    """Print what the merge changed."""
+    for label, names in (
+        ("Updated", result.updated),
+        ("Added", result.added),
+        ("Removed", result.removed),
+        ("Kept user value", result.kept),
+    ):
+        for name in names:
+            print(f"  {label}: {name}")
+    for conflict in result.conflicts:
+        print(
+            f"\033[33m  Conflict: {conflict.name} "
+            f"(base: {conflict.base}, new: {conflict.new}, user: {conflict.user})"
+            f" - {conflict.resolution}\033[0m"
+        )
+
+
+def main(argv: List[str]) -> int:
+    """Merge a profile update into the user profile."""
+    check = "--check" in argv
+    args = [arg for arg in argv[1:] if arg != "--check"]
+    base_rev = None
+    if len(args) == 4 and args[0] == "--base-rev":
+        base_rev = args[1]
+        args = args[2:]
+    if len(args) != (2 if base_rev else 3):
+        print(
+            "Usage: python3 merge_variables.py [--check] <base> <new> <user>\n"
+            "       python3 merge_variables.py [--check] --base-rev <rev> <new> <user>"
+        )
+        return 1
+    try:
+        if base_rev:
+            new_file, user_file = args
+            repo_dir = os.path.dirname(os.path.realpath(new_file))
+            base_lines = git_show(repo_dir, base_rev, new_file)
+        else:
+            base_file, new_file, user_file = args
+            base_lines = read_lines(base_file)
+        result = merge_lines(base_lines, read_lines(new_file), read_lines(user_file))
+    except (OSError, subprocess.CalledProcessError) as err:
+        print(f"\033[31mMerge failed: {err}\033[0m")
+        logger.error("Merge failed: %s", err)
+        return 1
+    print_report(result)
+    changes = len(result.updated) + len(result.added) + len(result.removed)
+    if not check and result.lines != read_lines(user_file):
+        write_lines_atomic(user_file, result.lines)
+        logger.info("Merged %s into %s", new_file, user_file)
+    verb = "would change" if check else "changed"
+    print(
+        f"\033[32mMerge {verb} {changes} variable(s), "
+        f"{len(result.conflicts)} conflict(s).\033[0m"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script writes minified copies of the printcfg macro files.
+# The files are rewritten from what Klipper's config parser keeps of them,
+# so the result is loaded the same way:
+#
+#   - Comments and blank lines are removed (Klipper skips them).
+#   - Option lines lose their indentation (Klipper strips every line).
+#   - Whitespace inside Jinja tags is collapsed, outside of strings.
+#   - Lines holding only Jinja statements are joined together.
+#   - variable_* values are written the way ast.literal_eval reads them.
+#
+# With --verify, every macro of the original and minified files is
+# rendered against the mock printer of macro_bench.py, and the G-code
+# Klipper would run (lines stripped, ';' comments and empty lines
+# removed) must be identical. A macro that fails to render (Eg: it needs
+# a parameter or a printer object the mock printer lacks) is reported
+# as unverified: give it values with --param and --state.
+#
+# Usage:
+#   python3 minify_macros.py [--output <dir>] [--verify] [config_file ...]
+#
+# Options:
+#   --output <dir>: Where the minified files are written (repo/minified).
+#   --verify: Check the minified macros render the same G-code.
+#   --profile <name>: The profile of the mock printer for --verify.
+#   --param <[MACRO:]NAME=VALUE>: A macro parameter for --verify, for every
+#                                 macro or for one macro (can be repeated).
+#   --state <file>: A JSON file of printer status values for --verify
+#                   (Eg: {"extruder": {"target": 210}}).
+#
+# Example:
+#   python3 minify_macros.py --verify
+#   Then include printcfg/minified/print_macros.cfg instead of
+#   printcfg/print_macros.cfg.
+
+import ast
+import json
+import os
+import re
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from klipper_config import ConfigError, ConfigFile, parse_file, parse_lines, parse_tree
+from log_setup import get_logger
+from search_replace import write_lines_atomic
+
+logger = get_logger("minify_macros")
+
+# Path to the printcfg repo
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Where the minified files are written by default
+OUTPUT_DIR = os.path.join(REPO_DIR, "minified")
+# The macro files of the suite
+MACRO_FILES = ["print_macros.cfg", "print_extras.cfg", "print_debug.cfg"]
+# Prefix of the macro variables
+VARIABLE_PREFIX = "variable_"
+
+STATEMENT_LINE = re.compile(r"^(?:{%.*?%}\s*)+$")
+JINJA_COMMENT = re.compile(r"{#.*?#}")
+
+
+def _tag_end(text: str, start: int, statement: bool) -> int:
+    """Find the end of the Jinja tag at start, -1 when it is not closed."""
+    quote = ""
+    depth = 0
+    i = start + (2 if statement else 1)
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == "\\":
+                i += 1
+            elif char == quote:
+                quote = ""
+        elif char in "'\"":
+            quote = char
+        elif statement and text.startswith("%}", i):
+            return i + 2
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            if depth == 0 and not statement:
+                return i + 1
+            depth -= 1
+        i += 1
+    return -1
+
+
+def _collapse(tag: str) -> str:
+    """Collapse the whitespace of a Jinja tag, outside of strings."""
+    out: List[str] = []
+    quote = ""
+    escaped = False
+    for char in tag:
+        if quote:
+            out.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = ""
+        elif char in "'\"":
+            quote = char
+            out.append(char)
+        elif char.isspace():
+            if out and out[-1] != " ":
+                out.append(" ")
+        else:
+            out.append(char)
+    return "".join(out)
+
+
+def collapse_tags(line: str) -> str:
+    """
+    Collapses the whitespace inside the Jinja tags of a template line.
+
+    Args:
+        line: The template line.
+
+    Returns:
+        The line, text outside of the tags unchanged.
+    """
+    out: List[str] = []
+    i = 0
+    while i < len(line):
+        if line[i] != "{" or line.startswith("{#", i):
+            out.append(line[i])
+            i += 1
+            continue
+        statement = line.startswith("{%", i)
+        end = _tag_end(line, i, statement)
+        if end < 0:
+            out.append(line[i:])
+            break
+        out.append(_collapse(line[i:end]))
+        i = end
+    return "".join(out)
+
+
+def minify_template(value: str) -> List[str]:
+    """
+    Minifies a gcode template.
+
+    Args:
+        value: The template, as parsed (comments and blank lines removed).
+
+    Returns:
+        The minified template lines.
+    """
+    lines: List[str] = []
+    joinable = False
+    for line in value.split("\n"):
+        line = collapse_tags(JINJA_COMMENT.sub("", line)).strip()
+        if not line:
+            continue
+        statements = STATEMENT_LINE.match(line) is not None
+        if statements:
+            line = re.sub(r"%}\s+{%", "%}{%", line)
+        if statements and joinable:
+            lines[-1] += line
+        else:
+            lines.append(line)
+        joinable = statements
+    return lines
+
+
+def normalize_variable(value: str) -> str:
+    """Write a macro variable the way Klipper reads it."""
+    try:
+        return repr(ast.literal_eval(value))
+    except (ValueError, SyntaxError):
+        return value
+
+
+def minify_config(config: ConfigFile, source: str) -> List[str]:
+    """
+    Rewrites a parsed config file without anything Klipper ignores.
+
+    Args:
+        config: The parsed file.
+        source: The name of the original file, for the header.
+
+    Returns:
+        The lines of the minified file.
+    """
+    lines = [f"# Minified from {source} by minify_macros.py, do not edit\n"]
+    items: List[Tuple[int, object]] = [(inc.line, inc) for inc in config.includes]
+    items += [(section.start, section) for section in config.sections]
+    for _, item in sorted(items, key=lambda pair: pair[0]):
+        if not hasattr(item, "options"):
+            lines.append(f"[include {item.pattern}]\n")
+            continue
+        lines.append(f"[{item.name}]\n")
+        for name, option in item.options.items():
+            if name == "gcode":
+                template = minify_template(option.value)
+                lines.append("gcode:\n")
+                lines += [f" {line}\n" for line in template]
+                continue
+            if name.startswith(VARIABLE_PREFIX) and "\n" not in option.value:
+                lines.append(f"{name}: {normalize_variable(option.value)}\n")
+                continue
+            first, *rest = option.value.split("\n")
+            lines.append(f"{name}: {first}\n" if first else f"{name}:\n")
+            lines += [f" {line}\n" for line in rest]
+    return lines
+
+
+def minify_files(
+    file_names: List[str], output_dir: str
+) -> List[Tuple[ConfigFile, ConfigFile]]:
+    """
+    Writes minified copies of config files and the files they include.
+
+    Args:
+        file_names: The config files.
+        output_dir: The directory of the copies, with the same layout.
+
+    Returns:
+        The original and minified parsed files.
+    """
+    done: Dict[str, Tuple[ConfigFile, ConfigFile]] = {}
+    for file_name in file_names:
+        base_dir = os.path.dirname(os.path.abspath(file_name))
+        for config in parse_tree(file_name).files:
+            path = os.path.abspath(config.path)
+            if path in done:
+                continue
+            relative = os.path.relpath(path, base_dir)
+            if relative.startswith(".."):
+                raise ConfigError(f"{path} is outside of {base_dir}")
+            target = os.path.join(output_dir, relative)
+            lines = minify_config(config, relative)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            write_lines_atomic(target, lines)
+            done[path] = (config, parse_lines(lines, target))
+            logger.info("Minified %s to %s", path, target)
+    return list(done.values())
+
+
+def gcode_commands(output: str) -> List[str]:
+    """Get the commands Klipper runs from a rendered template."""
+    commands = []
+    for line in output.split("\n"):
+        line = line.strip()
+        position = line.find(";")
+        if position >= 0:
+            line = line[:position].strip()
+        if line:
+            commands.append(line)
+    return commands
+
+
+class Verification(NamedTuple):
+    """The outcome of rendering the original and minified macros."""
+
+    problems: List[str]
+    unverified: List[str]
+    verified: int
+
+
+def macro_params(params: Dict[str, str], macro: str) -> Dict[str, str]:
+    """
+    Get the parameters of a macro.
+
+    Args:
+        params: The parameters, as NAME or MACRO:NAME keys.
+        macro: The name of the macro.
+
+    Returns:
+        The parameters for every macro, then those for this macro.
+    """
+    result = {key: value for key, value in params.items() if ":" not in key}
+    for key, value in params.items():
+        name, _, param = key.rpartition(":")
+        if name and name.upper() == macro.upper():
+            result[param] = value
+    return result
+
+
+def verify(
+    pairs: List[Tuple[ConfigFile, ConfigFile]],
+    profile: str,
+    params: Dict[str, str],
+    overrides: Optional[Dict[str, dict]] = None,
+) -> Verification:
+    """
+    Renders every macro of the original and minified files.
+
+    Args:
+        pairs: The original and minified parsed files.
+        profile: The profile of the mock printer.
+        params: The macro parameters, as NAME or MACRO:NAME keys.
+        overrides: Status values of the mock printer.
+
+    Returns:
+        The differences found (empty when the files are equivalent), the
+        macros that could not be rendered and the number of macros that
+        rendered the same G-code.
+    """
+    # pylint: disable=import-outside-toplevel
+    import macro_bench
+
+    if macro_bench.jinja2 is None:
+        return Verification(
+            ["jinja2 is required to verify (pip3 install jinja2)."], [], 0
+        )
+    profile_configs, _ = macro_bench.load_configs(profile, [])
+    originals = [original for original, _ in pairs]
+    status = macro_bench.build_status(profile_configs + originals, overrides)
+    env = macro_bench.create_environment()
+    problems: List[str] = []
+    unverified: List[str] = []
+    verified = 0
+    for original, minified in pairs:
+        sections = {section.name: section for section in minified.sections}
+        for section in original.sections:
+            copy = sections.get(section.name)
+            if copy is None:
+                problems.append(f"{original.path}: [{section.name}] is missing")
+                continue
+            if macro_bench.macro_variables(section) != macro_bench.macro_variables(
+                copy
+            ):
+                problems.append(f"[{section.name}]: variables differ")
+            others = [
+                name
+                for name, option in section.options.items()
+                if name != "gcode"
+                and not name.startswith(VARIABLE_PREFIX)
+                and copy.get(name) != option.value
+            ]
+            if others:
+                problems.append(f"[{section.name}]: {', '.join(others)} differ")
+            if section.kind != "gcode_macro" or "gcode" not in section.options:
+                continue
+            section_params = macro_params(params, section.title)
+            before, before_error = _render(env, section, status, section_params)
+            after, after_error = _render(env, copy, status, section_params)
+            if before_error is not None and before_error == after_error:
+                # Failing the same way proves nothing about the G-code
+                unverified.append(f"[{section.name}]: {before_error}")
+            elif before != after or before_error != after_error:
+                problems.append(f"[{section.name}]: rendered G-code differs")
+            else:
+                verified += 1
+    return Verification(problems, unverified, verified)
+
+
+def _render(
+    env, section, status: Dict[str, dict], params: Dict[str, str]
+) -> Tuple[List[object], Optional[str]]:
+    """Render a macro once, returning its commands and its error (if any)."""
+    # pylint: disable=import-outside-toplevel
+    import macro_bench
+
+    result: List[object] = []
+
+    def respond(msg):
+        result.append(("respond", msg))
+        return ""
+
+    def raise_error(msg):
+        raise macro_bench.MacroError(msg)
+
+    context = {
+        "printer": macro_bench.MockPrinter(status),
+        "action_respond_info": respond,
+        "action_raise_error": raise_error,
+        "action_emergency_stop": raise_error,
+        "action_call_remote_method": lambda method, **kwargs: "",
+        "params": {key.upper(): value for key, value in params.items()},
+        "rawparams": " ".join(f"{key}={value}" for key, value in params.items()),
+    }
+    context.update(macro_bench.macro_variables(section))
+    try:
+        template = env.from_string(section.get("gcode", ""))
+        output = template.render(context)
+    except Exception as err:  # pylint: disable=broad-except
+        return result, f"{type(err).__name__}: {err}"
+    return result + gcode_commands(output), None
+
+
+def _parse_time(paths: List[str]) -> float:
+    """Time the parsing of some files, in milliseconds."""
+    start = time.perf_counter()
+    for path in paths:
+        parse_file(path)
+    return (time.perf_counter() - start) * 1000
+
+
+def main(argv: List[str]) -> int:
+    """Minify the macro files."""
+    args = argv[1:]
+    output_dir = OUTPUT_DIR
+    check = False
+    profile = "default"
+    params: Dict[str, str] = {}
+    overrides: Dict[str, dict] = {}
+    files: List[str] = []
+    try:
+        while args:
+            arg = args.pop(0)
+            if arg == "--output":
+                output_dir = args.pop(0)
+            elif arg == "--verify":
+                check = True
+            elif arg == "--profile":
+                profile = args.pop(0)
+            elif arg == "--param":
+                key, _, value = args.pop(0).partition("=")
+                params[key] = value
+            elif arg == "--state":
+                with open(args.pop(0), "r", encoding="utf-8") as file:
+                    overrides = json.load(file)
+            else:
+                files.append(arg)
+    except (IndexError, ValueError, OSError) as err:
+        print(f"Error: Invalid arguments ({err})")
+        print(
+            "Usage: python3 minify_macros.py [--output <dir>] [--verify] "
+            "[--profile <name>] [--param <[MACRO:]NAME=VALUE>] [--state <file>] "
+            "[config_file ...]"
+        )
+        return 1
+    files = files or [os.path.join(REPO_DIR, name) for name in MACRO_FILES]
+    try:
+        pairs = minify_files(files, output_dir)
+    except (OSError, ConfigError) as err:
+        print(f"\033[31mError: {err}\033[0m")
+        logger.error("Minify failed: %s", err)
+        return 1
+    before_size = after_size = 0
+    for original, minified in pairs:
+        size = os.path.getsize(original.path)
+        new_size = os.path.getsize(minified.path)
+        before_size += size
+        after_size += new_size
+        print(
+            f"{os.path.basename(original.path):<20} {original.line_count:>5} -> "
+            f"{minified.line_count:>5} lines, {size:>7} -> {new_size:>7} bytes"
+        )
+    before_ms = _parse_time([original.path for original, _ in pairs])
+    after_ms = _parse_time([minified.path for _, minified in pairs])
+    print(
+        f"Total: {before_size} -> {after_size} bytes, "
+        f"parse time {before_ms:.1f} -> {after_ms:.1f} ms. Written to {output_dir}"
+    )
+    if not check:
+        return 0
+    result = verify(pairs, profile, params, overrides)
+    for problem in result.problems:
+        print(f"\033[31m  {problem}\033[0m")
+    for macro in result.unverified:
+        print(f"\033[33m  Unverified {macro}\033[0m")
+    if result.problems:
+        logger.error("Minified macros differ: %s", result.problems)
+        return 1
+    if result.unverified:
+        logger.warning("Minified macros not verified: %s", result.unverified)
+        print(
+            f"\033[33m{result.verified} macro(s) render the same G-code, "
+            f"{len(result.unverified)} could not be rendered: give them values "
+            "with --param and --state.\033[0m"
+        )
+        return 2
+    print(
+        f"\033[32mVerified: the {result.verified} minified macros render the "
+        "same G-code.\033[0m"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A Moonraker client, to ask Klipper for its live state.
+
+All requests of a client go through one keep-alive HTTP connection, and
+the results of GET requests are cached for CACHE_TTL seconds, so asking
+the printer several questions does not open a connection for each.
+With subscribe(), a websocket subscription keeps the printer objects up
+to date, and queries of the subscribed objects need no request at all.
+
+The Moonraker URL is read from PRINTCFG_MOONRAKER, or built from the port
+in moonraker.conf, and an API key can be given in PRINTCFG_MOONRAKER_KEY.
+fake_moonraker.py is a stand-in server to run against in tests.
+
+Usage:
+    python3 moonraker.py status
+    python3 moonraker.py query <object> [<object> ...]
+    python3 moonraker.py variables
+    python3 moonraker.py idle
+
+'idle' exits with 1 when a print is running or paused, so scripts can
+leave the Klipper restart for later:
+    python3 moonraker.py idle && systemctl restart klipper
+"""
+
+import base64
+import hashlib
+import http.client
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode, urlsplit
+
+from log_setup import get_logger
+
+logger = get_logger("moonraker")
+
+# How long a GET result is reused, in seconds
+CACHE_TTL = 2.0
+# Seconds to wait for Moonraker
+TIMEOUT = 5.0
+# Port of Moonraker when moonraker.conf does not set one
+DEFAULT_PORT = 7125
+# The _printcfg macro object
+PRINTCFG_OBJECT = "gcode_macro _printcfg"
+# Print states during which Klipper must not be restarted
+ACTIVE_STATES = ("printing", "paused")
+# The websocket handshake key suffix (RFC 6455)
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+# Websocket opcodes
+TEXT, CLOSE, PING, PONG = 0x1, 0x8, 0x9, 0xA
+
+
+class MoonrakerError(RuntimeError):
+    """Moonraker could not be reached or returned an error."""
+
+
+def moonraker_url() -> str:
+    """Get the Moonraker URL of the instance."""
+    url = os.environ.get("PRINTCFG_MOONRAKER")
+    if url:
+        return url.rstrip("/")
+    port = DEFAULT_PORT
+    printer_data = os.environ.get(
+        "PRINTCFG_DATA", os.path.join(os.path.expanduser("~"), "printer_data")
+    )
+    try:
+        from config_cache import load_config
+
+        config = load_config(os.path.join(printer_data, "config", "moonraker.conf"))
+        server = config.section("server")
+        if server is not None and "port" in server.options:
+            port = int(server.options["port"].value)
+    except (OSError, ValueError):
+        pass
+    return f"http://127.0.0.1:{port}"
+
+
+def send_frame(
+    sock: socket.socket, payload: bytes, opcode: int = TEXT, mask: bool = True
+):
+    """
+    Sends a websocket frame.
+
+    Args:
+        sock: The websocket.
+        payload: The frame payload.
+        opcode: The frame type.
+        mask: Whether to mask the payload (clients must, servers must not).
+    """
+    header = bytes([0x80 | opcode])
+    flag = 0x80 if mask else 0
+    length = len(payload)
+    if length < 126:
+        header += bytes([flag | length])
+    elif length < 65536:
+        header += bytes([flag | 126]) + struct.pack("!H", length)
+    else:
+        header += bytes([flag | 127]) + struct.pack("!Q", length)
+    if mask:
+        key = os.urandom(4)
+        # Mask 4 bytes at a time
+        padded = payload + b"\0" * (-length % 4)
+        words = struct.unpack(f"!{len(padded) // 4}I", padded)
+        (key_word,) = struct.unpack("!I", key)
+        payload = struct.pack(
+            f"!{len(words)}I", *(word ^ key_word for word in words)
+        )[:length]
+        header += key
+    sock.sendall(header + payload)
+
+
+def _read_exact(file, size: int) -> bytes:
+    """Read exactly size bytes from a socket file."""
+    data = file.read(size)
+    if len(data) < size:
+        raise ConnectionError("Websocket closed")
+    return data
+
+
+def read_frame(file) -> Tuple[int, bytes]:
+    """
+    Reads a websocket message, joining fragmented frames.
+
+    Args:
+        file: The websocket, as a binary file (socket.makefile('rb')).
+
+    Returns:
+        The opcode and the payload.
+    """
+    message = b""
+    message_opcode = None
+    while True:
+        first, second = _read_exact(file, 2)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            (length,) = struct.unpack("!H", _read_exact(file, 2))
+        elif length == 127:
+            (length,) = struct.unpack("!Q", _read_exact(file, 8))
+        key = _read_exact(file, 4) if second & 0x80 else None
+        payload = _read_exact(file, length)
+        if key:
+            payload = bytes(byte ^ key[i % 4] for i, byte in enumerate(payload))
+        if opcode >= CLOSE:
+            # Control frames may come between fragments
+            return opcode, payload
+        if message_opcode is None:
+            message_opcode = opcode
+        message += payload
+        if first & 0x80:
+            return message_opcode, message
+
+
+def websocket_accept(key: str) -> str:
+    """Get the Sec-WebSocket-Accept value of a handshake key."""
+    digest = hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+
+class Subscription:
+    """A websocket subscription to printer objects."""
+
+    def __init__(self, url: str, objects: List[str], timeout: float = TIMEOUT):
+        parts = urlsplit(url)
+        self.objects = list(objects)
+        self.status: Dict[str, dict] = {}
+        self.connected = False
+        self._lock = threading.Lock()
+        try:
+            self._sock = socket.create_connection(
+                (parts.hostname, parts.port or 80), timeout=timeout
+            )
+        except OSError as err:
+            raise MoonrakerError(f"Moonraker unreachable at {url}: {err}") from err
+        try:
+            key = base64.b64encode(os.urandom(16)).decode()
+            self._sock.sendall(
+                (
+                    f"GET /websocket HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+                    "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                    f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+                ).encode()
+            )
+            self._file = self._sock.makefile("rb")
+            response = self._file.readline().decode("latin-1")
+            headers = {}
+            for line in iter(self._file.readline, b"\r\n"):
+                if not line:
+                    raise ConnectionError("Websocket closed during the handshake")
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if " 101 " not in response or headers.get(
+                "sec-websocket-accept"
+            ) != websocket_accept(key):
+                raise MoonrakerError(f"Websocket refused: {response.strip()}")
+            request = {
+                "jsonrpc": "2.0",
+                "method": "printer.objects.subscribe",
+                "params": {"objects": {name: None for name in self.objects}},
+                "id": 1,
+            }
+            send_frame(self._sock, json.dumps(request).encode())
+            while True:
+                message = self._receive()
+                if message is not None and message.get("id") == 1:
+                    break
+            if "error" in message:
+                raise MoonrakerError(message["error"].get("message", "error"))
+            self.status = message["result"]["status"]
+        except (OSError, ValueError, KeyError) as err:
+            self._sock.close()
+            raise MoonrakerError(f"Could not subscribe: {err}") from err
+        except MoonrakerError:
+            self._sock.close()
+            raise
+        self.connected = True
+        # Block in the reader thread, not in the subscriber
+        self._sock.settimeout(None)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _receive(self) -> Optional[dict]:
+        """Read a JSON-RPC message, answering pings."""
+        opcode, payload = read_frame(self._file)
+        if opcode == PING:
+            send_frame(self._sock, payload, PONG)
+            return None
+        if opcode == CLOSE:
+            raise ConnectionError("Websocket closed")
+        if opcode != TEXT:
+            return None
+        return json.loads(payload.decode("utf-8"))
+
+    def _run(self):
+        """Apply the status updates until the websocket closes."""
+        try:
+            while True:
+                message = self._receive()
+                if message is None:
+                    continue
+                method = message.get("method")
+                if method == "notify_status_update":
+                    with self._lock:
+                        for name, changes in message["params"][0].items():
+                            self.status.setdefault(name, {}).update(changes)
+                elif method in (
+                    "notify_klippy_disconnected",
+                    "notify_klippy_shutdown",
+                ):
+                    # The objects are gone until Klipper is ready again
+                    break
+        except (OSError, ValueError, KeyError, IndexError) as err:
+            logger.debug("Subscription ended: %s", err)
+        finally:
+            self.connected = False
+
+    def get(self, objects: List[str]) -> Optional[Dict[str, dict]]:
+        """Get subscribed objects, or None if they are not all up to date."""
+        if not self.connected or not set(objects) <= set(self.objects):
+            return None
+        with self._lock:
+            return {
+                name: dict(self.status[name]) for name in objects if name in self.status
+            }
+
+    def close(self):
+        """Close the websocket."""
+        self.connected = False
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+
+class Moonraker:
+    """A Moonraker client with one keep-alive connection and a result cache."""
+
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        timeout: float = TIMEOUT,
+        ttl: float = CACHE_TTL,
+    ):
+        self.url = (url or moonraker_url()).rstrip("/")
+        self.api_key = api_key or os.environ.get("PRINTCFG_MOONRAKER_KEY")
+        self.timeout = timeout
+        self.ttl = ttl
+        self.subscription: Optional[Subscription] = None
+        self._connection: Optional[http.client.HTTPConnection] = None
+        self._cache: Dict[str, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "Moonraker":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the connection and the subscription."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self.subscription is not None:
+            self.subscription.close()
+            self.subscription = None
+
+    def clear_cache(self):
+        """Forget all cached results."""
+        self._cache.clear()
+
+    def _send(self, method: str, path: str) -> Tuple[int, bytes]:
+        """Send a request over the kept-alive connection."""
+        headers = {"Connection": "keep-alive"}
+        if self.api_key:
+            headers["X-Api-Key"] = self.api_key
+        # A kept connection may have been closed by the server: retry once
+        for attempt in (1, 2):
+            reused = self._connection is not None
+            if self._connection is None:
+                parts = urlsplit(self.url)
+                self._connection = http.client.HTTPConnection(
+                    parts.hostname, parts.port or 80, timeout=self.timeout
+                )
+            try:
+                self._connection.request(method, path, headers=headers)
+                response = self._connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as err:
+                self._connection.close()
+                self._connection = None
+                if reused and attempt == 1:
+                    continue
+                raise MoonrakerError(f"Moonraker unreachable at {self.url}: {err}")
+            if response.getheader("Connection", "").lower() == "close":
+                self._connection.close()
+                self._connection = None
+            return response.status, body
+        raise MoonrakerError(f"Moonraker unreachable at {self.url}")
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        ttl: Optional[float] = None,
+    ) -> Any:
+        """
+        Sends a request to Moonraker.
+
+        Args:
+            method: 'GET' or 'POST'.
+            path: The endpoint (Eg: '/printer/info').
+            params: The query parameters.
+            ttl: How old a cached GET result may be (default: the client ttl,
+                 0 to always send the request).
+
+        Returns:
+            The result of the request.
+
+        Raises:
+            MoonrakerError: If Moonraker could not be reached or failed.
+        """
+        if params:
+            path += "?" + urlencode(params, quote_via=quote)
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            now = time.monotonic()
+            if method == "GET" and path in self._cache:
+                cached_at, result = self._cache[path]
+                if now - cached_at <= ttl:
+                    return result
+            status, body = self._send(method, path)
+            try:
+                data = json.loads(body.decode("utf-8"))
+            except ValueError as err:
+                raise MoonrakerError(f"Invalid response to {path}: {err}") from err
+            if status != 200 or "error" in data:
+                error = data.get("error", {}) if isinstance(data, dict) else {}
+                message = error.get("message", f"HTTP {status}")
+                raise MoonrakerError(f"{method} {path} failed: {message}")
+            if method == "GET":
+                self._cache[path] = (now, data["result"])
+            else:
+                # The state may have changed
+                self._cache.clear()
+            return data["result"]
+
+    def subscribe(self, objects: List[str]) -> Subscription:
+        """
+        Subscribes to printer objects over a websocket, so their queries are
+        answered from the updates instead of requests.
+
+        Args:
+            objects: The printer objects (Eg: ['print_stats']).
+
+        Returns:
+            The subscription.
+        """
+        if self.subscription is not None:
+            self.subscription.close()
+        self.subscription = Subscription(self.url, objects, self.timeout)
+        return self.subscription
+
+    def query(self, *objects: str, ttl: Optional[float] = None) -> Dict[str, dict]:
+        """
+        Gets the status of printer objects.
+
+        Args:
+            objects: The printer objects (Eg: 'print_stats', 'gcode_macro _printcfg').
+            ttl: How old a cached result may be.
+
+        Returns:
+            The status of each object that exists.
+        """
+        if self.subscription is not None:
+            status = self.subscription.get(list(objects))
+            if status is not None:
+                return status
+        result = self.request(
+            "GET", "/printer/objects/query", {name: "" for name in objects}, ttl
+        )
+        return result["status"]
+
+    def server_info(self, ttl: Optional[float] = None) -> Dict[str, Any]:
+        """Get the Moonraker server info (klippy_state, versions...)."""
+        return self.request("GET", "/server/info", ttl=ttl)
+
+    def klippy_state(self, ttl: Optional[float] = None) -> str:
+        """Get the Klipper state ('ready', 'startup', 'shutdown', 'error'...)."""
+        return self.server_info(ttl).get("klippy_state", "disconnected")
+
+    def print_state(self, ttl: Optional[float] = None) -> str:
+        """Get the print state ('standby', 'printing', 'paused', 'complete'...)."""
+        status = self.query("print_stats", ttl=ttl)
+        return status.get("print_stats", {}).get("state", "standby")
+
+    def is_printing(self, ttl: Optional[float] = None) -> bool:
+        """Whether a print is running or paused."""
+        if self.klippy_state(ttl) != "ready":
+            return False
+        return self.print_state(ttl) in ACTIVE_STATES
+
+    def printcfg_variables(self, ttl: Optional[float] = None) -> Dict[str, Any]:
+        """Get the live _printcfg variables."""
+        return self.query(PRINTCFG_OBJECT, ttl=ttl).get(PRINTCFG_OBJECT, {})
+
+    def config(self, ttl: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+        """Get the config loaded by Klipper, by section."""
+        configfile = self.query("configfile", ttl=ttl).get("configfile", {})
+        return configfile.get("settings", {})
+
+    def gcode(self, script: str) -> Any:
+        """Run G-code."""
+        return self.request("POST", "/printer/gcode/script", {"script": script})
+
+    def restart(self, firmware: bool = False, force: bool = False) -> Any:
+        """
+        Restarts Klipper.
+
+        Args:
+            firmware: Whether to also restart the MCUs.
+            force: Restart even during a print.
+
+        Raises:
+            MoonrakerError: If a print is running (without force), or the
+                            restart failed.
+        """
+        if not force and self.is_printing(ttl=0):
+            raise MoonrakerError("A print is running, not restarting Klipper")
+        endpoint = "/printer/firmware_restart" if firmware else "/printer/restart"
+        return self.request("POST", endpoint)
+
+
+_default: Optional[Moonraker] = None
+
+
+def default_client() -> Moonraker:
+    """Get the client shared by the process (its connection is reused)."""
+    global _default
+    if _default is None:
+        _default = Moonraker()
+    return _default
+
+
+def main(argv: List[str]) -> int:
+    """Query Moonraker from the command line."""
+    if len(argv) < 2 or argv[1] not in ("status", "query", "variables", "idle"):
+        print(
+            "Usage: python3 moonraker.py status | query <object> [<object> ...] | "
+            "variables | idle"
+        )
+        return 1
+    command = argv[1]
+    client = default_client()
+    try:
+        if command == "idle":
+            printing = client.is_printing(ttl=0)
+            if printing:
+                print(f"A print is {client.print_state()}.")
+            return 1 if printing else 0
+        if command == "status":
+            state = client.klippy_state()
+            result: Any = {"klippy_state": state}
+            if state == "ready":
+                result["print_state"] = client.print_state()
+        elif command == "variables":
+            result = client.printcfg_variables()
+        else:
+            result = client.query(*argv[2:])
+        print(json.dumps(result, indent=2))
+    except MoonrakerError as err:
+        if command == "idle":
+            # The print state is unknown: do not hold back updates for it
+            logger.warning("Assuming idle: %s", err)
+            return 0
+        print(f"\033[31mError: {err}\033[0m")
+        return 1
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,991 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs the printcfg update as a graph of steps.
+
+install.sh runs its checks, git commands, config edits and service
+setup strictly in order. Here each step names the steps it needs, and
+the steps whose needs are met run at the same time: the printer.cfg and
+moonraker.conf edits run alongside the profile sync and the service
+checks, for example. Each step has a timeout, and the steps that use
+the network are retried.
+
+The remote is fetched once into the shared bare mirror of git_mirror.py,
+and the checkout is updated from the mirror. In offline mode
+(PRINTCFG_OFFLINE=1 or --offline) the update only uses the mirror.
+
+The steps that succeeded are recorded in a state file. When a run
+fails, the next run for the same instance, profile and branch resumes
+after them (unless --fresh is given or the state is older than
+RESUME_TTL).
+
+install.sh is still used for the first install, before the repo is
+cloned.
+
+Usage:
+    python3 orchestrator.py [<profile>] [<branch>] [--fresh] [--offline]
+                            [--jobs N] [--plan]
+
+Example:
+    python3 orchestrator.py default dev
+"""
+
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from git_mirror import Mirror, MirrorError
+from log_setup import get_logger
+from search_replace import read_lines, write_lines_atomic
+from snapshots import take_snapshot
+
+# Set the repo name
+REPO = "printcfg"
+# Name of the instance when run by fleet mode
+INSTANCE = os.environ.get("PRINTCFG_INSTANCE")
+logger = get_logger(
+    "orchestrator", log_name=f"orchestrator-{INSTANCE}" if INSTANCE else None
+)
+
+HOME = os.path.expanduser("~")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_DIR = os.path.join(HOME, REPO, "cache")
+# The steps done by the last run
+STATE_FILE = os.path.join(
+    CACHE_DIR, f"install-state-{INSTANCE}.json" if INSTANCE else "install-state.json"
+)
+# The install paths, one file per fleet instance (~/printer_data, the
+# 'printer' instance, keeps printcfg.conf)
+REPO_DATA = (
+    f"{REPO}-{INSTANCE}.conf" if INSTANCE and INSTANCE != "printer" else f"{REPO}.conf"
+)
+# The hash of the last installed requirements.txt
+REQUIREMENTS_STAMP = os.path.join(CACHE_DIR, "requirements.sha256")
+# How long a failed run can be resumed, in seconds
+RESUME_TTL = 24 * 3600.0
+# Default timeout of a step, in seconds
+DEFAULT_TIMEOUT = 120.0
+# Default number of steps run at once
+DEFAULT_JOBS = 4
+# Delay before a step is retried, multiplied by the attempt number
+RETRY_DELAY = 2.0
+DEFAULT_PROFILE = "default"
+SYSTEMD_DIR = "/etc/systemd/system"
+BIN = f"/usr/local/bin/{REPO}"
+LOG4BASH_URL = (
+    "https://raw.githubusercontent.com/fredpalmer/log4bash/master/log4bash.sh"
+)
+# Commands needed by the install, and the package that provides them
+DEPENDENCIES = {"git": "git", "pip": "python3-pip", "bc": "bc", "wget": "wget"}
+USER_CONFIG_INCLUDE = "[include user_config.cfg]"
+MOONRAKER_INCLUDE = f"[include moonraker-{REPO}.conf]"
+OLD_MOONRAKER_INCLUDE = f"[include {REPO}/moonraker-{REPO}.conf]"
+
+
+class StepError(RuntimeError):
+    """Raised when a step fails."""
+
+
+class Context:
+    """The settings of a run and the values found by its steps."""
+
+    def __init__(
+        self,
+        profile: str = DEFAULT_PROFILE,
+        branch: Optional[str] = None,
+        repo_dir: str = REPO_DIR,
+        printer_data: Optional[str] = None,
+        env: Optional[Dict[str, str]] = None,
+        mirror: Optional[Mirror] = None,
+    ):
+        """
+        Args:
+            profile: The profile to install.
+            branch: The branch to switch to (default: stay on the current one).
+            repo_dir: The printcfg repo.
+            printer_data: The printer_data directory (default: PRINTCFG_DATA
+                          or ~/printer_data).
+            env: The environment of the commands (default: os.environ).
+            mirror: The mirror of the repo (default: the shared mirror).
+        """
+        self.env = dict(os.environ if env is None else env)
+        self.mirror = mirror or Mirror()
+        self.profile = profile
+        self.branch = branch
+        self.repo_dir = repo_dir
+        self.printer_data = printer_data or self.env.get(
+            "PRINTCFG_DATA", os.path.join(HOME, "printer_data")
+        )
+        self.values: Dict[str, str] = {}
+        self.notes: List[str] = []
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    @property
+    def repo_updated(self) -> bool:
+        """Whether fleet mode already updated the shared repo."""
+        return bool(self.env.get("PRINTCFG_REPO_UPDATED"))
+
+    def __getitem__(self, name: str) -> str:
+        return self.values[name]
+
+    def path(self, *parts: str) -> str:
+        """Get a path in the repo."""
+        return os.path.join(self.repo_dir, *parts)
+
+    def note(self, message: str):
+        """Add a message shown at the end of the run."""
+        logger.info(message)
+        self.notes.append(message)
+
+    def lock(self, name: str) -> asyncio.Lock:
+        """Get a lock shared by the steps of the run."""
+        if name not in self._locks:
+            self._locks[name] = asyncio.Lock()
+        return self._locks[name]
+
+    async def run(
+        self,
+        *command: str,
+        check: bool = True,
+        sudo: bool = False,
+        env: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, str]:
+        """
+        Runs a command in the repo directory.
+
+        Commands that may ask for the sudo password (sudo commands, or
+        any command with sudo=True) run one at a time.
+
+        Args:
+            command: The command and its arguments.
+            check: Raise StepError if the command fails.
+            sudo: Whether the command may ask for the sudo password.
+            env: Environment variables added for this command.
+
+        Returns:
+            The return code and the output of the command.
+        """
+        if sudo or command[0] == "sudo":
+            async with self.lock("sudo"):
+                return await self._run(command, check, env)
+        return await self._run(command, check, env)
+
+    async def _run(
+        self, command: Tuple[str, ...], check: bool, env: Optional[Dict[str, str]]
+    ) -> Tuple[int, str]:
+        logger.debug("Running %s", command)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                cwd=self.repo_dir,
+                env=dict(self.env, **env) if env else self.env,
+            )
+        except OSError as err:
+            raise StepError(f"Could not run {command[0]}: {err}") from err
+        try:
+            data, _ = await process.communicate()
+        except asyncio.CancelledError:
+            # Timed out: do not leave the command running
+            process.kill()
+            await process.wait()
+            raise
+        output = data.decode("utf-8", "replace")
+        logger.debug(
+            "%s exited with code %s: %s", command[0], process.returncode, output
+        )
+        if check and process.returncode != 0:
+            lines = output.strip().splitlines()
+            reason = lines[-1] if lines else f"exit code {process.returncode}"
+            raise StepError(f"{' '.join(command[:3])} failed: {reason}")
+        return process.returncode, output
+
+
+# Runs a step and returns the values it adds to the context
+Action = Callable[[Context], Awaitable[Optional[Dict[str, str]]]]
+
+
+@dataclass(frozen=True)
+class Step:
+    """A step of the update."""
+
+    name: str
+    action: Action
+    after: Tuple[str, ...] = ()
+    timeout: float = DEFAULT_TIMEOUT
+    retries: int = 0
+
+
+class StepResult(NamedTuple):
+    """The outcome of a step."""
+
+    name: str
+    # ok, resumed (done by an earlier run), failed or skipped
+    status: str
+    seconds: float = 0.0
+    attempts: int = 0
+    message: str = ""
+
+
+class Orchestrator:
+    """Runs steps as soon as the steps they need are done."""
+
+    def __init__(
+        self,
+        steps: Iterable[Step],
+        state_file: Optional[str] = None,
+        jobs: int = DEFAULT_JOBS,
+    ):
+        """
+        Args:
+            steps: The steps.
+            state_file: Where the steps done are recorded (default: nowhere).
+            jobs: The number of steps run at once.
+
+        Raises:
+            ValueError: If a step is duplicated, needs an unknown step, or
+                        the steps need each other.
+        """
+        self.steps: Dict[str, Step] = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f"Duplicate step: {step.name}")
+            self.steps[step.name] = step
+        for step in self.steps.values():
+            for name in step.after:
+                if name not in self.steps:
+                    raise ValueError(f"Step {step.name} needs unknown step {name}")
+        self.order = [name for stage in self.stages() for name in stage]
+        self.state_file = state_file
+        self.jobs = max(jobs, 1)
+
+    def stages(self) -> List[List[str]]:
+        """
+        Groups the steps that can run at the same time, in order.
+
+        Raises:
+            ValueError: If the steps need each other.
+        """
+        done: Set[str] = set()
+        stages: List[List[str]] = []
+        pending = list(self.steps)
+        while pending:
+            ready = [
+                name for name in pending if done.issuperset(self.steps[name].after)
+            ]
+            if not ready:
+                raise ValueError(f"Steps need each other: {', '.join(pending)}")
+            stages.append(ready)
+            done.update(ready)
+            pending = [name for name in pending if name not in done]
+        return stages
+
+    def load_state(self, key: Dict[str, str]) -> Dict[str, Dict[str, str]]:
+        """Get the values of the steps done by an unfinished run with the same key."""
+        if not self.state_file:
+            return {}
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+        if (
+            not isinstance(state, dict)
+            or state.get("key") != key
+            or state.get("complete")
+            or time.time() - state.get("updated", 0) > RESUME_TTL
+        ):
+            return {}
+        return {
+            name: values
+            for name, values in state.get("done", {}).items()
+            if name in self.steps
+        }
+
+    def save_state(
+        self, key: Dict[str, str], done: Dict[str, Dict[str, str]], complete: bool
+    ):
+        """Record the steps done."""
+        if not self.state_file:
+            return
+        state = {"key": key, "updated": time.time(), "complete": complete, "done": done}
+        try:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            write_lines_atomic(self.state_file, [json.dumps(state, indent=2), "\n"])
+        except OSError as err:
+            logger.error("Could not save the state to %s: %s", self.state_file, err)
+
+    async def run(
+        self,
+        context: Context,
+        key: Optional[Dict[str, str]] = None,
+        fresh: bool = False,
+        on_result: Optional[Callable[[StepResult], None]] = None,
+    ) -> List[StepResult]:
+        """
+        Runs the steps.
+
+        After a failure no more steps are started, the running steps are
+        finished, and the steps that were not run are skipped.
+
+        Args:
+            context: The context of the run.
+            key: Identifies the run, so an unfinished run is only resumed
+                 with the same settings.
+            fresh: Run every step, even those done by an unfinished run.
+            on_result: Called with the result of each step when it ends.
+
+        Returns:
+            The result of each step, in the order of the stages.
+        """
+        key = key or {}
+        done = {} if fresh else self.load_state(key)
+        results: Dict[str, StepResult] = {}
+
+        def report(result: StepResult):
+            results[result.name] = result
+            if on_result is not None:
+                on_result(result)
+
+        for name in self.order:
+            if name in done:
+                context.values.update(done[name])
+                report(StepResult(name, "resumed"))
+        running: Dict["asyncio.Future[Tuple[StepResult, Dict[str, str]]]", str] = {}
+        failed = False
+        while True:
+            for name in self.order:
+                if failed or len(running) >= self.jobs:
+                    break
+                if name in results or name in running.values():
+                    continue
+                if all(
+                    results.get(need, StepResult(need, "")).status in ("ok", "resumed")
+                    for need in self.steps[name].after
+                ):
+                    step = self.steps[name]
+                    task = asyncio.ensure_future(self._run_step(step, context))
+                    running[task] = name
+            if not running:
+                break
+            finished, _ = await asyncio.wait(
+                list(running), return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in finished:
+                del running[task]
+                result, values = task.result()
+                if result.status == "ok":
+                    context.values.update(values)
+                    done[result.name] = values
+                    self.save_state(key, done, complete=False)
+                else:
+                    failed = True
+                report(result)
+        for name in self.order:
+            if name not in results:
+                report(StepResult(name, "skipped"))
+        self.save_state(key, done, complete=not failed)
+        return [results[name] for name in self.order]
+
+    async def _run_step(
+        self, step: Step, context: Context
+    ) -> Tuple[StepResult, Dict[str, str]]:
+        """Run a step with its timeout and retries."""
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            logger.info("Running step %s (attempt %s)", step.name, attempt)
+            try:
+                values = await asyncio.wait_for(step.action(context), step.timeout)
+            except asyncio.TimeoutError:
+                message = f"timed out after {step.timeout:g}s"
+            except (StepError, OSError) as err:
+                message = str(err)
+            except Exception as err:  # pylint: disable=broad-except
+                # A bug, not a transient failure: fail the step without
+                # retrying, so the other steps finish and the state is saved
+                logger.exception("Step %s raised an error", step.name)
+                seconds = time.perf_counter() - start
+                message = f"{type(err).__name__}: {err}"
+                return StepResult(step.name, "failed", seconds, attempt, message), {}
+            else:
+                seconds = time.perf_counter() - start
+                logger.info("Step %s done in %.1fs", step.name, seconds)
+                return StepResult(step.name, "ok", seconds, attempt), values or {}
+            logger.warning(
+                "Step %s failed (attempt %s): %s", step.name, attempt, message
+            )
+            if attempt > step.retries:
+                seconds = time.perf_counter() - start
+                return StepResult(step.name, "failed", seconds, attempt, message), {}
+            await asyncio.sleep(RETRY_DELAY * attempt)
+
+
+def _has_line(path: str, line: str) -> bool:
+    """Determine whether a file has a line (like grep -qFx)."""
+    try:
+        with open(path, "r", encoding="utf-8") as lines:
+            return any(text.rstrip("\r\n") == line for text in lines)
+    except OSError:
+        return False
+
+
+def _search(path: str, pattern: str) -> str:
+    """Get the first group of the first match in a file, '' when there is none."""
+    try:
+        with open(path, "r", encoding="utf-8") as text:
+            match = re.search(pattern, text.read())
+    except OSError:
+        return ""
+    return match.group(1).strip() if match else ""
+
+
+def find_unit(service: str, printer_data: str, systemd_dir: str = SYSTEMD_DIR) -> str:
+    """
+    Finds the Klipper or Moonraker unit of an instance.
+
+    The unit is the one whose unit file or environment file names the
+    printer_data directory (Eg: klipper-printer_2 for ~/printer_2_data).
+    Failing that, the plain unit is taken to serve ~/printer_data.
+
+    Args:
+        service: The service name (Eg: 'moonraker').
+        printer_data: The printer_data directory of the instance.
+        systemd_dir: The directory of the unit files.
+
+    Returns:
+        The unit name, or '' if the instance has none.
+    """
+    printer_data = os.path.normpath(printer_data)
+    pattern = f"(?m)({re.escape(printer_data)})(?:[/\"\\s]|$)"
+    plain = os.path.join(systemd_dir, f"{service}.service")
+    instances = glob.glob(os.path.join(systemd_dir, f"{service}-*.service"))
+    units = [plain] + sorted(instances)
+    for unit in units:
+        if not os.path.isfile(unit):
+            continue
+        env_file = _search(unit, r"EnvironmentFile=-?(.*)")
+        if _search(unit, pattern) or (env_file and _search(env_file, pattern)):
+            return os.path.basename(unit)[: -len(".service")]
+    default = os.path.normpath(os.path.join(HOME, "printer_data"))
+    if printer_data == default and os.path.isfile(plain):
+        return service
+    return ""
+
+
+def service_paths(
+    service: str, unit_name: Optional[str] = None, systemd_dir: str = SYSTEMD_DIR
+) -> Dict[str, str]:
+    """
+    Reads the paths of a Klipper or Moonraker service.
+
+    Args:
+        service: The service name (Eg: 'moonraker').
+        unit_name: The unit of the instance (default: the service name).
+        systemd_dir: The directory of the unit files.
+
+    Returns:
+        The unit file ('<service>_service'), its working directory
+        ('<service>_dir') and the printer_data directory given with -d
+        in its environment file ('printer_dir'), or {} without a unit.
+    """
+    unit = os.path.join(systemd_dir, f"{unit_name or service}.service")
+    if not os.path.isfile(unit):
+        return {}
+    env_file = _search(unit, r"EnvironmentFile=(.*)")
+    return {
+        f"{service}_service": unit,
+        f"{service}_dir": _search(unit, r"WorkingDirectory=(.*)"),
+        "printer_dir": _search(env_file, r'-d\s+"?([^"\s]+)') if env_file else "",
+    }
+
+
+# The steps
+
+
+async def install_dependencies(context: Context) -> None:
+    """Install the missing system packages."""
+    missing = [
+        package
+        for command, package in DEPENDENCIES.items()
+        if shutil.which(command) is None
+    ]
+    if missing:
+        logger.info("Installing missing dependencies: %s", missing)
+        await context.run("sudo", "apt-get", "update")
+        await context.run("sudo", "apt-get", "install", "-y", *missing)
+
+
+async def fetch_repo(context: Context) -> None:
+    """Fetch the remote into the mirror, and the checkout from the mirror."""
+    if context.repo_updated:
+        logger.info("The repo was already updated by fleet mode")
+        return
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(None, context.mirror.fetch)
+    except MirrorError as err:
+        raise StepError(str(err)) from err
+    await context.run("git", *context.mirror.checkout_fetch_args())
+
+
+async def checkout_branch(context: Context) -> Dict[str, str]:
+    """Switch to the branch and bring it up to date."""
+    _, current = await context.run("git", "branch", "--show-current")
+    current = current.strip()
+    branch = context.branch or current
+    if branch != current:
+        try:
+            exists = context.mirror.has_branch(branch)
+        except MirrorError as err:
+            raise StepError(str(err)) from err
+        if not exists:
+            raise StepError(f"Branch {branch} does not exist")
+        await context.run("git", "switch", branch)
+    if not context.repo_updated:
+        await context.run("git", "merge", "--ff-only", "@{upstream}")
+    _, head = await context.run("git", "rev-parse", "HEAD")
+    return {"branch": branch, "head": head.strip()}
+
+
+async def install_requirements(context: Context) -> None:
+    """Install the Python requirements when they changed since the last install."""
+    requirements = context.path("requirements.txt")
+    if context.repo_updated or not os.path.isfile(requirements):
+        return
+    with open(requirements, "rb") as requirements_file:
+        digest = hashlib.sha256(requirements_file.read()).hexdigest()
+    if _search(REQUIREMENTS_STAMP, r"(\w+)") == digest:
+        logger.info("The requirements did not change")
+        return
+    if context.mirror.offline:
+        context.note(f"Offline: run 'pip3 install -r {requirements}' when online.")
+        return
+    await context.run("pip3", "install", "-r", requirements)
+    os.makedirs(os.path.dirname(REQUIREMENTS_STAMP), exist_ok=True)
+    write_lines_atomic(REQUIREMENTS_STAMP, [digest, "\n"])
+
+
+async def install_service(context: Context) -> None:
+    """Install the printcfg services unless they are enabled."""
+    for service in (REPO, f"{REPO}-daemon"):
+        returncode, _ = await context.run(
+            "systemctl", "is-enabled", service, check=False
+        )
+        if returncode != 0:
+            script = context.path("src", f"{REPO}.py")
+            await context.run(sys.executable, script, "install", sudo=True)
+            return
+
+
+async def link_bin(context: Context) -> None:
+    """Create the printcfg command."""
+    if not os.path.isfile(BIN):
+        await context.run("sudo", "ln", "-s", context.path("src", f"{REPO}.py"), BIN)
+        await context.run("sudo", "chmod", "+x", BIN)
+
+
+async def install_log4bash(context: Context) -> None:
+    """Download log4bash, used by the shell scripts, when it is missing."""
+    target = context.path("src", "log4bash.sh")
+    if (
+        os.path.isfile(target)
+        or os.path.isfile(os.path.join(HOME, "log4bash.sh"))
+        or shutil.which("log4bash.sh")
+    ):
+        return
+    await context.run("wget", LOG4BASH_URL, "-O", target)
+    await context.run("sudo", "ln", "-sf", target, "/usr/local/bin/log4bash.sh")
+    await context.run("sudo", "chmod", "+x", "/usr/local/bin/log4bash.sh")
+
+
+async def locate_config(context: Context) -> Dict[str, str]:
+    """Find the Klipper and Moonraker config files."""
+    printer_data = context.printer_data
+    config = os.path.join(printer_data, "config")
+    printer = os.path.join(config, "printer.cfg")
+    moonraker = os.path.join(config, "moonraker.conf")
+    # The units of this instance (Eg: klipper-printer_2 for ~/printer_2_data)
+    units = {
+        service: find_unit(service, printer_data)
+        for service in ("klipper", "moonraker")
+    }
+    moonraker_paths = service_paths("moonraker", units["moonraker"] or None)
+    klipper_paths = service_paths("klipper", units["klipper"] or None)
+    if not os.path.isfile(moonraker):
+        # Look for the config of the Moonraker service
+        printer_dir = moonraker_paths.get("printer_dir", "")
+        moonraker = os.path.join(printer_dir, "config", "moonraker.conf")
+        if not printer_dir or not os.path.isfile(moonraker):
+            raise StepError(
+                f"Moonraker config not found in {config}. Please make sure "
+                "you have moonraker installed."
+            )
+    if not os.path.isfile(printer):
+        # Look for the config of the Klipper service
+        printer_dir = klipper_paths.get("printer_dir", "")
+        printer = os.path.join(printer_dir, "config", "printer.cfg")
+        if not printer_dir or not os.path.isfile(printer):
+            raise StepError(
+                f"printer.cfg not found in {config}. Please make sure you "
+                "have klipper installed."
+            )
+        printer_data = printer_dir
+        config = os.path.join(printer_dir, "config")
+    values = {
+        "printer_data": printer_data,
+        "config": config,
+        "printer": printer,
+        "moonraker": moonraker,
+        "allowlist": os.path.join(printer_data, "moonraker.asvc"),
+        "printer_dir": moonraker_paths.get("printer_dir", ""),
+    }
+    for service, paths in (("klipper", klipper_paths), ("moonraker", moonraker_paths)):
+        values[f"{service}_service"] = paths.get(f"{service}_service", "")
+        values[f"{service}_dir"] = paths.get(f"{service}_dir", "")
+        values[f"{service}_unit"] = units[service]
+    return values
+
+
+async def sync_user_profile(context: Context) -> Dict[str, str]:
+    """Create or update the user config and user profile."""
+    profile = context.profile
+    profile_dir = context.path("profiles", profile)
+    if not all(
+        os.path.isfile(os.path.join(profile_dir, name))
+        for name in ("config.cfg", "variables.cfg")
+    ):
+        context.note(f"Profile '{profile}' not found, using {DEFAULT_PROFILE}.")
+        profile = DEFAULT_PROFILE
+    await context.run(
+        sys.executable,
+        context.path("src", "sync_profile.py"),
+        profile,
+        context["config"],
+        context.repo_dir,
+    )
+    return {"profile": profile}
+
+
+async def snapshot_config(context: Context) -> Dict[str, str]:
+    """Keep a restore point of the config files before they are edited."""
+    if context.branch:
+        note = f"Before changing to branch {context.branch}"
+    else:
+        note = "Before updating"
+    loop = asyncio.get_event_loop()
+    snapshot_id = await loop.run_in_executor(
+        None, take_snapshot, "update", note, context["config"]
+    )
+    if snapshot_id:
+        context.note(f"Restore point: {snapshot_id} ({REPO} rollback {snapshot_id})")
+    return {"snapshot": snapshot_id or ""}
+
+
+async def link_repo(context: Context) -> None:
+    """Link the repo into the config directory."""
+    link = os.path.join(context["config"], REPO)
+    if not os.path.islink(link):
+        os.symlink(context.repo_dir, link)
+
+
+async def include_user_config(context: Context) -> None:
+    """Include the user config in printer.cfg."""
+    printer = context["printer"]
+    if not _has_line(printer, USER_CONFIG_INCLUDE):
+        await context.run(
+            sys.executable,
+            context.path("src", "search_replace.py"),
+            USER_CONFIG_INCLUDE,
+            USER_CONFIG_INCLUDE,
+            printer,
+        )
+
+
+async def include_moonraker_config(context: Context) -> None:
+    """Set up the update manager config and include it in moonraker.conf."""
+    mooncfg = os.path.join(context["config"], f"moonraker-{REPO}.conf")
+    if not os.path.isfile(mooncfg):
+        shutil.copyfile(context.path("src", "mooncfg.conf"), mooncfg)
+    # Track the installed branch
+    lines = read_lines(mooncfg)
+    updated = [
+        re.sub(r"primary_branch:.*", f"primary_branch: {context['branch']}", line)
+        for line in lines
+    ]
+    if updated != lines:
+        write_lines_atomic(mooncfg, updated)
+    moonraker = context["moonraker"]
+    if not _has_line(moonraker, MOONRAKER_INCLUDE):
+        await context.run(
+            sys.executable,
+            context.path("src", "search_replace.py"),
+            OLD_MOONRAKER_INCLUDE,
+            MOONRAKER_INCLUDE,
+            moonraker,
+        )
+
+
+async def allow_service(context: Context) -> None:
+    """Add the printcfg service to the Moonraker allowlist."""
+    allowlist = context["allowlist"]
+    if _has_line(allowlist, REPO):
+        return
+    with open(allowlist, "a+", encoding="utf-8") as allowlist_file:
+        allowlist_file.seek(0)
+        text = allowlist_file.read()
+        if text and not text.endswith("\n"):
+            allowlist_file.write("\n")
+        allowlist_file.write(f"{REPO}\n")
+
+
+async def store_repo_data(context: Context) -> None:
+    """Store the install paths in printcfg.conf (or that of the instance)."""
+    user_profile = os.path.join(context["config"], "user_profile.cfg")
+    profile = _search(user_profile, r"# Profile:(.*)")
+    data = {
+        "moonraker": context["moonraker"],
+        "printer": context["printer"],
+        "klipper_service": context["klipper_service"],
+        "klipper_dir": context["klipper_dir"],
+        "printer_dir": context["printer_dir"],
+        "moonraker_service": context["moonraker_service"],
+        "moonraker_dir": context["moonraker_dir"],
+        "allowlist": context["allowlist"],
+        "config": context["config"],
+        "repo": REPO,
+        "repo_dir": context.repo_dir,
+        "profile": profile,
+    }
+    write_lines_atomic(
+        context.path(REPO_DATA),
+        [f"{key}={value}\n" for key, value in data.items()],
+    )
+
+
+async def verify_install(context: Context) -> None:
+    """Check that printcfg is installed correctly."""
+    config = context["config"]
+    printer = context["printer"]
+    moonraker = context["moonraker"]
+    checks = (
+        (os.path.isfile(printer), f"File '{printer}' not found"),
+        (os.path.isfile(moonraker), f"File '{moonraker}' not found"),
+        (os.path.isfile(context["allowlist"]), "Moonraker allowlist not found"),
+        (
+            _has_line(printer, USER_CONFIG_INCLUDE),
+            f"{REPO} config not included in {printer}",
+        ),
+        (
+            _has_line(moonraker, MOONRAKER_INCLUDE),
+            f"{REPO} config not included in {moonraker}",
+        ),
+        (os.path.islink(os.path.join(config, REPO)), f"{REPO} symlink not created"),
+        (os.path.isfile(os.path.join(config, "user_config.cfg")), "No user config"),
+        (os.path.isfile(os.path.join(config, "user_profile.cfg")), "No user profile"),
+    )
+    problems = [message for passed, message in checks if not passed]
+    if problems:
+        raise StepError("; ".join(problems))
+
+
+async def run_setup(context: Context) -> None:
+    """Run the setup checks."""
+    await context.run("bash", context.path("scripts", "setup.sh"), context["profile"])
+
+
+async def restart_services(context: Context) -> None:
+    """
+    Restart the Klipper (unless it would interrupt a print) and Moonraker
+    units of the instance.
+    """
+    printer_data = context["printer_data"]
+    klipper = context.values.get("klipper_unit", "")
+    moonraker = context.values.get("moonraker_unit", "")
+    if not klipper:
+        context.note(f"No klipper service found for {printer_data}: restart it.")
+    else:
+        # Ask the Moonraker of this instance
+        idle, output = await context.run(
+            sys.executable,
+            context.path("src", "moonraker.py"),
+            "idle",
+            check=False,
+            env={"PRINTCFG_DATA": printer_data},
+        )
+        if idle == 0:
+            await context.run("systemctl", "restart", klipper)
+        else:
+            context.note(f"{output.strip()} Restart {klipper} once it has finished.")
+    if not moonraker:
+        context.note(f"No moonraker service found for {printer_data}: restart it.")
+    else:
+        await context.run("systemctl", "restart", moonraker)
+
+
+def install_steps() -> List[Step]:
+    """Get the steps of an update."""
+    config_steps = ("profile", "link", "printer_cfg", "moonraker_conf", "allowlist")
+    return [
+        Step("dependencies", install_dependencies, timeout=600.0, retries=1),
+        Step("fetch", fetch_repo, ("dependencies",), timeout=180.0, retries=2),
+        Step("checkout", checkout_branch, ("fetch",)),
+        Step("requirements", install_requirements, ("checkout",), 900.0, retries=1),
+        Step("service", install_service, ("checkout",)),
+        Step("bin", link_bin, ("checkout",)),
+        Step("log4bash", install_log4bash, ("checkout",), retries=2),
+        Step("locate", locate_config),
+        Step("snapshot", snapshot_config, ("locate",)),
+        Step("profile", sync_user_profile, ("checkout", "snapshot")),
+        Step("link", link_repo, ("locate",)),
+        Step("printer_cfg", include_user_config, ("checkout", "snapshot")),
+        Step("moonraker_conf", include_moonraker_config, ("checkout", "snapshot")),
+        Step("allowlist", allow_service, ("locate",)),
+        Step("verify", verify_install, config_steps),
+        Step("store", store_repo_data, ("profile",)),
+        Step(
+            "setup",
+            run_setup,
+            ("verify", "store", "requirements", "service", "bin", "log4bash"),
+            timeout=600.0,
+        ),
+        Step("restart", restart_services, ("setup",), timeout=180.0),
+    ]
+
+
+def print_result(result: StepResult):
+    """Print the result of a step."""
+    if result.status == "ok":
+        retried = f", {result.attempts} attempts" if result.attempts > 1 else ""
+        seconds = f"{result.seconds:.1f}s{retried}"
+        print(f"\033[32m  ok      \033[0m{result.name} ({seconds})")
+    elif result.status == "resumed":
+        print(f"\033[36m  resumed \033[0m{result.name}")
+    elif result.status == "failed":
+        print(f"\033[31m  failed  \033[0m{result.name}: {result.message}")
+    else:
+        print(f"\033[33m  skipped \033[0m{result.name}")
+
+
+def run_install(
+    profile: str = DEFAULT_PROFILE,
+    branch: Optional[str] = None,
+    fresh: bool = False,
+    jobs: int = DEFAULT_JOBS,
+    state_file: Optional[str] = STATE_FILE,
+    offline: Optional[bool] = None,
+) -> bool:
+    """
+    Updates printcfg, resuming an unfinished update.
+
+    Args:
+        profile: The profile to install.
+        branch: The branch to switch to (default: stay on the current one).
+        fresh: Run every step, even those done by an unfinished update.
+        jobs: The number of steps run at once.
+        state_file: Where the steps done are recorded.
+        offline: Only use the local mirror (default: PRINTCFG_OFFLINE).
+
+    Returns:
+        True if every step succeeded.
+    """
+    context = Context(profile, branch, mirror=Mirror(offline=offline))
+    orchestrator = Orchestrator(install_steps(), state_file, jobs)
+    key = {
+        "profile": profile,
+        "branch": branch or "",
+        "printer_data": context.printer_data,
+    }
+    logger.info("Updating %s: %s", REPO, key)
+    start = time.perf_counter()
+    results = asyncio.run(orchestrator.run(context, key, fresh, on_result=print_result))
+    for note in context.notes:
+        print(f"\033[33m{note}\033[0m")
+    failed = [result.name for result in results if result.status == "failed"]
+    seconds = time.perf_counter() - start
+    if failed:
+        logger.error("Update failed in %.1fs at: %s", seconds, failed)
+        return False
+    logger.info("Update done in %.1fs", seconds)
+    return True
+
+
+def main(argv: List[str]) -> int:
+    """Update printcfg from the command line."""
+    args = argv[1:]
+    positional: List[str] = []
+    fresh = False
+    offline: Optional[bool] = None
+    plan = False
+    jobs = DEFAULT_JOBS
+    try:
+        while args:
+            arg = args.pop(0)
+            if arg == "--fresh":
+                fresh = True
+            elif arg == "--offline":
+                offline = True
+            elif arg == "--plan":
+                plan = True
+            elif arg == "--jobs":
+                jobs = int(args.pop(0))
+            elif arg.startswith("--") or len(positional) == 2:
+                raise ValueError(arg)
+            else:
+                positional.append(arg)
+    except (IndexError, ValueError) as err:
+        print(f"Error: Invalid argument {err}")
+        print(
+            "Usage: python3 orchestrator.py [<profile>] [<branch>] [--fresh] "
+            "[--offline] [--jobs N] [--plan]"
+        )
+        return 1
+    if plan:
+        for number, stage in enumerate(Orchestrator(install_steps()).stages(), 1):
+            print(f"{number}: {', '.join(stage)}")
+        return 0
+    profile = positional[0] if positional else DEFAULT_PROFILE
+    branch = positional[1] if len(positional) > 1 else None
+    return 0 if run_install(profile, branch, fresh, jobs, offline=offline) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Match many literal and regex patterns against a file in a single scan.
+
+The patterns are compiled once:
+    - Literal patterns are built into an Aho-Corasick automaton.
+    - Regex patterns are compiled individually.
+    - All patterns are also joined into one combined alternation
+      that rejects lines matching no pattern at C speed, so long
+      blocks such as the #*# SAVE_CONFIG bed mesh cost one search
+      per line no matter how many patterns there are. Joining
+      renumbers capture groups, so there is no combined alternation
+      when a regex has groups (and maybe backreferences to them).
+
+Usage:
+    python3 pattern_matcher.py <file_name> <pattern> [<pattern> ...]
+    Prefix a pattern with 're:' to treat it as a regular expression.
+"""
+
+import re
+import sys
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Sequence, Tuple
+
+# Pattern kinds
+LITERAL = "literal"
+REGEX = "regex"
+
+
+class Hit(NamedTuple):
+    """A single pattern match."""
+
+    pattern_id: int
+    line: int
+    offset: int
+    text: str
+
+
+class PatternMatcher:
+    """A set of literal and regex patterns compiled for a single scan."""
+
+    def __init__(self, patterns: Sequence[Tuple[str, str]]):
+        """
+        Compiles the patterns.
+
+        Args:
+            patterns: The (pattern, kind) pairs to match, where kind is
+                      'literal' or 'regex'. Each pattern is identified
+                      by its index in this sequence.
+        """
+        self.patterns = list(patterns)
+        literals: List[Tuple[int, str]] = []
+        self._regexes: List[Tuple[int, "re.Pattern[str]"]] = []
+        self._empty: List[int] = []
+        alternatives = []
+        grouped = False
+        for pattern_id, (pattern, kind) in enumerate(self.patterns):
+            if kind == LITERAL:
+                if pattern:
+                    literals.append((pattern_id, pattern))
+                else:
+                    self._empty.append(pattern_id)
+                alternatives.append(re.escape(pattern))
+            elif kind == REGEX:
+                regex = re.compile(pattern)
+                self._regexes.append((pattern_id, regex))
+                alternatives.append(f"(?:{pattern})")
+                grouped = grouped or regex.groups > 0
+            else:
+                raise ValueError(f"Invalid pattern kind: {kind}")
+        self._goto, self._out = _build_automaton(literals)
+        # Combined alternation used to skip lines that cannot match
+        self._prefilter = None
+        if not grouped:
+            try:
+                self._prefilter = re.compile("|".join(alternatives)).search
+            except re.error:
+                pass
+
+    def scan_line(self, line: str, line_no: int = 0) -> List[Hit]:
+        """
+        Finds every hit of every pattern in a line.
+
+        Args:
+            line: The line to scan.
+            line_no: The line number reported in the hits.
+
+        Returns:
+            The hits ordered by offset.
+        """
+        if not self.patterns:
+            return []
+        if self._prefilter is not None and not self._prefilter(line):
+            return []
+        hits = [Hit(pattern_id, line_no, 0, "") for pattern_id in self._empty]
+        # Run the literals through the automaton
+        if len(self._goto) > 1:
+            goto = self._goto
+            out = self._out
+            state = 0
+            for index, char in enumerate(line):
+                next_state = goto[state].get(char)
+                while next_state is None and state:
+                    state = goto[state][_FAIL]
+                    next_state = goto[state].get(char)
+                state = next_state or 0
+                for pattern_id, length in out[state]:
+                    start = index - length + 1
+                    text = line[start : index + 1]
+                    hits.append(Hit(pattern_id, line_no, start, text))
+        # Run the regexes that can match
+        for pattern_id, regex in self._regexes:
+            for match in regex.finditer(line):
+                hits.append(Hit(pattern_id, line_no, match.start(), match.group(0)))
+        hits.sort(key=lambda hit: (hit.offset, hit.pattern_id))
+        return hits
+
+    def scan(self, lines: Iterable[str]) -> Iterator[Hit]:
+        """
+        Finds every hit of every pattern in the lines.
+
+        Args:
+            lines: The lines to scan.
+
+        Yields:
+            The hits in line and offset order, with 0-based line numbers.
+        """
+        for line_no, line in enumerate(lines):
+            yield from self.scan_line(line, line_no)
+
+    def line_matches(self, lines: Iterable[str]) -> Iterator[Tuple[int, List[int]]]:
+        """
+        Finds which patterns match each line.
+
+        Args:
+            lines: The lines to scan.
+
+        Yields:
+            The 0-based line number and sorted pattern ids of each
+            line matched by at least one pattern.
+        """
+        for line_no, line in enumerate(lines):
+            hits = self.scan_line(line, line_no)
+            if hits:
+                yield line_no, sorted({hit.pattern_id for hit in hits})
+
+
+# Key of the failure link stored alongside the transitions of each state
+_FAIL = ""
+
+
+def _build_automaton(
+    literals: Sequence[Tuple[int, str]]
+) -> Tuple[List[Dict[str, int]], List[List[Tuple[int, int]]]]:
+    """
+    Builds an Aho-Corasick automaton for the literal patterns.
+
+    Returns:
+        The transition table of each state (with its failure link stored
+        under an empty key) and the (pattern id, length) outputs of each state.
+    """
+    goto: List[Dict[str, int]] = [{}]
+    out: List[List[Tuple[int, int]]] = [[]]
+    for pattern_id, text in literals:
+        state = 0
+        for char in text:
+            next_state = goto[state].get(char)
+            if next_state is None:
+                next_state = len(goto)
+                goto[state][char] = next_state
+                goto.append({})
+                out.append([])
+            state = next_state
+        out[state].append((pattern_id, len(text)))
+    # Breadth-first pass to set the failure links
+    queue = deque()
+    for char, state in goto[0].items():
+        goto[state][_FAIL] = 0
+        queue.append(state)
+    while queue:
+        state = queue.popleft()
+        for char, next_state in list(goto[state].items()):
+            if char == _FAIL:
+                continue
+            queue.append(next_state)
+            fail = goto[state][_FAIL]
+            while char not in goto[fail] and fail:
+                fail = goto[fail][_FAIL]
+            fail = goto[fail].get(char, 0)
+            goto[next_state][_FAIL] = fail
+            out[next_state] = out[next_state] + out[fail]
+    return goto, out
+
+
+def compile_patterns(patterns: Iterable[str]) -> PatternMatcher:
+    """Compiles patterns, treating those prefixed with 're:' as regexes."""
+    return PatternMatcher(
+        [
+            (pattern[3:], REGEX) if pattern.startswith("re:") else (pattern, LITERAL)
+            for pattern in patterns
+        ]
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python3 pattern_matcher.py <file_name> <pattern> [<pattern> ...]")
+        print("Prefix a pattern with 're:' to treat it as a regular expression.")
+        sys.exit(1)
+    matcher = compile_patterns(sys.argv[2:])
+    with open(sys.argv[1], "r", encoding="utf-8") as file:
+        for hit in matcher.scan(line.rstrip("\n") for line in file):
+            print(f"{hit.pattern_id}:{hit.line + 1}:{hit.offset}:{hit.text}")
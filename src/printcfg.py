@@ -25,79 +25,38 @@
 #   change: Change the printcfg profile
 #   remove: Remove the printcfg service
 #   update: Update printcfg
+#   daemon: Run the printcfg helper daemon
+#   --all <status|update|repair>: Run a command on every Klipper instance
 """
     PrintCFG Klipper Suite -
     A configuration manager
     and macro suite
     for Klipper printers.
 """
-import datetime
-import getpass
-import logging
 import os
-import subprocess
 import sys
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
-logger: logging.Logger = logging.getLogger(__name__)
+from log_setup import get_logger
 
 # Set the repo name
 REPO = "printcfg"
-# Set arguments
-ARGUMENTS_LIST = [
-    "help",
-    "install",
-    "restart",
-    "change",
-    "remove",
-    "update",
-    "repair",
-    "branch",
-    "status",
-]
-# Get the current user name
-current_user = getpass.getuser()
+# Name of the instance when run by fleet mode
+instance = os.environ.get("PRINTCFG_INSTANCE")
+logger = get_logger(REPO, log_name=f"{REPO}-{instance}" if instance else None)
+
 user_home = os.path.expanduser("~")
-profile_path = f"{user_home}/printer_data/config/user_profile.cfg"
+# The printer_data directory (PRINTCFG_DATA selects another instance)
+printer_data = os.environ.get("PRINTCFG_DATA", f"{user_home}/printer_data")
+profile_path = f"{printer_data}/config/user_profile.cfg"
+# The install paths, one file per fleet instance (~/printer_data keeps printcfg.conf)
+repo_data = (
+    f"{user_home}/{REPO}/{REPO}-{instance}.conf"
+    if instance and instance != "printer"
+    else f"{user_home}/{REPO}/{REPO}.conf"
+)
 setup_script = f"{user_home}/{REPO}/scripts/setup.sh"
 
-# Set the logfile
-logfile = f"{user_home}/{REPO}/logs/{REPO}.log"
-
-# Check the date of the first log entry
-# If it is older than 30 days, delete the logfile
-if os.path.exists(logfile):
-    with open(logfile, "r", encoding="utf-8") as file:
-        first_line = file.readline()
-        if first_line:
-            first_line = first_line.split(" - ")[0]
-            first_date = datetime.datetime.strptime(first_line, "%Y-%m-%d %H:%M:%S,%f")
-            thirty_days_ago = datetime.datetime.now() - datetime.timedelta(days=30)
-            if first_date < thirty_days_ago:
-                os.remove(logfile)
-
-# Check if the logfile exists
-log_dir = f"{user_home}/{REPO}/logs/"
-if not os.path.exists(log_dir):
-    try:
-        # Create the log directory
-        os.makedirs(log_dir)
-    except OSError as err:
-        print(f"Error creating log directory: {err}")
-    # Create the logfile
-    try:
-        with open(logfile, "w", encoding="utf-8") as file:
-            pass
-        logging.info("Created log file: %s", logfile)
-    except OSError as err:
-        logging.error("Error creating log file: %s", err)
-
-# Set the logging level
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-handler = logging.FileHandler(logfile)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-
 
 def show_help():
     """Show the help message."""
@@ -106,44 +65,43 @@ def show_help():
     print(f"  install: Install the {REPO} service")
     print(f"  restart: Restart the {REPO} service")
     print("  change: Change the current profile")
-    print(f"  branch: Change the current {REPO} branch")
+    print(f"  branch <branch> [--fresh] [--offline]: Change the {REPO} branch")
     print(f"  remove: Remove {REPO} service")
-    print(f"  update: Update {REPO}")
-    print(f"  status: Show the status of the {REPO} service")
+    print(f"  update [--fresh] [--offline]: Update {REPO}, resuming a failed update")
+    print(f"  check-update [<branch>]: Check whether a {REPO} update is available")
+    print(f"  status [--json]: Show the status of the {REPO} service")
     print(f"  repair: Repair the {REPO} service")
+    print(f"  daemon: Run the {REPO} helper daemon")
+    print("  --all <status|update|repair>: Run a command on every printer instance")
+    print("  bundle [--output <file>]: Build a macro bundle pruned for the profile")
+    print("  analyze-log [<klippy.log> ...]: Summarize the prints of klippy.log")
+    print("  check-gcode [<file.gcode> ...]: Check G-code files against the profile")
+    print("  snapshot [<note>]: Snapshot the config files")
+    print("  snapshots [--json]: List the snapshots of the config files")
+    print("  rollback <id>: Restore the config files of a snapshot")
     print("  help: Show this help message")
     logger.info("Help message shown.")
     sys.exit(0)
 
 
-def is_service_active(service: str):
-    """Determine whether a systemctl system service is active."""
-    # Check if the service exists
-    logger.debug("Checking if service exists: %s", service)
-    if not os.path.exists(f"/etc/systemd/system/{service}.service"):
+def is_service_active(service: str) -> bool:
+    """Determine whether a systemctl system service is enabled and active."""
+    from service_state import ServiceStateError, get_state
+
+    logger.debug("Checking service state: %s", service)
+    try:
+        state = get_state(service)
+    except ServiceStateError as err:
+        logger.error("Error reading service state: %s", err)
+        return False
+    if not state.exists:
         logger.debug("Service does not exist: %s", service)
         return False
-    else:
-        logger.debug("Service exists: %s", service)
-        # Check if service is enabled
-        logger.debug("Checking if service is enabled: %s", service)
-        if (
-            subprocess.run(
-                ["systemctl", "is-enabled", service], capture_output=True, check=True
-            ).stdout.decode("utf-8")
-            == "enabled\n"
-        ):
-            if (
-                subprocess.run(
-                    ["systemctl", "is-active", service], capture_output=True, check=True
-                ).stdout.decode("utf-8")
-                == "active\n"
-            ):
-                logger.debug("Service is active: %s", service)
-                return True
-            else:
-                logger.debug("Service is not active: %s", service)
-                return False
+    if state.enabled and state.active:
+        logger.debug("Service is active: %s", service)
+        return True
+    logger.debug("Service is not active: %s", service)
+    return False
 
 
 def load_config():
@@ -151,9 +109,11 @@ def load_config():
     Load the printcfg.conf config file.
     And output its contents.
     """
+    import shutil
+
     logger.info("Loading config file...")
     # Set the config file path
-    config_path = f"{user_home}/{REPO}/printcfg.conf"
+    config_path = repo_data
     # Log and print the config file path
     logger.debug("Config file path: %s", config_path)
     print(f"### START OF {config_path} FILE ###")
@@ -161,26 +121,25 @@ def load_config():
     if not os.path.exists(config_path):
         logger.error("Config file not found: %s", config_path)
         raise FileNotFoundError(f"Config file not found: {config_path}")
-    # Load the config file
+    # Stream the config file to the output
+    sys.stdout.flush()
     with open(config_path, "r", encoding="utf-8") as config_file:
-        for line in config_file:
-            print(line, end="")
-            logger.debug("Config line: %s", line)
+        shutil.copyfileobj(config_file, sys.stdout)
     print(f"### END OF {config_path} FILE ###")
     logger.info("Config file loaded.")
 
 
 def find_profile(path: str):
     """Find the profile name in the given file."""
+    from config_cache import load_config as load_parsed
+
     logger.debug("Searching for profile name in file: %s", path)
     # Find the profile name (Eg: '# Profile: default' = 'default')
-    with open(path, "r", encoding="utf-8") as p_file:
-        for line in p_file:
-            if line.startswith("# Profile:"):
-                the_profile = line[10:].strip()
-                logger.debug("Found profile name: %s", the_profile)
-                # Return the profile name
-                return the_profile
+    marker = load_parsed(path).marker("Profile")
+    if marker is not None and marker.value:
+        logger.debug("Found profile name: %s", marker.value)
+        # Return the profile name
+        return marker.value
 
     # If no profile was found, raise an error
     logger.error("Profile not found in file: %s", path)
@@ -189,6 +148,8 @@ def find_profile(path: str):
 
 def normal_ops():
     """Run the script normally."""
+    import subprocess
+
     logger.info("Starting normal operations...")
     print(f"Starting {REPO}...")
     try:
@@ -214,6 +175,8 @@ def normal_ops():
 
 def generate_service():
     """Generate the printcfg service."""
+    import subprocess
+
     logger.info("Generating %s service...", REPO)
     print(f"Generating {REPO} service...")
     # Define the path to the second script
@@ -230,7 +193,9 @@ def generate_service():
         logger.error("Error: The script '%s' does not exist.", script_path)
         return
     # Start the second script as root with the current user name as the first argument
-    command = ["sudo", "python3", script_path, current_user, user_home, mode]
+    import getpass
+
+    command = ["sudo", "python3", script_path, getpass.getuser(), user_home, mode]
     logger.debug("Executing command: %s", command)
     try:
         result = subprocess.run(command, capture_output=True, check=False)
@@ -256,6 +221,10 @@ def generate_service():
 
 def change_profile(profile_name: str):
     """Change the profile."""
+    import subprocess
+
+    from snapshots import take_snapshot
+
     logger.info("Changing profile to %s...", profile_name)
     print(f"Changing profile to {profile_name}...")
     # Define the path to the second script
@@ -266,6 +235,10 @@ def change_profile(profile_name: str):
         print(f"Error: The script '{script_path}' does not exist.")
         logger.error("Error: The script '%s' does not exist.", script_path)
         return
+    # Keep a restore point of the config files
+    take_snapshot(
+        "change", f"Before changing to profile {profile_name}", f"{printer_data}/config"
+    )
     # Start the change profile script
     command = ["bash", script_path, profile_name]
     logger.debug("Executing command: %s", command)
@@ -281,27 +254,25 @@ def change_profile(profile_name: str):
     sys.exit(0)
 
 
-def update_printcfg():
-    """Update printcfg."""
+def update_printcfg(fresh: bool = False, offline: Optional[bool] = None):
+    """
+    Update printcfg.
+
+    Args:
+        fresh: Run every update step, even those done by an unfinished update.
+        offline: Update from the local mirror only (default: PRINTCFG_OFFLINE).
+    """
+    from orchestrator import run_install
+
     logger.info("Updating %s...", REPO)
     print(f"Updating {REPO}...")
-    # Define the path to the second script
-    script_path = f"{user_home}/{REPO}/scripts/install.sh"
-    # Check if the second script exists
-    if not os.path.isfile(script_path):
-        print(f"Error: The script '{script_path}' does not exist.")
-        return
     # Find the current profile
     profile_name = find_profile(profile_path)
-    # Start the update script
-    command = ["bash", script_path, profile_name]
-    logger.debug("Executing command: %s", command)
-    try:
-        subprocess.run(command, check=True)
-    except subprocess.CalledProcessError as errr:
-        print("Error: The subprocess returned an error.")
-        print(errr.stderr)
-        logger.error("Error: The subprocess returned an error: %s", errr.stderr)
+    # Run the update steps
+    if not run_install(profile_name, fresh=fresh, offline=offline):
+        print(f"Error: The update failed. Run '{REPO} update' again to resume it.")
+        logger.error("Error: The update failed.")
+        sys.exit(1)
     # Exit gracefully
     logger.info("%s updated successfully.", REPO)
     print(f"{REPO} updated successfully.")
@@ -317,6 +288,8 @@ def restart_service(service_name: str):
     Returns:
         True if the service was restarted successfully, False otherwise.
     """
+    import subprocess
+
     logger.info("Restarting %s service...", service_name)
     print(f"Restarting {service_name} service...")
     command = ["systemctl", "restart", f"{service_name}.service"]
@@ -332,32 +305,34 @@ def restart_service(service_name: str):
         return False
 
 
-def change_branch(branch_name: str):
-    """Changes the branch of the printcfg repo."""
+def change_branch(
+    branch_name: str, fresh: bool = False, offline: Optional[bool] = None
+):
+    """
+    Changes the branch of the printcfg repo.
+
+    Args:
+        branch_name: The branch to switch to.
+        fresh: Run every update step, even those done by an unfinished update.
+        offline: Update from the local mirror only (default: PRINTCFG_OFFLINE).
+    """
+    from orchestrator import run_install
+
     logger.info("Changing to branch '%s'.", branch_name)
-    print(f"Changing to branch '{branch_name}'.")
-    # Define the path to the second script
-    script_path = f"{user_home}/{REPO}/scripts/install.sh"
-    logger.debug("Script: %s", script_path)
-    # Check if the second script exists
-    if not os.path.isfile(script_path):
-        print(f"Error: The script '{script_path}' does not exist.")
-        return
     # Find the current profile
     profile_name = find_profile(profile_path)
-    # Start the change branch script
-    command = ["bash", script_path, profile_name, branch_name]
-    logger.debug("Executing command: %s", command)
     logger.debug(
         "Changing to branch '%s' with profile '%s'.", branch_name, profile_name
     )
     print(f"Changing to branch '{branch_name}' with profile '{profile_name}'.")
-    try:
-        subprocess.run(command, check=False)
-    except subprocess.CalledProcessError as errbranch:
-        print("Error: The subprocess returned an error.")
-        print(errbranch.stderr)
-        logger.error("Error: The subprocess returned an error: %s", errbranch.stderr)
+    # Run the update steps on the new branch
+    if not run_install(profile_name, branch_name, fresh=fresh, offline=offline):
+        print(
+            f"Error: Changing to branch '{branch_name}' failed. "
+            "Run the command again to resume it."
+        )
+        logger.error("Error: Changing to branch '%s' failed.", branch_name)
+        sys.exit(1)
     # Exit gracefully
     logger.info("Succesfully changed to branch '%s'.", branch_name)
     print(f"Succesfully changed to branch '{branch_name}'.")
@@ -366,6 +341,10 @@ def change_branch(branch_name: str):
 
 def repair_printcfg():
     """Repairs printcfg."""
+    import subprocess
+
+    from snapshots import take_snapshot
+
     logger.info("Repairing %s...", REPO)
     print(f"Repairing {REPO}...")
     # Define the path to the second script
@@ -376,6 +355,10 @@ def repair_printcfg():
         return
     # Find the current profile
     profile_name = find_profile(profile_path)
+    # Keep a restore point of the config files
+    take_snapshot(
+        "repair", f"Before repairing profile {profile_name}", f"{printer_data}/config"
+    )
     # Start the update script
     command = ["bash", script_path, profile_name, "force"]
     logger.debug("Executing command: %s", command)
@@ -385,6 +368,7 @@ def repair_printcfg():
         print("Error: The subprocess returned an error.")
         print(errepair.stderr)
         logger.error("Error: The subprocess returned an error: %s", errepair.stderr)
+        sys.exit(1)
     # Exit gracefully
     logger.info("Repairing %s completed successfully.", REPO)
     print(f"Repairing {REPO} completed successfully.")
@@ -393,6 +377,8 @@ def repair_printcfg():
 
 def remove_printcfg():
     """Remove printcfg from the system."""
+    import subprocess
+
     logger.info("Removing %s...", REPO)
     print(f"Removing {REPO}...")
     # Define the path to the second script
@@ -418,6 +404,102 @@ def remove_printcfg():
     sys.exit(0)
 
 
+def file_fingerprint(path: str) -> Optional[Dict[str, Union[str, int, float]]]:
+    """Get the size, modification time and SHA-256 hash of a file."""
+    from sync_profile import file_hash
+
+    try:
+        stat = os.stat(path)
+        sha256 = file_hash(path)
+    except OSError:
+        return None
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+
+
+def get_status(service_name: str) -> Dict[str, Any]:
+    """
+    Collect the status of printcfg.
+
+    Args:
+        service_name: The name of the systemctl service.
+
+    Returns:
+        The service state, profile, patch versions and config fingerprints.
+    """
+    from config_cache import load_config as load_parsed
+    from read_patch_notes import find_highest_version
+    from service_state import ServiceStateError, get_state
+
+    status: Dict[str, Any] = {"instance": printer_data}
+    try:
+        state = get_state(service_name)
+        status["service"] = {
+            "unit": state.unit,
+            "exists": state.exists,
+            "enabled": state.enabled,
+            "active": state.active,
+            "load_state": state.load_state,
+            "active_state": state.active_state,
+            "sub_state": state.sub_state,
+            "main_pid": state.main_pid,
+            "active_since": state.active_since,
+        }
+    except ServiceStateError as err:
+        status["service"] = {"unit": service_name, "error": str(err)}
+    try:
+        status["profile"] = find_profile(profile_path)
+    except (OSError, ValueError):
+        status["profile"] = None
+    config_path = os.path.join(os.path.dirname(profile_path), "user_config.cfg")
+    for key, path in (("user_config", config_path), ("user_profile", profile_path)):
+        status[key] = {"path": path, "profile": None, "patch": None}
+        try:
+            config = load_parsed(path)
+        except (OSError, ValueError):
+            continue
+        for marker in ("Profile", "Patch"):
+            found = config.marker(marker)
+            status[key][marker.lower()] = found.value if found else None
+    latest = None
+    if status["profile"]:
+        notes = f"{user_home}/{REPO}/profiles/{status['profile']}/patch_notes.txt"
+        try:
+            latest = find_highest_version(notes)
+        except OSError:
+            latest = None
+    status["latest_patch"] = latest
+    status["patch_pending"] = latest is not None and any(
+        status[key]["patch"] != latest for key in ("user_config", "user_profile")
+    )
+    status["files"] = {
+        path: file_fingerprint(path)
+        for path in (
+            repo_data,
+            status["user_config"]["path"],
+            status["user_profile"]["path"],
+        )
+    }
+    status["klipper"] = get_klipper_status()
+    status["ok"] = bool(status["service"].get("active"))
+    return status
+
+
+def get_klipper_status() -> Dict[str, Any]:
+    """Get the live Klipper and print state from Moonraker."""
+    from moonraker import MoonrakerError, default_client
+
+    client = default_client()
+    try:
+        klipper: Dict[str, Any] = {"state": client.klippy_state()}
+        if klipper["state"] == "ready":
+            stats = client.query("print_stats").get("print_stats", {})
+            klipper["print_state"] = stats.get("state")
+            klipper["filename"] = stats.get("filename")
+    except MoonrakerError as err:
+        klipper = {"state": None, "error": str(err)}
+    return klipper
+
+
 def show_status(service_name: str):
     """Show the status of a systemctl service.
 
@@ -427,29 +509,24 @@ def show_status(service_name: str):
     Returns:
         True if the status was displayed successfully, False otherwise.
     """
+    from service_state import ServiceStateError, format_state, get_state
+
     logger.info("Showing status of %s service...", service_name)
     print(f"Showing status of {service_name} service...")
-    # Get the systemctl status
-    command = ["systemctl", "status", f"{service_name}.service"]
-    logger.debug("Executing command: %s", command)
+    # Read the service state with a single systemctl call
     try:
-        result = subprocess.run(command, capture_output=True, check=False)
-    except subprocess.CalledProcessError as errstat:
-        print("Error: The subprocess returned an error.")
-        print(errstat.stderr)
-        logger.error("Error: The subprocess returned an error: %s", errstat.stderr)
-        return False
-    logger.debug("Command output: %s", result.stdout.decode("utf-8"))
-    if result.returncode != 0:
-        print(f"Error: The command '{command}' failed with code {result.returncode}.")
-        logger.error(
-            "Error: The command '%s' failed with code %s.", command, result.returncode
-        )
-        print(f"Output from command: {result.stdout.decode('utf-8')}")
-        print(f"Error from command: {result.stderr.decode('utf-8')}")
+        state = get_state(service_name)
+    except ServiceStateError as errstat:
+        print(f"Error: {errstat}")
+        logger.error("Error reading service state: %s", errstat)
         return False
     # Print the status
-    print(result.stdout.decode("utf-8"))
+    print(format_state(state))
+    klipper = get_klipper_status()
+    if klipper["state"] is None:
+        print(f"Klipper: unknown ({klipper['error']})")
+    else:
+        print(f"Klipper: {klipper['state']}, print: {klipper.get('print_state', '-')}")
     logger.info("Showing config file...")
     print(f"Current {REPO} configuration:")
     load_config()
@@ -467,83 +544,127 @@ def show_status(service_name: str):
     return True
 
 
-if __name__ == "__main__":
+def require_argument(args: List[str], usage: str) -> str:
+    """Get the single argument of a subcommand or exit with its usage."""
+    name = usage.split()[0]
+    if len(args) != 1:
+        print(f"Error: The {name} script requires two arguments.")
+        print(f"Usage: python3 {REPO}.py {usage}")
+        logger.error("Error: The %s script requires two arguments.", name)
+        sys.exit(1)
+    return args[0]
+
+
+def cmd_change(args: List[str]):
+    """Check the requested profile and change to it."""
+    profile = require_argument(args, "change <profile>")
+    profile_dir = f"{user_home}/{REPO}/profiles/{profile}"
+    logger.debug("Profile path: %s", profile_dir)
+    print(f"Changing to profile '{profile}'")
+    # If the profile is 'backup' then skip the check
+    if profile == "backup":
+        logger.info("Changing to backup profile.")
+    # If the profile path does not exist, exit
+    elif not os.path.isdir(profile_dir):
+        print(f"Error: The profile '{profile}' does not exist.")
+        logger.error("Error: The profile '%s' does not exist.", profile)
+        sys.exit(1)
+    else:
+        logger.info("Changing to profile '%s'.", profile)
+    change_profile(profile)
+
+
+def update_options(args: List[str]) -> Tuple[List[str], bool, Optional[bool]]:
+    """Split the --fresh and --offline options from the arguments of a command."""
+    fresh = "--fresh" in args
+    offline = True if "--offline" in args else None
+    return [arg for arg in args if arg not in ("--fresh", "--offline")], fresh, offline
+
+
+def cmd_update(args: List[str]):
+    """Handle 'printcfg update [--fresh] [--offline]'."""
+    _, fresh, offline = update_options(args)
+    update_printcfg(fresh, offline)
+
+
+def cmd_branch(args: List[str]):
+    """Handle 'printcfg branch <branch> [--fresh] [--offline]'."""
+    args, fresh, offline = update_options(args)
+    branch = require_argument(args, "branch <branch> [--fresh] [--offline]")
+    change_branch(branch, fresh, offline)
+
+
+def cmd_status(args: List[str]) -> bool:
+    """Show the status, as JSON with --json."""
+    if args == ["--json"]:
+        import json
+
+        status = get_status(REPO)
+        print(json.dumps(status, indent=2))
+        return status["ok"]
+    if args:
+        print(f"Usage: python3 {REPO}.py status [--json]")
+        sys.exit(1)
+    return show_status(REPO)
+
+
+# Subcommands and their handlers.
+# Handlers defined in other modules are given as 'module:function'
+# and only imported when their subcommand is run.
+COMMANDS: Dict[str, Union[str, Callable[[List[str]], Any]]] = {
+    "help": lambda args: show_help(),
+    "install": lambda args: generate_service(),
+    "restart": lambda args: restart_service(REPO),
+    "change": cmd_change,
+    "remove": lambda args: remove_printcfg(),
+    "update": cmd_update,
+    "repair": lambda args: repair_printcfg(),
+    "branch": cmd_branch,
+    "status": cmd_status,
+    "daemon": "printcfg_daemon:main",
+    "--all": "fleet:main",
+    "bundle": "macro_graph:cmd_bundle",
+    "analyze-log": "analyze_log:cmd_analyze",
+    "check-gcode": "gcode_meta:cmd_check",
+    "check-update": "git_mirror:cmd_check",
+    "snapshot": "snapshots:cmd_snapshot",
+    "snapshots": "snapshots:cmd_list",
+    "rollback": "snapshots:cmd_rollback",
+}
+
+
+def load_command(name: str) -> Callable[[List[str]], Any]:
+    """Load the handler of a subcommand."""
+    handler = COMMANDS[name]
+    if isinstance(handler, str):
+        import importlib
+
+        module_name, function_name = handler.split(":")
+        handler = getattr(importlib.import_module(module_name), function_name)
+    return handler
+
+
+def main(argv: List[str]) -> int:
+    """Run printcfg from the command line."""
     # Check if there are any arguments
-    if len(sys.argv) < 2:
+    if len(argv) < 2:
         logger.info("No arguments provided, running normal operations.")
         normal_ops()
-        sys.exit(1)
+        return 1
     # Check the argument
-    if sys.argv[1] not in ARGUMENTS_LIST:
-        print(f"Error: Invalid Argument: {sys.argv[1]}")
-        logger.error("Error: Invalid Argument: %s", sys.argv[1])
-        show_help()
-        sys.exit(1)
-    # If the argument is 'install' start the script as root
-    if sys.argv[1] == "install":
-        logger.info("Running install operations.")
-        generate_service()
-    # If the argument is 'change' check for a second argument
-    elif sys.argv[1] == "change":
-        if len(sys.argv) != 3:
-            print("Error: The change script requires two arguments.")
-            print(f"Usage: python3 {REPO}.py change <profile>")
-            logger.error("Error: The change script requires two arguments.")
-            sys.exit(1)
-        else:
-            # Check if the profile exists
-            profile = sys.argv[2]
-            logger.info("Running change operations.")
-            profile_path = f"{user_home}/{REPO}/profiles/{profile}"
-            logger.debug("Profile path: %s", profile_path)
-            print(f"Changing to profile '{profile}'")
-            # If the profile is 'backup' then skip the check
-            if profile == "backup":
-                logger.info("Changing to backup profile.")
-                change_profile(profile)
-            else:
-                # If the profile path does not exist, exit
-                if not os.path.isdir(profile_path):
-                    print(f"Error: The profile '{profile}' does not exist.")
-                    logger.error("Error: The profile '%s' does not exist.", profile)
-                    sys.exit(1)
-                else:
-                    logger.info("Changing to profile '%s'.", profile)
-                    change_profile(profile)
-    # If the argument is 'remove'
-    elif sys.argv[1] == "remove":
-        logger.info("Running remove operations.")
-        remove_printcfg()
-    elif sys.argv[1] == "update":
-        logger.info("Running update operations.")
-        update_printcfg()
-    elif sys.argv[1] == "status":
-        logger.info("Running status operations.")
-        show_status(REPO)
-    elif sys.argv[1] == "restart":
-        logger.info("Running restart operations.")
-        restart_service(REPO)
-    elif sys.argv[1] == "repair":
-        logger.info("Running repair operations.")
-        repair_printcfg()
-    elif sys.argv[1] == "branch":
-        logger.info("Running branch operations.")
-        # Make sure the branch was provided
-        if len(sys.argv) != 3:
-            print("Error: The branch script requires two arguments.")
-            print(f"Usage: python3 {REPO}.py branch <branch>")
-            logger.error("Error: The branch script requires two arguments.")
-            sys.exit(1)
-        else:
-            branch_arg = sys.argv[2]
-            change_branch(branch_arg)
-    elif sys.argv[1] == "help":
-        logger.info("Running help operations.")
+    if argv[1] not in COMMANDS:
+        print(f"Error: Invalid Argument: {argv[1]}")
+        logger.error("Error: Invalid Argument: %s", argv[1])
         show_help()
-    else:
-        logger.info("Running normal operations.")
-        normal_ops()
-
+        return 1
+    logger.info("Running %s operations.", argv[1])
+    if load_command(argv[1])(argv[2:]) is False:
+        logger.error("%s failed.", argv[1])
+        return 1
     # Exit gracefully
     logger.info("%s completed successfully.", REPO)
-    exit(0)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
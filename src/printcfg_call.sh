@@ -0,0 +1,122 @@
+#!/bin/bash
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# Shell client for the printcfg helper daemon.
+# Talks to the daemon socket with socat (or nc -U) so a call does not
+# start a python interpreter. When no daemon is listening, or neither
+# tool is installed, the call is passed on to printcfg_client.py.
+# Output and exit status are the same as printcfg_client.py.
+#
+# Usage:
+#   source ~/printcfg/src/printcfg_call.sh
+#   printcfg_call <operation> [args...]
+#
+# Example:
+#   printcfg_call replace "$old_line" "$new_line" "$printer"
+
+printcfg_src="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+printcfg_socket="${PRINTCFG_SOCKET:-$HOME/printcfg/printcfg.sock}"
+
+# Encode a shell string as a JSON string
+_printcfg_json_string() {
+    local text=$1
+    text=${text//\\/\\\\}
+    text=${text//\"/\\\"}
+    text=${text//$'\n'/\\n}
+    text=${text//$'\r'/\\r}
+    text=${text//$'\t'/\\t}
+    printf '"%s"' "$text"
+}
+
+# Print a JSON value the way printcfg_client.py prints a result
+# (the daemon only sends ASCII, other characters are \u escapes)
+_printcfg_print_value() {
+    local value=$1
+    case "$value" in
+        true) echo "True" ;;
+        false) echo "False" ;;
+        null) echo "None" ;;
+        \"*\")
+            value=${value:1:${#value}-2}
+            value=${value//\\\"/\"}
+            value=${value//\\\//\/}
+            printf '%b\n' "$value"
+            ;;
+        *) echo "$value" ;;
+    esac
+}
+
+# Send one request line to the daemon and print the reply line
+_printcfg_send() {
+    if command -v socat >/dev/null 2>&1; then
+        printf '%s\n' "$1" | socat -t 60 - UNIX-CONNECT:"$printcfg_socket" 2>/dev/null
+    elif command -v nc >/dev/null 2>&1; then
+        printf '%s\n' "$1" | nc -N -U "$printcfg_socket" 2>/dev/null
+    fi
+}
+
+printcfg_call() {
+    local op=$1
+    shift
+    local args=("$@")
+    # Position of the file argument of each operation
+    # (made absolute since the daemon runs in another directory)
+    local index=""
+    case "$op" in
+        find | exists) index=1 ;;
+        replace) index=2 ;;
+        lookup | edit | version | profile) index=0 ;;
+    esac
+    if [ -n "$index" ] && [ "$index" -lt "${#args[@]}" ] && [[ ${args[$index]} != /* ]]; then
+        args[index]="$PWD/${args[$index]}"
+    fi
+    local reply=""
+    if [ -S "$printcfg_socket" ] && { [ "$op" != "edit" ] || [ "${#args[@]}" -eq 2 ]; }; then
+        local request="" arg
+        for arg in "${args[@]}"; do
+            request+="${request:+, }$(_printcfg_json_string "$arg")"
+        done
+        # The edit plan file holds the JSON of the second argument
+        if [ "$op" = "edit" ]; then
+            request="$(_printcfg_json_string "${args[0]}"), $(<"${args[1]}")"
+        fi
+        request="{\"op\": $(_printcfg_json_string "$op"), \"args\": [$request]}"
+        reply=$(_printcfg_send "$request")
+    fi
+    # No reply: the daemon is not running (or cannot be reached),
+    # as it answers every request it reads, errors included
+    if [ -z "$reply" ]; then
+        python3 "$printcfg_src/printcfg_client.py" "$op" "${args[@]}"
+        return
+    fi
+    case "$reply" in
+        '{"ok": true, "result": '*'}')
+            reply=${reply#'{"ok": true, "result": '}
+            _printcfg_print_value "${reply%\}}"
+            ;;
+        '{"ok": false, "error": '*'}')
+            reply=${reply#'{"ok": false, "error": '}
+            echo "Error: $(_printcfg_print_value "${reply%\}}")" >&2
+            return 1
+            ;;
+        *)
+            echo "Error: Invalid reply from the daemon." >&2
+            return 1
+            ;;
+    esac
+}
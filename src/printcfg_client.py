@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# A tiny client for the printcfg helper daemon.
+# It only imports the standard socket and json modules, and runs
+# the operation in-process when no daemon is listening.
+#
+# Usage:
+#   python3 printcfg_client.py <operation> [args...]
+#
+# Operations:
+#   ping
+#   find <search_text> <file_name>
+#   exists <search_text> <file_name>
+#   lookup <file_name> <key> [<key> ...]
+#   replace <search_text> <replace_text> <file_name>
+#   edit <file_name> <plan.json>
+#   version <patch_notes_file>
+#   profile [<user_profile.cfg>]
+#   status
+#   shutdown
+#
+# Example:
+#   python3 printcfg_client.py version ~/printcfg/profiles/default/patch_notes.txt
+
+import json
+import os
+import socket
+import sys
+
+SOCKET_PATH = os.path.expanduser("~/printcfg/printcfg.sock")
+
+# Position of the file argument of each operation
+# (made absolute since the daemon runs in another directory)
+FILE_ARGS = {
+    "find": 1,
+    "exists": 1,
+    "lookup": 0,
+    "replace": 2,
+    "edit": 0,
+    "version": 0,
+    "profile": 0,
+}
+
+
+def call(op: str, *args, socket_path: str = SOCKET_PATH):
+    """
+    Runs an operation through the daemon, or in-process if it is not running.
+
+    Args:
+        op: The name of the operation.
+        args: The arguments of the operation.
+        socket_path: The path of the daemon socket.
+
+    Returns:
+        The result of the operation.
+
+    Raises:
+        RuntimeError: If the operation failed, or the daemon did not reply.
+    """
+    args = list(args)
+    index = FILE_ARGS.get(op)
+    if index is not None and index < len(args):
+        args[index] = os.path.abspath(args[index])
+    request = json.dumps({"op": op, "args": args}).encode("utf-8") + b"\n"
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            response = call_local(op, *args)
+        else:
+            # The daemon may have run the operation already: never run it
+            # again in-process
+            try:
+                sock.sendall(request)
+                with sock.makefile("rb") as reply:
+                    response = json.loads(reply.readline())
+            except (OSError, ValueError) as err:
+                raise RuntimeError(f"No reply from the daemon: {err}") from err
+    if not isinstance(response, dict):
+        raise RuntimeError("Invalid reply from the daemon.")
+    if not response.get("ok"):
+        raise RuntimeError(response.get("error"))
+    return response.get("result")
+
+
+def call_local(op: str, *args) -> dict:
+    """Runs an operation in this process."""
+    import threading
+
+    from printcfg_daemon import OPERATIONS, handle_request
+
+    if op == "shutdown":
+        return {"ok": True, "result": "Daemon not running."}
+    return handle_request(
+        {"op": op, "args": list(args)}, OPERATIONS, threading.Lock()
+    )
+
+
+def main(argv) -> int:
+    """Run the client from the command line."""
+    if len(argv) < 2:
+        print("Usage: python3 printcfg_client.py <operation> [args...]")
+        return 1
+    op, args = argv[1], argv[2:]
+    if op == "edit" and len(args) == 2:
+        with open(args[1], "r", encoding="utf-8") as plan:
+            args = [args[0], json.load(plan)]
+    try:
+        result = call(op, *args)
+    except RuntimeError as err:
+        print(f"Error: {err}", file=sys.stderr)
+        return 1
+    if isinstance(result, str):
+        print(result)
+    elif isinstance(result, bool) or result is None:
+        print(str(result))
+    else:
+        print(json.dumps(result))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
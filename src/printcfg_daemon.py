@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The printcfg helper daemon.
+
+Keeps one warm python process that serves the find, replace,
+version and profile helpers over a local Unix socket, so the
+shell scripts do not pay for a new interpreter on every call.
+
+Protocol:
+    One JSON request per line:  {"op": "<operation>", "args": [...]}
+    One JSON response per line: {"ok": true, "result": ...}
+                            or: {"ok": false, "error": "<message>"}
+
+The daemon runs as the printcfg-daemon service installed by
+'printcfg install' (or by hand with 'printcfg daemon'). The shell
+scripts query it with printcfg_call.sh, which needs no python,
+and python code with printcfg_client.py.
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from typing import Any, Callable, Dict, List
+
+from log_setup import get_logger
+
+logger: logging.Logger = get_logger("printcfg_daemon")
+
+# Default socket path
+SOCKET_PATH = os.path.expanduser("~/printcfg/printcfg.sock")
+
+
+def _find(search_text: str, file_name: str) -> str:
+    """Find the rest of the line containing search_text."""
+    from find_string import find_string
+
+    return find_string(search_text, file_name)
+
+
+def _exists(search_text: str, file_name: str) -> bool:
+    """Check whether search_text is in the file."""
+    from find_string import string_exists
+
+    return string_exists(search_text, file_name)
+
+
+def _lookup(file_name: str, *keys: str) -> dict:
+    """Look up several keys with a single read of the file."""
+    from find_string import batch_lookup
+
+    return batch_lookup(list(keys), file_name)
+
+
+def _replace(search_text: str, replace_text: str, file_name: str) -> bool:
+    """Replace the line containing search_text."""
+    from search_replace import simple_search_and_replace
+
+    return simple_search_and_replace(search_text, replace_text, file_name)
+
+
+def _edit(file_name: str, edits: List[List[str]]) -> Any:
+    """Apply an edit plan to a file."""
+    from search_replace import edit_file
+
+    return edit_file(file_name, [tuple(edit) for edit in edits])
+
+
+def _version(file_name: str) -> Any:
+    """Find the highest version in a patch notes file."""
+    from read_patch_notes import find_highest_version
+
+    return find_highest_version(file_name)
+
+
+def _profile(path: str = "") -> str:
+    """Find the profile name in a user profile."""
+    from printcfg import find_profile, profile_path
+
+    return find_profile(path or profile_path)
+
+
+def _status() -> dict:
+    """Collect the printcfg status."""
+    from printcfg import REPO, get_status
+
+    return get_status(REPO)
+
+
+# The operations served by the daemon
+OPERATIONS: Dict[str, Callable[..., Any]] = {
+    "ping": lambda: "pong",
+    "find": _find,
+    "exists": _exists,
+    "lookup": _lookup,
+    "replace": _replace,
+    "edit": _edit,
+    "version": _version,
+    "profile": _profile,
+    "status": _status,
+}
+
+
+def handle_request(
+    request: dict, operations: Dict[str, Callable[..., Any]], lock: threading.Lock
+) -> dict:
+    """
+    Runs a single request.
+
+    Args:
+        request: The decoded request.
+        operations: The operations that may be called.
+        lock: The lock serializing the operations.
+
+    Returns:
+        The response to send back.
+    """
+    if not isinstance(request, dict):
+        return {"ok": False, "error": "Invalid request."}
+    operation = operations.get(request.get("op", ""))
+    if operation is None:
+        return {"ok": False, "error": f"Invalid operation: {request.get('op')}"}
+    args = request.get("args", [])
+    if not isinstance(args, list):
+        return {"ok": False, "error": "Invalid arguments."}
+    try:
+        # File edits must never interleave
+        with lock:
+            result = operation(*args)
+    except Exception as err:  # pylint: disable=broad-except
+        # Any failure is reported: a dropped connection would make the
+        # client believe the operation never ran
+        logger.exception("Operation %s failed", request.get("op"))
+        return {"ok": False, "error": f"{type(err).__name__}: {err}"}
+    return {"ok": True, "result": result}
+
+
+def encode_response(response: dict) -> bytes:
+    """Encode a response, replacing a result that is not JSON by an error."""
+    try:
+        return json.dumps(response).encode("utf-8") + b"\n"
+    except (TypeError, ValueError) as err:
+        logger.error("Result cannot be sent: %s", err)
+        error = {"ok": False, "error": f"Result cannot be sent: {err}"}
+        return json.dumps(error).encode("utf-8") + b"\n"
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Serves the requests of one client connection."""
+
+    server: "PrintcfgDaemon"
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {"ok": False, "error": "Invalid request."}
+            else:
+                if isinstance(request, dict) and request.get("op") == "shutdown":
+                    response = {"ok": True, "result": "bye"}
+                    threading.Thread(target=self.server.shutdown).start()
+                else:
+                    response = handle_request(
+                        request, self.server.operations, self.server.lock
+                    )
+            self.wfile.write(encode_response(response))
+            self.wfile.flush()
+
+
+class PrintcfgDaemon(socketserver.ThreadingUnixStreamServer):
+    """A Unix socket server for the printcfg helpers."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, operations: Dict[str, Callable[..., Any]]):
+        self.operations = operations
+        self.lock = threading.Lock()
+        super().__init__(socket_path, _RequestHandler)
+
+
+def is_running(socket_path: str = SOCKET_PATH) -> bool:
+    """Check whether a daemon is listening on the socket."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+    except OSError:
+        return False
+    return True
+
+
+def serve(socket_path: str = SOCKET_PATH, operations=None) -> bool:
+    """
+    Runs the daemon until it is stopped.
+
+    Args:
+        socket_path: The path of the Unix socket to listen on.
+        operations: The operations to serve (default: OPERATIONS).
+
+    Returns:
+        False if another daemon is already running, True once stopped.
+    """
+    if is_running(socket_path):
+        logger.error("Daemon already running on %s", socket_path)
+        return False
+    # Remove a stale socket left by a daemon that did not stop cleanly
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    server = PrintcfgDaemon(socket_path, operations or OPERATIONS)
+    os.chmod(socket_path, 0o600)
+
+    def stop(*_):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("Daemon listening on %s", socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        logger.info("Daemon stopped.")
+    return True
+
+
+def main(args: List[str]):
+    """Run the printcfg helper daemon until it is stopped."""
+    logger.info("Starting printcfg daemon...")
+    print(f"Starting printcfg daemon on {SOCKET_PATH}...")
+    if not serve(SOCKET_PATH):
+        print("Error: The printcfg daemon is already running.")
+        sys.exit(1)
+    print("printcfg daemon stopped.")
+    sys.exit(0)
@@ -17,29 +17,201 @@
 # along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
 
 # This script reads the patch notes file and returns the highest version number.
+#
+# The patch notes of each profile are parsed into an index of entries
+# (version, notes, Add/Remove/MANUAL operations and available patch
+# files). The index is saved next to the patch notes and only rebuilt
+# when the patch notes or the patches directory change.
+#
+# Usage:
+#   python3 read_patch_notes.py <patch_notes_file> [--index]
+#
+# Options:
+#   --index: Print the whole index as JSON instead of the highest version.
 
+import json
+import os
 import re
 import sys
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
+# Name of the index file saved next to the patch notes
+INDEX_FILE = ".patch_notes.json"
+# Bump when the index layout changes
+INDEX_FORMAT = 1
+# Patch files that may be shipped with a version
+PATCH_FILES = ("config.patch", "vars.patch")
+# Operation headers of a patch notes entry
+OPERATIONS = ("Add", "Remove", "MANUAL")
 
-def find_highest_version(file_name):
-    """Finds highest version in patch notes."""
-    highest_version = None
+VERSION_PATTERN = re.compile(r"^(\d+\.\d+\.\d+):\s*$")
+OPERATION_PATTERN = re.compile(r"^\s+(" + "|".join(OPERATIONS) + r"):\s*$")
+
+
+class PatchEntry(NamedTuple):
+    """A single version of the patch notes."""
+
+    version: str
+    key: Tuple[int, ...]
+    notes: List[str]
+    operations: Dict[str, List[str]]
+    patches: Dict[str, bool]
+
+
+# Indexes loaded by this process, by patch notes file
+_loaded: Dict[str, Tuple[list, List[PatchEntry]]] = {}
+
+
+def version_key(version: str) -> Tuple[int, ...]:
+    """Converts a version string into a tuple that sorts numerically."""
+    return tuple(int(part) for part in re.findall(r"\d+", version))
+
+
+def parse_patch_notes(file_name: str) -> List[PatchEntry]:
+    """
+    Parses patch notes into entries, oldest version first.
 
+    Args:
+        file_name: The patch notes file.
+
+    Returns:
+        The entries of the patch notes.
+    """
+    entries: Dict[str, PatchEntry] = {}
+    entry: Optional[PatchEntry] = None
+    operation: Optional[str] = None
+    patches_dir = os.path.join(os.path.dirname(file_name), "patches")
     with open(file_name, "r", encoding="utf-8") as file:
-        content = file.read()
+        for line in file:
+            if not line.strip():
+                continue
+            match = VERSION_PATTERN.match(line)
+            if match:
+                version = match.group(1)
+                entry = entries.get(version)
+                if entry is None:
+                    patches = {
+                        name: os.path.isfile(os.path.join(patches_dir, version, name))
+                        for name in PATCH_FILES
+                    }
+                    entry = PatchEntry(
+                        version, version_key(version), [], {}, patches
+                    )
+                    entries[version] = entry
+                operation = None
+                continue
+            if entry is None:
+                continue
+            match = OPERATION_PATTERN.match(line)
+            if match:
+                operation = match.group(1)
+                entry.operations.setdefault(operation, [])
+            elif line.lstrip().startswith("- ") and operation is None:
+                entry.notes.append(line.strip()[2:])
+            elif operation is not None:
+                entry.operations[operation].append(line.strip())
+            else:
+                entry.notes.append(line.strip())
+    return sorted(entries.values(), key=lambda e: e.key)
+
+
+def _signature(file_name: str) -> list:
+    """Get the mtime and size of the patch notes and the patch directories."""
+    stat = os.stat(file_name)
+    signature = [stat.st_mtime_ns, stat.st_size]
+    patches_dir = os.path.join(os.path.dirname(file_name), "patches")
+    if os.path.isdir(patches_dir):
+        signature.append(os.stat(patches_dir).st_mtime_ns)
+        with os.scandir(patches_dir) as versions:
+            for version in sorted(versions, key=lambda v: v.name):
+                if version.is_dir():
+                    signature.append([version.name, version.stat().st_mtime_ns])
+    return signature
+
+
+def _read_index(index_file: str, signature: list) -> Optional[List[PatchEntry]]:
+    """Read a saved index if it matches the signature."""
+    try:
+        with open(index_file, "r", encoding="utf-8") as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if data.get("format") != INDEX_FORMAT or data.get("signature") != signature:
+        return None
+    return [
+        PatchEntry(
+            entry["version"],
+            tuple(entry["key"]),
+            entry["notes"],
+            entry["operations"],
+            entry["patches"],
+        )
+        for entry in data["entries"]
+    ]
+
+
+def _write_index(index_file: str, signature: list, entries: List[PatchEntry]):
+    """Save an index, atomically. A read-only profile is not an error."""
+    data = {
+        "format": INDEX_FORMAT,
+        "signature": signature,
+        "entries": [entry._asdict() for entry in entries],
+    }
+    temp_file = f"{index_file}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, "w", encoding="utf-8") as file:
+            json.dump(data, file, indent=1)
+        os.replace(temp_file, index_file)
+    except OSError:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
 
-    pattern = r"(\d+\.\d+\.\d+):"
-    versions = re.findall(pattern, content)
 
-    for version in versions:
-        if highest_version is None or version > highest_version:
-            highest_version = version
+def load_index(file_name: str) -> List[PatchEntry]:
+    """
+    Loads the patch notes index, rebuilding it if the patch notes changed.
 
-    return highest_version
+    Args:
+        file_name: The patch notes file.
+
+    Returns:
+        The entries of the patch notes, oldest version first.
+    """
+    file_name = os.path.abspath(file_name)
+    signature = _signature(file_name)
+    loaded = _loaded.get(file_name)
+    if loaded is not None and loaded[0] == signature:
+        return loaded[1]
+    index_file = os.path.join(os.path.dirname(file_name), INDEX_FILE)
+    entries = _read_index(index_file, signature)
+    if entries is None:
+        entries = parse_patch_notes(file_name)
+        _write_index(index_file, signature, entries)
+    _loaded[file_name] = (signature, entries)
+    return entries
+
+
+def find_versions(file_name: str) -> List[str]:
+    """Finds all versions in patch notes, oldest first."""
+    return [entry.version for entry in load_index(file_name)]
+
+
+def find_highest_version(file_name):
+    """Finds highest version in patch notes."""
+    entries = load_index(file_name)
+    if not entries:
+        return None
+    return entries[-1].version
 
 
-# Test the function
-f_name = sys.argv[1]
-h_version = find_highest_version(f_name)
-print(h_version)
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3) or sys.argv[2:] not in ([], ["--index"]):
+        print("Usage: python3 read_patch_notes.py <patch_notes_file> [--index]")
+        sys.exit(1)
+    f_name = sys.argv[1]
+    if sys.argv[2:]:
+        index = [entry._asdict() for entry in load_index(f_name)]
+        print(json.dumps(index, indent=4))
+    else:
+        h_version = find_highest_version(f_name)
+        print(h_version)
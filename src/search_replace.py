@@ -37,40 +37,237 @@
 #
 # Example:
 #   python3 search_replace.py "version" "version: 1.0.0" "patch_notes.txt"
+#
+# Several edits can be applied to a file at once with an edit plan.
+# The file is read once, every edit is applied in a single pass
+# and the result is written atomically (temp file, fsync, rename).
+#
+# Usage:
+#   python3 search_replace.py [--replace <search_text> <replace_text>]
+#                             [--regex <search_pattern> <replace_text>]
+#                             [--delete <search_text>]
+#                             [--plan <plan.json>] <file_name>
+#
+# Example:
+#   python3 search_replace.py --delete "[include old.cfg]" \
+#       --replace "[include new.cfg]" "[include new.cfg]" "printer.cfg"
 
-import datetime
-import getpass
+import json
 import logging
 import os
 import re
+import shutil
 import sys
+import tempfile
+from typing import BinaryIO, Callable, Iterable, List, Optional, Sequence, Tuple
+
+from log_setup import get_logger
+from pattern_matcher import LITERAL, REGEX, PatternMatcher
+
+logger: logging.Logger = get_logger("search_replace")
+
+# Edit modes
+#   literal: Replace the first line containing the text (add it if missing)
+#   regex:   Replace the first line matching the pattern (add it if missing)
+#   delete:  Remove every line containing the text
+EDIT_MODES = ("literal", "regex", "delete")
+
+# An edit is a (pattern, replacement, mode) tuple
+Edit = Tuple[str, str, str]
+
+
+def read_lines(file_name: str) -> List[str]:
+    """Read a file into a list of lines."""
+    with open(file_name, "r", encoding="utf-8") as f:
+        return f.readlines()
+
+
+def write_temp(
+    directory: str, name: str, write: Callable[[BinaryIO], object], sync: bool = True
+) -> str:
+    """
+    Writes a temporary file in a directory, to be renamed over a file.
+
+    Args:
+        directory: The directory of the file it will replace.
+        name: The name of that file, used in the temporary name.
+        write: Writes the content to the open binary file.
+        sync: Flush the file to disk before returning.
+
+    Returns:
+        The path of the temporary file.
+    """
+    fd, temp_name = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as temp:
+            write(temp)
+            if sync:
+                temp.flush()
+                os.fsync(temp.fileno())
+    except BaseException:
+        os.remove(temp_name)
+        raise
+    return temp_name
+
+
+def copy_to_temp(source: str, directory: str, name: str) -> str:
+    """Copy a file to a synced temporary file in a directory (see write_temp)."""
+    with open(source, "rb") as src:
+        return write_temp(directory, name, lambda temp: shutil.copyfileobj(src, temp))
+
+
+def fsync_dir(directory: str) -> None:
+    """Make the renames of a directory durable."""
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def write_lines_atomic(file_name: str, lines: Iterable[str]) -> None:
+    """
+    Writes the lines to a temporary file next to file_name,
+    flushes it to disk and renames it over the original,
+    so the file is never left half-written.
+
+    Args:
+        file_name: The name of the file to write.
+        lines: The lines to write.
+    """
+    # Replace the target of a symlink rather than the link itself
+    target = os.path.realpath(file_name)
+    directory = os.path.dirname(target)
+    temp_name = write_temp(
+        directory,
+        os.path.basename(target),
+        lambda temp: temp.writelines(line.encode("utf-8") for line in lines),
+    )
+    try:
+        # Keep the permissions and owner of the original file
+        if os.path.exists(target):
+            shutil.copymode(target, temp_name)
+            stat = os.stat(target)
+            try:
+                os.chown(temp_name, stat.st_uid, stat.st_gid)
+            except PermissionError:
+                pass
+        os.replace(temp_name, target)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    # Make sure the rename itself is on disk
+    fsync_dir(directory)
+    logger.debug("write_lines_atomic() wrote the file %s", file_name)
+
+
+def apply_edits(
+    lines: List[str], edits: Sequence[Edit]
+) -> Tuple[List[str], List[bool]]:
+    """
+    Applies all of the edits to the lines in a single pass.
 
-logger: logging.Logger = logging.getLogger(__name__)
-
-# Get the current user name
-current_user = getpass.getuser()
-user_home = os.path.expanduser("~")
-# Set the logfile
-logfile = f"{user_home}/printcfg/logs/search_replace.log"
-
-# Check the date of the first log entry
-# If it is older than 30 days, delete the logfile
-if os.path.exists(logfile):
-    with open(logfile, "r", encoding="utf-8") as file:
-        first_line = file.readline()
-        if first_line:
-            first_line = first_line.split(" - ")[0]
-            first_date = datetime.datetime.strptime(first_line, "%Y-%m-%d %H:%M:%S,%f")
-            thirty_days_ago = datetime.datetime.now() - datetime.timedelta(days=30)
-            if first_date < thirty_days_ago:
-                os.remove(logfile)
-
-# Set the logging level
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-handler = logging.FileHandler(logfile)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+    Each line is claimed by the first edit that matches it.
+    Replacements that match no line are inserted at the top
+    in the order they were given.
+
+    Args:
+        lines: The lines to edit.
+        edits: The (pattern, replacement, mode) edits to apply.
+
+    Returns:
+        The edited lines and whether each edit found its pattern.
+    """
+    for _, _, mode in edits:
+        if mode not in EDIT_MODES:
+            raise ValueError(f"Invalid edit mode: {mode}")
+    # Compile every pattern once and find the lines each one matches
+    matcher = PatternMatcher(
+        [(pattern, REGEX if mode == "regex" else LITERAL) for pattern, _, mode in edits]
+    )
+    matches = dict(matcher.line_matches(lines))
+    found = [False] * len(edits)
+    # Edits that may still match a line
+    pending = set(range(len(edits)))
+    result: List[str] = []
+    for line_no, line in enumerate(lines):
+        for i in matches.get(line_no, ()):
+            if i not in pending:
+                continue
+            found[i] = True
+            if edits[i][2] != "delete":
+                result.append(edits[i][1] + "\n")
+                pending.discard(i)
+            break
+        else:
+            result.append(line)
+    # Add the replacements that were not found at the top
+    missing = [
+        edits[i][1] + "\n"
+        for i in range(len(edits))
+        if not found[i] and edits[i][2] != "delete"
+    ]
+    return missing + result, found
+
+
+def edit_file(file_name: str, edits: Sequence[Edit]) -> Optional[List[bool]]:
+    """
+    Applies an edit plan to a file with one read and one atomic write.
+
+    The file is only rewritten if its contents changed.
+
+    Args:
+        file_name: The name of the file to edit.
+        edits: The (pattern, replacement, mode) edits to apply.
+
+    Returns:
+        Whether each edit found its pattern, or None if the plan is invalid.
+    """
+    logger.debug("edit_file() called with: file_name=%s, edits=%s", file_name, edits)
+    if file_name is None or any(None in edit for edit in edits):
+        logger.error("edit_file() failed due to invalid input: edits=%s", edits)
+        return None
+    lines = read_lines(file_name)
+    try:
+        new_lines, found = apply_edits(lines, edits)
+    except (ValueError, re.error) as err:
+        logger.error("edit_file() failed due to an invalid edit: %s", err)
+        return None
+    if new_lines != lines:
+        write_lines_atomic(file_name, new_lines)
+    else:
+        logger.debug("edit_file() left the file %s unchanged", file_name)
+    return found
+
+
+def load_plan(plan_name: str) -> List[Edit]:
+    """
+    Loads an edit plan from a JSON file ('-' for stdin).
+
+    The plan is a list of [pattern, replacement, mode] lists
+    or of objects with pattern, replacement and mode keys.
+    """
+    if plan_name == "-":
+        plan = json.load(sys.stdin)
+    else:
+        with open(plan_name, "r", encoding="utf-8") as f:
+            plan = json.load(f)
+    edits: List[Edit] = []
+    for entry in plan:
+        if isinstance(entry, dict):
+            entry = (
+                entry["pattern"],
+                entry.get("replacement", ""),
+                entry.get("mode", "literal"),
+            )
+        edits.append((str(entry[0]), str(entry[1]), str(entry[2])))
+    return edits
 
 
 def simple_search_and_replace(search_text, replace_text, file_name):
@@ -105,32 +302,15 @@ def simple_search_and_replace(search_text, replace_text, file_name):
         )
         return False
 
-    logger.debug("search_and_replace() opened the file %s", file_name)
-    with open(file_name, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    found = False
-    for i, line in enumerate(lines):
-        if search_text in line:
-            lines[i] = replace_text + "\n"
-            found = True
-        logger.debug(
-            "search_and_replace() did not find the search_text %s", search_text
-        )
-        break
-
-    if not found:
+    found = edit_file(file_name, [(search_text, replace_text, "literal")])
+    if found is None:
+        return False
+    if not found[0]:
         logger.debug(
             "search_and_replace() did not find the search_text %s", search_text
         )
-        lines.insert(0, replace_text + "\n")
         logger.debug("search_and_replace() inserted the replace_text %s", replace_text)
-
-    with open(file_name, "w", encoding="utf-8") as f:
-        f.writelines(lines)
-        logger.debug("search_and_replace() wrote the file %s", file_name)
-
-    return found
+    return found[0]
 
 
 def search_and_replace(search_text: str, replace_text: str, file_name: str) -> bool:
@@ -166,46 +346,72 @@ def search_and_replace(search_text: str, replace_text: str, file_name: str) -> b
         )
         return False
 
-    # Open the file
-    logger.debug("search_and_replace() opened the file %s", file_name)
-    with open(file_name, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    # Search the file for the search_text
-    found = False
-    for i, line in enumerate(lines):
-        if re.search(search_text, line):
-            lines[i] = replace_text + "\n"
-            found = True
-            break
-
-    # If the search_text wasn't found, insert the replace_text at the top
-    if not found:
-        lines.insert(0, replace_text + "\n")
-
-    # Write the file
-    logger.debug("search_and_replace() wrote the file %s", file_name)
-    with open(file_name, "w", encoding="utf-8") as f:
-        f.writelines(lines)
-
-    return found
+    # Replace the first matching line or insert the replace_text at the top
+    found = edit_file(file_name, [(search_text, replace_text, "regex")])
+    if found is None:
+        return False
+    return found[0]
 
 
-# Check the number of arguments
-if len(sys.argv) != 4:
-    # Print the usage
+def show_usage():
+    """Show the usage message."""
     print("Usage:")
     print("  python3 search_replace.py <search_text> <replace_text> <file_name>")
+    print("  python3 search_replace.py [--replace <search_text> <replace_text>]")
+    print("                            [--regex <search_pattern> <replace_text>]")
+    print("                            [--delete <search_text>]")
+    print("                            [--plan <plan.json>] <file_name>")
     print("Example:")
     print('  python3 search_replace.py "version" "version: 1.0.0" "patch_notes.txt"')
-    sys.exit(1)
 
-s_text = sys.argv[1]
-r_text = sys.argv[2]
-f_name = sys.argv[3]
 
-status = simple_search_and_replace(s_text, r_text, f_name)
-if status:
-    print("The change was successful.")
-else:
-    print("The text was added.")
+def parse_plan_args(args: List[str]) -> Optional[List[Edit]]:
+    """Parses the edit plan options into a list of edits."""
+    edits: List[Edit] = []
+    while args:
+        option = args.pop(0)
+        if option == "--replace" and len(args) >= 2:
+            edits.append((args.pop(0), args.pop(0), "literal"))
+        elif option == "--regex" and len(args) >= 2:
+            edits.append((args.pop(0), args.pop(0), "regex"))
+        elif option == "--delete" and args:
+            edits.append((args.pop(0), "", "delete"))
+        elif option == "--plan" and args:
+            edits.extend(load_plan(args.pop(0)))
+        else:
+            print(f"Invalid option: {option}")
+            return None
+    return edits
+
+
+def main(argv: List[str]) -> int:
+    """Run search_replace from the command line."""
+    if len(argv) == 4 and not argv[1].startswith("--"):
+        status = simple_search_and_replace(argv[1], argv[2], argv[3])
+        if status:
+            print("The change was successful.")
+        else:
+            print("The text was added.")
+        return 0
+    if len(argv) < 3 or not argv[1].startswith("--"):
+        show_usage()
+        return 1
+    f_name = argv[-1]
+    edits = parse_plan_args(argv[1:-1])
+    if not edits:
+        show_usage()
+        return 1
+    found = edit_file(f_name, edits)
+    if found is None:
+        print("The edit plan is invalid.")
+        return 1
+    for (pattern, _, mode), status in zip(edits, found):
+        if mode == "delete":
+            print(f"{'Deleted' if status else 'Not found'}: {pattern}")
+        else:
+            print(f"{'Changed' if status else 'Added'}: {pattern}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
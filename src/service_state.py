@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The state of systemd services.
+
+The state of any number of units is read with a single
+'systemctl show' call and cached for CACHE_TTL seconds,
+so polling the status does not spawn a process per check.
+
+The systemctl command can be replaced, for example by a
+stand-in script in tests, with the PRINTCFG_SYSTEMCTL
+environment variable or with set_runner().
+"""
+
+import os
+import shlex
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from log_setup import get_logger
+
+logger = get_logger("service_state")
+
+# How long a queried state is reused, in seconds
+CACHE_TTL = 2.0
+# Properties read for each unit
+PROPERTIES = (
+    "Id",
+    "Description",
+    "LoadState",
+    "ActiveState",
+    "SubState",
+    "UnitFileState",
+    "MainPID",
+    "ActiveEnterTimestamp",
+    "FragmentPath",
+)
+
+# Runs systemctl with the given arguments and returns its output
+Runner = Callable[[List[str]], str]
+
+
+class ServiceStateError(RuntimeError):
+    """Raised when the service state cannot be read."""
+
+
+@dataclass(frozen=True)
+class ServiceState:
+    """The state of a systemd unit."""
+
+    unit: str
+    description: str = ""
+    load_state: str = ""
+    active_state: str = ""
+    sub_state: str = ""
+    unit_file_state: str = ""
+    main_pid: int = 0
+    active_since: str = ""
+    fragment_path: str = ""
+
+    @property
+    def exists(self) -> bool:
+        """Whether the unit file exists."""
+        return self.load_state == "loaded"
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the unit is enabled."""
+        return self.unit_file_state == "enabled"
+
+    @property
+    def active(self) -> bool:
+        """Whether the unit is running."""
+        return self.active_state == "active"
+
+
+def _run_systemctl(args: List[str]) -> str:
+    """Run systemctl (or the command in PRINTCFG_SYSTEMCTL)."""
+    command = shlex.split(os.environ.get("PRINTCFG_SYSTEMCTL", "systemctl"))
+    try:
+        result = subprocess.run(
+            command + args, capture_output=True, check=False, stdin=subprocess.DEVNULL
+        )
+    except OSError as err:
+        raise ServiceStateError(f"Could not run {command[0]}: {err}") from err
+    if result.returncode != 0:
+        error = result.stderr.decode("utf-8", "replace").strip()
+        raise ServiceStateError(f"{command[0]} failed: {error}")
+    return result.stdout.decode("utf-8", "replace")
+
+
+_runner: Runner = _run_systemctl
+_cache: Dict[str, Tuple[float, ServiceState]] = {}
+
+
+def set_runner(runner: Optional[Runner] = None):
+    """
+    Replace the systemctl runner and clear the cache.
+
+    Args:
+        runner: The new runner (default: run systemctl).
+    """
+    global _runner
+    _runner = runner or _run_systemctl
+    clear_cache()
+
+
+def clear_cache():
+    """Forget all cached states."""
+    _cache.clear()
+
+
+def unit_name(service: str) -> str:
+    """Get the full unit name of a service (Eg: 'klipper' = 'klipper.service')."""
+    return service if "." in service else f"{service}.service"
+
+
+def parse_show(output: str, units: List[str]) -> Dict[str, ServiceState]:
+    """
+    Parses the output of 'systemctl show' for several units.
+
+    Args:
+        output: The output of systemctl show.
+        units: The units in the order they were queried.
+
+    Returns:
+        The state of each unit.
+    """
+    blocks: List[Dict[str, str]] = [{}]
+    for line in output.splitlines():
+        if not line.strip():
+            if blocks[-1]:
+                blocks.append({})
+            continue
+        key, _, value = line.partition("=")
+        blocks[-1][key] = value
+    blocks = [block for block in blocks if block]
+    states: Dict[str, ServiceState] = {}
+    for unit, props in zip(units, blocks):
+        pid = props.get("MainPID", "0")
+        states[unit] = ServiceState(
+            unit=props.get("Id") or unit,
+            description=props.get("Description", ""),
+            load_state=props.get("LoadState", ""),
+            active_state=props.get("ActiveState", ""),
+            sub_state=props.get("SubState", ""),
+            unit_file_state=props.get("UnitFileState", ""),
+            main_pid=int(pid) if pid.isdigit() else 0,
+            active_since=props.get("ActiveEnterTimestamp", ""),
+            fragment_path=props.get("FragmentPath", ""),
+        )
+    return states
+
+
+def get_states(services: List[str], ttl: float = CACHE_TTL) -> Dict[str, ServiceState]:
+    """
+    Gets the state of several services with at most one systemctl call.
+
+    Args:
+        services: The service or unit names.
+        ttl: How old a cached state may be, in seconds (0 to always query).
+
+    Returns:
+        The state of each service, by the name it was given as.
+
+    Raises:
+        ServiceStateError: If systemctl could not be run.
+    """
+    units = {service: unit_name(service) for service in services}
+    now = time.monotonic()
+    missing = [
+        unit
+        for unit in dict.fromkeys(units.values())
+        if unit not in _cache or now - _cache[unit][0] > ttl
+    ]
+    if missing:
+        logger.debug("Querying service state: %s", missing)
+        output = _runner(["show", f"--property={','.join(PROPERTIES)}", *missing])
+        for unit, state in parse_show(output, missing).items():
+            _cache[unit] = (now, state)
+    states = {}
+    for service, unit in units.items():
+        if unit not in _cache:
+            raise ServiceStateError(f"No state returned for {unit}")
+        states[service] = _cache[unit][1]
+    return states
+
+
+def get_state(service: str, ttl: float = CACHE_TTL) -> ServiceState:
+    """Gets the state of a single service."""
+    return get_states([service], ttl)[service]
+
+
+def format_state(state: ServiceState) -> str:
+    """Format a service state like the header of 'systemctl status'."""
+    lines = [f"{state.unit} - {state.description}"]
+    loaded = state.load_state
+    if state.exists:
+        loaded += f" ({state.fragment_path}; {state.unit_file_state})"
+    lines.append(f"     Loaded: {loaded}")
+    active = f"{state.active_state} ({state.sub_state})"
+    if state.active and state.active_since:
+        active += f" since {state.active_since}"
+    lines.append(f"     Active: {active}")
+    if state.main_pid:
+        lines.append(f"   Main PID: {state.main_pid}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 service_state.py <service> [<service> ...]")
+        sys.exit(1)
+    try:
+        for unit_state in get_states(sys.argv[1:]).values():
+            print(format_state(unit_state))
+    except ServiceStateError as err:
+        print(f"Error: {err}")
+        sys.exit(1)
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Snapshots of the config files managed by printcfg.
+
+Every file is stored once, as a blob named after its SHA-256 hash in
+~/printcfg/snapshots/objects, and a snapshot is a small JSON manifest
+of the hashes of the files. A file that did not change since an
+earlier snapshot reuses its blob, so a snapshot of unchanged files
+costs a manifest, and a snapshot identical to the last one costs
+nothing. The stat of each file is indexed so unchanged files are not
+hashed again.
+
+A snapshot is taken before each profile change, update, patch and
+repair. The oldest snapshots beyond MAX_SNAPSHOTS per config directory
+are removed, with the blobs no snapshot uses.
+
+A rollback first snapshots the current files, then copies every file
+of the snapshot next to its target and renames them all over their
+targets. The renames are recorded in a journal first, so a rollback
+that is interrupted is finished the next time the store is opened.
+
+Usage:
+    python3 snapshots.py snapshot [<note>]
+    python3 snapshots.py list [--json]
+    python3 snapshots.py rollback <id>
+
+Example:
+    python3 snapshots.py rollback 20231018-154210
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+from log_setup import get_logger
+from search_replace import copy_to_temp, fsync_dir, write_lines_atomic
+
+logger = get_logger("snapshots")
+
+# Where the blobs and manifests are kept
+SNAPSHOT_DIR = os.environ.get(
+    "PRINTCFG_SNAPSHOTS",
+    os.path.join(os.path.expanduser("~"), "printcfg", "snapshots"),
+)
+# The klipper config directory (PRINTCFG_DATA selects another instance)
+CONFIG_DIR = os.path.join(
+    os.environ.get("PRINTCFG_DATA", os.path.expanduser("~/printer_data")), "config"
+)
+# The files of the config directory that are snapshotted
+MANAGED_FILES = (
+    "printer.cfg",
+    "user_config.cfg",
+    "user_profile.cfg",
+    "moonraker.conf",
+    "moonraker-printcfg.conf",
+)
+# Number of snapshots kept per config directory
+MAX_SNAPSHOTS = 50
+# Bump when the manifest layout changes
+MANIFEST_FORMAT = 1
+
+
+class SnapshotError(RuntimeError):
+    """Raised when a snapshot cannot be found or restored."""
+
+
+class SnapshotStore:
+    """The blobs and manifests of the snapshots."""
+
+    def __init__(self, path: str = SNAPSHOT_DIR):
+        self.path = path
+        self.objects = os.path.join(path, "objects")
+        self.manifests = os.path.join(path, "manifests")
+        self.index_file = os.path.join(path, "index.json")
+        self.journal = os.path.join(path, "rollback.json")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.manifests, exist_ok=True)
+        self._lock_file = open(  # pylint: disable=consider-using-with
+            os.path.join(path, ".lock"), "w", encoding="utf-8"
+        )
+        self.recover()
+
+    def close(self):
+        """Release the store."""
+        self._lock_file.close()
+
+    def __enter__(self) -> "SnapshotStore":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _lock(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def blob_path(self, sha256: str) -> str:
+        """Get the path of a blob."""
+        return os.path.join(self.objects, sha256[:2], sha256[2:])
+
+    def _load_index(self) -> Dict[str, list]:
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as index:
+                return json.load(index)
+        except (OSError, ValueError):
+            return {}
+
+    def _hash(self, path: str, stat: os.stat_result, index: Dict[str, list]) -> str:
+        """Get the hash of a file, reusing the index when it is unchanged."""
+        entry = index.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(65536), b""):
+                digest.update(block)
+        index[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def _store_blob(self, path: str, sha256: str) -> bool:
+        """Store a file as a blob unless the blob exists."""
+        blob = self.blob_path(sha256)
+        if os.path.exists(blob):
+            return False
+        directory = os.path.dirname(blob)
+        os.makedirs(directory, exist_ok=True)
+        temp_name = copy_to_temp(path, directory, sha256[:8])
+        os.chmod(temp_name, 0o444)
+        os.replace(temp_name, blob)
+        return True
+
+    def manifest(self, snapshot_id: str) -> dict:
+        """
+        Get the manifest of a snapshot.
+
+        Args:
+            snapshot_id: The id of the snapshot, or a unique prefix of it.
+
+        Raises:
+            SnapshotError: If no single snapshot has the id.
+        """
+        names = [
+            name[: -len(".json")]
+            for name in os.listdir(self.manifests)
+            if name.endswith(".json") and name.startswith(snapshot_id)
+        ]
+        if len(names) != 1:
+            problem = "is ambiguous" if names else "not found"
+            raise SnapshotError(f"Snapshot {snapshot_id} {problem}")
+        with open(
+            os.path.join(self.manifests, f"{names[0]}.json"), "r", encoding="utf-8"
+        ) as manifest:
+            return json.load(manifest)
+
+    def snapshots(self, config_dir: Optional[str] = None) -> List[dict]:
+        """Get the manifests of the snapshots of a config directory, oldest first."""
+        manifests = []
+        for name in os.listdir(self.manifests):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(
+                    os.path.join(self.manifests, name), "r", encoding="utf-8"
+                ) as manifest:
+                    data = json.load(manifest)
+            except (OSError, ValueError) as err:
+                logger.warning("Skipping the manifest %s: %s", name, err)
+                continue
+            if config_dir is None or data.get("config_dir") == config_dir:
+                manifests.append(data)
+        manifests.sort(key=lambda manifest: (manifest["created"], manifest["id"]))
+        return manifests
+
+    def snapshot(
+        self,
+        config_dir: str = CONFIG_DIR,
+        reason: str = "manual",
+        note: str = "",
+        keep: int = MAX_SNAPSHOTS,
+        protect: Optional[str] = None,
+    ) -> dict:
+        """
+        Snapshots the managed files of a config directory.
+
+        Args:
+            config_dir: The klipper config directory.
+            reason: Why the snapshot was taken (Eg: 'update').
+            note: A description of the snapshot.
+            keep: The number of snapshots kept for the config directory.
+            protect: The id of a snapshot that is never pruned.
+
+        Returns:
+            The manifest of the snapshot, or of the last snapshot when
+            the files did not change since.
+        """
+        config_dir = os.path.abspath(config_dir)
+        self._lock()
+        try:
+            index = self._load_index()
+            files: Dict[str, Optional[dict]] = {}
+            stored = 0
+            for name in MANAGED_FILES:
+                path = os.path.join(config_dir, name)
+                try:
+                    # Snapshot the content of linked files
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    files[name] = None
+                    continue
+                sha256 = self._hash(path, stat, index)
+                stored += self._store_blob(path, sha256)
+                files[name] = {
+                    "sha256": sha256,
+                    "size": stat.st_size,
+                    "mode": stat.st_mode & 0o7777,
+                }
+            write_lines_atomic(self.index_file, [json.dumps(index)])
+            previous = self.snapshots(config_dir)
+            if previous and previous[-1]["files"] == files:
+                logger.info("No change since snapshot %s", previous[-1]["id"])
+                return previous[-1]
+            digest = hashlib.sha256(
+                json.dumps(files, sort_keys=True).encode("utf-8")
+            ).hexdigest()
+            manifest = {
+                "format": MANIFEST_FORMAT,
+                "id": f"{time.strftime('%Y%m%d-%H%M%S')}-{digest[:6]}",
+                "created": time.time(),
+                "reason": reason,
+                "note": note,
+                "config_dir": config_dir,
+                "files": files,
+            }
+            write_lines_atomic(
+                os.path.join(self.manifests, f"{manifest['id']}.json"),
+                [json.dumps(manifest, indent=4)],
+            )
+            fsync_dir(self.manifests)
+            logger.info(
+                "Snapshot %s (%s): %s new blobs", manifest["id"], reason, stored
+            )
+            self._prune(previous + [manifest], keep, protect)
+            return manifest
+        finally:
+            self._unlock()
+
+    def _prune(self, manifests: List[dict], keep: int, protect: Optional[str] = None):
+        """Remove the oldest snapshots and the blobs no snapshot uses."""
+        candidates = [manifest for manifest in manifests if manifest["id"] != protect]
+        removed = candidates[: max(len(manifests) - keep, 0)]
+        if not removed:
+            return
+        for manifest in removed:
+            os.remove(os.path.join(self.manifests, f"{manifest['id']}.json"))
+            logger.info("Removed snapshot %s", manifest["id"])
+        used = {
+            entry["sha256"]
+            for manifest in self.snapshots()
+            for entry in manifest["files"].values()
+            if entry
+        }
+        for directory in os.listdir(self.objects):
+            for name in os.listdir(os.path.join(self.objects, directory)):
+                if directory + name not in used:
+                    os.remove(os.path.join(self.objects, directory, name))
+
+    def rollback(self, snapshot_id: str, config_dir: str = CONFIG_DIR) -> List[str]:
+        """
+        Restores the files of a snapshot.
+
+        The current files are snapshotted first, so a rollback can be
+        undone with another rollback. Files that did not exist when the
+        snapshot was taken are left in place.
+
+        Args:
+            snapshot_id: The id of the snapshot, or a unique prefix of it.
+            config_dir: The klipper config directory.
+
+        Returns:
+            The restored files.
+
+        Raises:
+            SnapshotError: If the snapshot is not found, belongs to another
+                           config directory or misses a blob.
+        """
+        config_dir = os.path.abspath(config_dir)
+        manifest = self.manifest(snapshot_id)
+        if manifest["config_dir"] != config_dir:
+            raise SnapshotError(
+                f"Snapshot {manifest['id']} is of {manifest['config_dir']}"
+            )
+        # The snapshot rolled back to must survive the pruning
+        current = self.snapshot(
+            config_dir,
+            "rollback",
+            f"Before the rollback to {manifest['id']}",
+            protect=manifest["id"],
+        )
+        self._lock()
+        try:
+            renames = []
+            try:
+                for name, entry in manifest["files"].items():
+                    if entry is None or entry == current["files"].get(name):
+                        continue
+                    blob = self.blob_path(entry["sha256"])
+                    if not os.path.exists(blob):
+                        raise SnapshotError(f"Missing blob of {name}: {blob}")
+                    # Replace the target of a symlink rather than the link itself
+                    target = os.path.realpath(os.path.join(config_dir, name))
+                    temp_name = copy_to_temp(blob, os.path.dirname(target), name)
+                    os.chmod(temp_name, entry["mode"])
+                    renames.append((temp_name, target))
+            except BaseException:
+                for temp_name, _ in renames:
+                    os.remove(temp_name)
+                raise
+            # Every file is staged: record the renames, then make them
+            journal = {"id": manifest["id"], "renames": renames}
+            write_lines_atomic(self.journal, [json.dumps(journal)])
+            self._finish(renames)
+        finally:
+            self._unlock()
+        logger.info("Rolled back to %s: %s", manifest["id"], renames)
+        return [os.path.basename(target) for _, target in renames]
+
+    def _finish(self, renames: List[List[str]]):
+        """Make the renames of a rollback and remove its journal."""
+        for temp_name, target in renames:
+            if os.path.exists(temp_name):
+                os.replace(temp_name, target)
+        for directory in {os.path.dirname(target) for _, target in renames}:
+            fsync_dir(directory)
+        os.remove(self.journal)
+
+    def recover(self):
+        """Finish a rollback that was interrupted."""
+        if not os.path.exists(self.journal):
+            return
+        self._lock()
+        try:
+            with open(self.journal, "r", encoding="utf-8") as journal:
+                data = json.load(journal)
+            logger.warning("Finishing the interrupted rollback to %s", data["id"])
+            self._finish(data["renames"])
+        except (OSError, ValueError, KeyError) as err:
+            logger.error("Could not finish the interrupted rollback: %s", err)
+        finally:
+            self._unlock()
+
+
+def take_snapshot(
+    reason: str, note: str = "", config_dir: str = CONFIG_DIR
+) -> Optional[str]:
+    """
+    Snapshots the config files before a change, without failing it.
+
+    Args:
+        reason: Why the snapshot is taken (Eg: 'update').
+        note: A description of the snapshot.
+        config_dir: The klipper config directory.
+
+    Returns:
+        The id of the snapshot, or None if it failed.
+    """
+    try:
+        with SnapshotStore() as store:
+            return store.snapshot(config_dir, reason, note)["id"]
+    except (OSError, ValueError) as err:
+        logger.error("Could not snapshot %s: %s", config_dir, err)
+        return None
+
+
+def print_snapshots(manifests: List[dict]):
+    """Print the snapshots and the files changed by each."""
+    previous: Dict[str, Optional[dict]] = {}
+    rows = []
+    for manifest in manifests:
+        changed = [
+            name
+            for name, entry in manifest["files"].items()
+            if previous and previous.get(name) != entry
+        ]
+        previous = manifest["files"]
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(manifest["created"]))
+        rows.append((manifest, when, changed))
+    print(f"{'id':<22}  {'date':<16}  {'reason':<8}  note")
+    for manifest, when, changed in reversed(rows):
+        reason = manifest["reason"]
+        print(f"{manifest['id']:<22}  {when:<16}  {reason:<8}  {manifest['note']}")
+        if changed:
+            print(f"{'':<22}  changed: {', '.join(changed)}")
+
+
+def main(argv: List[str]) -> int:
+    """Manage the snapshots from the command line."""
+    args = argv[1:]
+    command = args.pop(0) if args else ""
+    try:
+        with SnapshotStore() as store:
+            if command == "snapshot":
+                note = " ".join(args)
+                manifest = store.snapshot(CONFIG_DIR, "manual", note)
+                print(f"Snapshot: {manifest['id']}")
+            elif command == "list" and args in ([], ["--json"]):
+                manifests = store.snapshots(CONFIG_DIR)
+                if args:
+                    print(json.dumps(manifests, indent=4))
+                elif manifests:
+                    print_snapshots(manifests)
+                else:
+                    print(f"No snapshots of {CONFIG_DIR}.")
+            elif command == "rollback" and len(args) == 1:
+                restored = store.rollback(args[0], CONFIG_DIR)
+                if restored:
+                    print(f"\033[32mRestored: {', '.join(restored)}\033[0m")
+                    print("Restart Klipper to load the restored config.")
+                else:
+                    print("The files already match the snapshot.")
+            else:
+                print("Usage: python3 snapshots.py snapshot [<note>]")
+                print("       python3 snapshots.py list [--json]")
+                print("       python3 snapshots.py rollback <id>")
+                return 1
+    except (OSError, SnapshotError) as err:
+        print(f"\033[31mError: {err}\033[0m")
+        logger.error("%s failed: %s", command, err)
+        return 1
+    return 0
+
+
+def cmd_snapshot(args: List[str]) -> bool:
+    """Handle 'printcfg snapshot [<note>]'."""
+    return main([sys.argv[0], "snapshot", *args]) == 0
+
+
+def cmd_list(args: List[str]) -> bool:
+    """Handle 'printcfg snapshots [--json]'."""
+    return main([sys.argv[0], "list", *args]) == 0
+
+
+def cmd_rollback(args: List[str]) -> bool:
+    """Handle 'printcfg rollback <id>'."""
+    return main([sys.argv[0], "rollback", *args]) == 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
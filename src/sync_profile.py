@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+# This script deploys a profile into the klipper config directory.
+# A SHA-256 manifest of the deployed files is kept in the config directory,
+# so a file is only written when its content differs from the profile, and
+# changes made by the user since the last deploy are detected.
+#
+# The profile's config.cfg and variables.cfg are copied to user_config.cfg
+# and user_profile.cfg. The repo root *.cfg files are included through the
+# printcfg link, so they are never copied: their hashes are tracked to
+# report which of them changed since the last sync.
+#
+# A copy of each deployed variables.cfg is kept in .printcfg_base, so a
+# forced sync of the same profile merges the new variables into a
+# user_profile.cfg the user changed (see merge_variables.py) instead of
+# replacing it.
+#
+# Usage:
+#   python3 sync_profile.py [--force] [--check] <profile> [config_dir] [repo_dir]
+#
+# Options:
+#   --force: Replace the user files when they differ from the profile.
+#            Without it, existing user files are never touched.
+#   --check: Report the changes without writing anything.
+#
+# Example:
+#   python3 sync_profile.py --force default ~/printer_data/config ~/printcfg
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+from typing import Dict, List, NamedTuple, Optional
+
+from log_setup import get_logger
+from merge_variables import merge_lines, print_report
+from search_replace import copy_to_temp, read_lines, write_lines_atomic
+
+logger = get_logger("sync_profile")
+
+# Name of the manifest in the config directory
+MANIFEST_FILE = ".printcfg_manifest.json"
+# Bump when the manifest layout changes
+MANIFEST_FORMAT = 1
+# Profile files and the user files they are deployed to
+PROFILE_FILES = {
+    "config.cfg": "user_config.cfg",
+    "variables.cfg": "user_profile.cfg",
+}
+# Name of the printcfg link in the config directory
+REPO_LINK = "printcfg"
+# Directory of the deployed profile files, the base of the variable merges
+BASE_DIR = ".printcfg_base"
+# User files merged instead of replaced when the user changed them
+MERGED_FILES = ("user_profile.cfg",)
+
+# Change set actions
+CREATED = "created"
+UPDATED = "updated"
+REPLACED = "replaced"
+MERGED = "merged"
+UNCHANGED = "unchanged"
+KEPT = "kept"
+CHANGED = "changed"
+TRACKED = "tracked"
+
+
+class Change(NamedTuple):
+    """A single entry of the change set."""
+
+    action: str
+    target: str
+    source: str
+    note: str = ""
+
+
+def file_hash(path: str) -> str:
+    """Get the SHA-256 hash of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """The hashes of the deployed files, with their stat to skip re-hashing."""
+
+    def __init__(self, config_dir: str):
+        self.path = os.path.join(config_dir, MANIFEST_FILE)
+        self.profile: Optional[str] = None
+        self.files: Dict[str, dict] = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return
+        if data.get("format") == MANIFEST_FORMAT:
+            self.profile = data.get("profile")
+            self.files = data.get("files", {})
+
+    def deployed_hash(self, target: str) -> Optional[str]:
+        """Get the hash a file had when it was last deployed or synced."""
+        entry = self.files.get(target)
+        return entry["sha256"] if entry else None
+
+    def current_hash(self, target: str, path: str) -> str:
+        """Get the hash of a file, reusing the manifest when it is unchanged."""
+        stat = os.stat(path)
+        entry = self.files.get(target)
+        if (
+            entry
+            and entry.get("size") == stat.st_size
+            and entry.get("mtime_ns") == stat.st_mtime_ns
+        ):
+            return entry["sha256"]
+        return file_hash(path)
+
+    def record(self, target: str, source: str, path: str, sha256: str):
+        """Record the hash of a file."""
+        stat = os.stat(path)
+        self.files[target] = {
+            "source": source,
+            "sha256": sha256,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+    def save(self):
+        """Write the manifest."""
+        data = {
+            "format": MANIFEST_FORMAT,
+            "profile": self.profile,
+            "files": self.files,
+        }
+        write_lines_atomic(self.path, [json.dumps(data, indent=4, sort_keys=True)])
+
+
+def copy_atomic(source: str, target: str):
+    """Copy a file over the target in a single rename."""
+    temp_name = copy_to_temp(
+        source, os.path.dirname(os.path.abspath(target)), os.path.basename(target)
+    )
+    try:
+        shutil.copymode(target if os.path.exists(target) else source, temp_name)
+        os.replace(temp_name, target)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+def merge_user_file(
+    source: str, path: str, base_path: str, check: bool = False
+) -> bool:
+    """
+    Merges the variables of a profile file into a user file.
+
+    Args:
+        source: The new profile file.
+        path: The user file.
+        base_path: The profile file as it was last deployed.
+        check: Only report the merge without writing.
+
+    Returns:
+        Whether the merge changed the user file.
+    """
+    user_lines = read_lines(path)
+    result = merge_lines(read_lines(base_path), read_lines(source), user_lines)
+    print_report(result)
+    if result.lines == user_lines:
+        return False
+    if not check:
+        write_lines_atomic(path, result.lines)
+    return True
+
+
+def sync_profile(
+    profile: str,
+    config_dir: str,
+    repo_dir: str,
+    force: bool = False,
+    check: bool = False,
+) -> List[Change]:
+    """
+    Deploys a profile into the config directory.
+
+    Args:
+        profile: The name of the profile.
+        config_dir: The klipper config directory.
+        repo_dir: The printcfg repo directory.
+        force: Replace user files that differ from the profile.
+        check: Only work out the change set without writing.
+
+    Returns:
+        The change set.
+
+    Raises:
+        FileNotFoundError: If the profile is missing a file.
+    """
+    manifest = Manifest(config_dir)
+    changes: List[Change] = []
+    profile_dir = os.path.join(repo_dir, "profiles", profile)
+    for name, target in PROFILE_FILES.items():
+        source = os.path.join(profile_dir, name)
+        if not os.path.isfile(source):
+            raise FileNotFoundError(f"Profile file not found: {source}")
+        source_rel = os.path.relpath(source, repo_dir)
+        path = os.path.join(config_dir, target)
+        source_hash = file_hash(source)
+        if not os.path.exists(path):
+            action, note = CREATED, ""
+        else:
+            current = manifest.current_hash(target, path)
+            deployed = manifest.deployed_hash(target)
+            user_modified = deployed is not None and current != deployed
+            note = "modified by user" if user_modified else ""
+            if current == source_hash:
+                action = UNCHANGED
+            elif not force:
+                action = KEPT
+            else:
+                action = REPLACED if user_modified else UPDATED
+            base_path = os.path.join(config_dir, BASE_DIR, target)
+            if (
+                action in (UPDATED, REPLACED)
+                and target in MERGED_FILES
+                and manifest.files.get(target, {}).get("source") == source_rel
+                and os.path.isfile(base_path)
+                and current != file_hash(base_path)
+            ):
+                # The user file differs from the deployed profile file
+                merged = merge_user_file(source, path, base_path, check)
+                if not check:
+                    copy_atomic(source, base_path)
+                    manifest.record(target, source_rel, path, file_hash(path))
+                    logger.info("Merged %s into %s", source, path)
+                action = MERGED if merged else UNCHANGED
+                changes.append(Change(action, target, source_rel, note))
+                continue
+            if action in (UNCHANGED, KEPT):
+                # Only record files known to match the profile, so user
+                # changes to a kept file are still reported next time
+                if not check and current == source_hash:
+                    manifest.record(target, source_rel, path, current)
+                changes.append(Change(action, target, source_rel, note))
+                continue
+        if not check:
+            copy_atomic(source, path)
+            manifest.record(target, source_rel, path, source_hash)
+            if target in MERGED_FILES:
+                os.makedirs(os.path.join(config_dir, BASE_DIR), exist_ok=True)
+                copy_atomic(source, os.path.join(config_dir, BASE_DIR, target))
+            logger.info("%s %s from %s", action.capitalize(), path, source)
+        changes.append(Change(action, target, source_rel, note))
+    # The root configs are included through the link, only track them
+    link = os.path.join(config_dir, REPO_LINK)
+    for source in sorted(glob.glob(os.path.join(repo_dir, "*.cfg"))):
+        name = os.path.basename(source)
+        target = f"{REPO_LINK}/{name}"
+        path = os.path.join(link, name) if os.path.isdir(link) else source
+        current = manifest.current_hash(target, path)
+        if current == manifest.deployed_hash(target):
+            action = UNCHANGED
+        else:
+            action = TRACKED if manifest.deployed_hash(target) is None else CHANGED
+        if not check:
+            manifest.record(target, name, path, current)
+        changes.append(Change(action, target, name, "linked"))
+    if not check:
+        if force or manifest.profile is None:
+            manifest.profile = profile
+        manifest.save()
+    return changes
+
+
+def main(argv: List[str]) -> int:
+    """Sync a profile from the command line."""
+    force = "--force" in argv
+    check = "--check" in argv
+    args = [arg for arg in argv[1:] if arg not in ("--force", "--check")]
+    if not args:
+        print(
+            "Usage: python3 sync_profile.py [--force] [--check] "
+            "<profile> [config_dir] [repo_dir]"
+        )
+        return 1
+    home = os.path.expanduser("~")
+    profile = args[0]
+    config_dir = args[1] if len(args) > 1 else f"{home}/printer_data/config"
+    repo_dir = args[2] if len(args) > 2 else f"{home}/printcfg"
+    try:
+        changes = sync_profile(profile, config_dir, repo_dir, force, check)
+    except OSError as err:
+        print(f"\033[31mProfile sync failed: {err}\033[0m")
+        logger.error("Profile sync failed: %s", err)
+        return 1
+    written = [
+        c for c in changes if c.action in (CREATED, UPDATED, REPLACED, MERGED)
+    ]
+    for change in changes:
+        if change.note == "linked" and change.action == UNCHANGED:
+            continue
+        note = f" ({change.note})" if change.note else ""
+        print(f"  {change.action:<10} {change.target} <- {change.source}{note}")
+        if change.action == KEPT:
+            print(f"{'':13}Use --force to replace it with the {profile} profile.")
+    verb = "would be written" if check else "written"
+    print(f"\033[32mProfile {profile}: {len(written)} file(s) {verb}.\033[0m")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,116 @@
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the git mirror against a temporary bare repo."""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
+
+# pylint: disable=wrong-import-position
+from git_mirror import Mirror, MirrorError, git
+
+
+class MirrorTest(unittest.TestCase):
+    """Tests of git_mirror.Mirror."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.remote = os.path.join(self.tmp.name, "remote.git")
+        self.work = os.path.join(self.tmp.name, "work")
+        git("init", "--quiet", "--bare", self.remote)
+        git("clone", "--quiet", self.remote, self.work)
+        self.first = self.commit("first")
+        self.commit("second")
+        git(
+            "push",
+            "--quiet",
+            "origin",
+            "HEAD:main",
+            "HEAD~1:refs/heads/dev",
+            cwd=self.work,
+        )
+        self.mirror = Mirror(
+            os.path.join(self.tmp.name, "mirror.git"), self.remote, offline=False
+        )
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def commit(self, message: str) -> str:
+        """Commit to the work tree and return the commit."""
+        git(
+            "-c",
+            "user.name=printcfg",
+            "-c",
+            "user.email=printcfg@localhost",
+            "commit",
+            "--quiet",
+            "--allow-empty",
+            "-m",
+            message,
+            cwd=self.work,
+        )
+        return git("rev-parse", "HEAD", cwd=self.work).strip()
+
+    def test_fetch(self):
+        self.assertFalse(self.mirror.exists())
+        self.assertTrue(self.mirror.fetch())
+        self.assertTrue(self.mirror.exists())
+        # A recent fetch is reused
+        self.assertFalse(self.mirror.fetch())
+        self.assertTrue(self.mirror.fetch(max_age=0))
+
+    def test_branches(self):
+        self.mirror.fetch()
+        head = git("rev-parse", "HEAD", cwd=self.work).strip()
+        self.assertEqual(self.mirror.branches(), {"dev": self.first, "main": head})
+        self.assertTrue(self.mirror.has_branch("dev"))
+        self.assertFalse(self.mirror.has_branch("missing"))
+
+    def test_fetch_updates_branches(self):
+        self.mirror.fetch()
+        self.mirror.branches()
+        head = self.commit("third")
+        git("push", "--quiet", "origin", "HEAD:main", cwd=self.work)
+        self.mirror.fetch(max_age=0)
+        self.assertEqual(self.mirror.branches()["main"], head)
+
+    def test_commits_behind(self):
+        self.mirror.fetch()
+        self.assertEqual(self.mirror.commits_behind(self.first, "main"), 1)
+        self.assertEqual(self.mirror.commits_behind(self.first, "dev"), 0)
+        # A commit the mirror does not have
+        local = self.commit("local")
+        self.assertIsNone(self.mirror.commits_behind(local, "main"))
+        with self.assertRaises(MirrorError):
+            self.mirror.commits_behind(self.first, "missing")
+
+    def test_offline(self):
+        offline = Mirror(self.mirror.path, self.remote, offline=True)
+        with self.assertRaises(MirrorError):
+            offline.fetch()
+        self.mirror.fetch()
+        self.assertFalse(offline.fetch())
+        self.assertTrue(offline.has_branch("main"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+# Copyright (C) 2023 Chris Laprade (chris@rootiest.com)
+#
+# This file is part of printcfg.
+#
+# printcfg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# printcfg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with printcfg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of the Moonraker client against the stand-in server."""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
+
+# pylint: disable=wrong-import-position
+from fake_moonraker import FakeMoonraker
+from moonraker import PRINTCFG_OBJECT, Moonraker
+
+
+def printer_objects() -> dict:
+    """Get the objects of an idle printer."""
+    return {
+        "webhooks": {"state": "ready"},
+        "print_stats": {"state": "standby"},
+        PRINTCFG_OBJECT: {"variable_version": "'4.1.0'"},
+    }
+
+
+class MoonrakerTest(unittest.TestCase):
+    """Tests of moonraker.Moonraker."""
+
+    def setUp(self):
+        self.server = FakeMoonraker(objects=printer_objects()).start()
+        self.client = Moonraker(self.server.url, ttl=60)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def queries(self) -> int:
+        """Count the object queries the server received."""
+        return self.server.requests.count(("GET", "/printer/objects/query"))
+
+    def test_get_is_cached(self):
+        self.assertEqual(self.client.print_state(), "standby")
+        self.assertEqual(self.client.print_state(), "standby")
+        self.assertEqual(self.queries(), 1)
+        # A ttl of 0 always sends the request
+        self.client.print_state(ttl=0)
+        self.assertEqual(self.queries(), 2)
+
+    def test_post_clears_cache(self):
+        self.client.print_state()
+        self.client.gcode("M117 test")
+        self.server.update({"print_stats": {"state": "printing"}})
+        self.assertEqual(self.client.print_state(), "printing")
+        self.assertEqual(self.queries(), 2)
+        self.assertEqual(self.server.scripts, ["M117 test"])
+
+    def test_one_connection(self):
+        self.client.server_info(ttl=0)
+        self.client.print_state(ttl=0)
+        self.client.printcfg_variables(ttl=0)
+        self.client.gcode("G28")
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_subscription(self):
+        subscription = self.client.subscribe(["print_stats"])
+        self.assertTrue(subscription.connected)
+        self.assertEqual(self.client.print_state(), "standby")
+        self.server.update({"print_stats": {"state": "printing"}})
+        deadline = time.monotonic() + 5
+        while self.client.print_state() != "printing":
+            self.assertLess(time.monotonic(), deadline, "No status update received")
+            time.sleep(0.01)
+        self.assertTrue(self.client.is_printing(ttl=0))
+        # The subscribed object is never queried over HTTP
+        self.assertEqual(self.queries(), 0)
+        # Objects outside the subscription still are
+        self.assertEqual(
+            self.client.printcfg_variables(), {"variable_version": "'4.1.0'"}
+        )
+        self.assertEqual(self.queries(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()